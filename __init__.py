@@ -0,0 +1,63 @@
+""" Shared modules for Hacker Dojo apps.
+
+Importing this package doesn't import any of its modules. Each one is imported
+the first time it is used, so a cold instance only pays for the ones it needs:
+
+from shared import keymaster  # Imports shared.lib.keymaster now.
+
+import shared
+shared.api.domain("/api/v1/members")  # Imports shared.api here.
+
+Importing a module directly, like "from shared.lib import keymaster", still
+works as usual.
+
+Apps whose webapp handlers raise utils.RedirectException need to call
+utils.install_redirect_handler() when they start up. Importing utils doesn't
+patch webapp by itself any more. """
+
+
+import importlib
+import sys
+import types
+
+
+# The names of the modules this package exposes, and where they are.
+MODULES = {
+    "api": "api",
+    "auth": "auth",
+    "breaker": "breaker",
+    "cassette": "lib.cassette",
+    "codec": "codec",
+    "config": "config",
+    "failover": "failover",
+    "keymaster": "lib.keymaster",
+    "latency": "latency",
+    "localcache": "localcache",
+    "session": "session",
+    "urlfetch_intercept": "lib.urlfetch_intercept",
+    "utils": "utils",
+    "warmup": "warmup",
+}
+
+
+""" A module that imports the modules in MODULES the first time they are
+accessed as its attributes. """
+class LazyPackage(types.ModuleType):
+  def __getattr__(self, name):
+    if name not in MODULES:
+      raise AttributeError("'%s' has no module '%s'" % (self.__name__, name))
+    module = importlib.import_module("%s.%s" % (self.__name__, MODULES[name]))
+    setattr(self, name, module)
+    return module
+
+  def __dir__(self):
+    return sorted(set(self.__dict__) | set(MODULES))
+
+
+_package = LazyPackage(__name__, __doc__)
+_package.__dict__.update((name, value) for name, value in globals().items()
+                         if name not in ("__name__", "__doc__"))
+# Keeps this module alive. Python 2 clears the globals of modules that are
+# garbage collected, which would break LazyPackage.
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
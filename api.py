@@ -11,31 +11,541 @@ last good response that it will use when a request cache expires and the new
 request fails to respond in a timely fashion. It will keep using this while
 trying every time until it gets a good response.
 
+Responses are stored once, as the failover copy, encoded by the codec module.
+The request cache entry is just a marker saying that copy is still fresh. The
+failover copy is also written behind to the datastore (see the failover
+module, including how to wrap the app so that those writes are finished after
+each response), so it survives memcache losing it.
+
+Requests to a host that keeps failing are cut short by a circuit breaker (see
+the breaker module), so while it is down callers get the failover copy without
+waiting for the deadline first.
+
+Refreshes are conditional requests whenever the upstream app gave us an ETag
+or Last-Modified header for the cached copy, and a 304 response just extends
+the life of that copy without downloading or parsing it again.
+
+With STALE_WHILE_REVALIDATE turned on, an expired request cache doesn't make
+the caller wait at all: the failover copy is served right away and the refresh
+is handed off to REFRESHER, which by default runs it on the task queue through
+the deferred library. That needs the deferred builtin in app.yaml:
+
+builtins:
+- deferred: on
+
 """
+import logging
+import threading
+import time
+import urlparse
+
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from django.utils import simplejson
 
+import breaker
+import codec
+import failover
+import latency
+import localcache
+
+# Requests get a deadline adapted to how long the upstream endpoint has been
+# taking to respond, between MIN_DEADLINE and DEADLINE seconds.
 DEADLINE = 7
+MIN_DEADLINE = 1
+# Serve the failover copy immediately when the request cache has expired and
+# refresh it in the background instead of blocking the caller.
+STALE_WHILE_REVALIDATE = False
+# How long a scheduled background refresh keeps others for the same url from
+# being scheduled.
+REFRESH_LEASE = 60
+# How long a fetch lease is held, and how long callers that didn't get it will
+# wait for the holder's result before using the failover copy.
+FETCH_LEASE = 10
+FETCH_WAIT = 2
+FETCH_POLL_INTERVAL = 0.1
+# How long a failover copy read back from the datastore is kept in memcache.
+DURABLE_REFILL_TTL = 36000
+
+# Counters for fetches saved by coalescing. 'waited' counts threads that got
+# the result of another thread in this process, 'leased' counts callers that
+# got it from another caller through memcache.
+STATS = {'fetches': 0, 'waited': 0, 'leased': 0}
+_stats_lock = threading.Lock()
+
+
+class DeferredRefresher(object):
+    """ Runs background refreshes on the task queue """
+    def schedule(self, url, cache_ttl):
+        # Importing deferred is slow, and most requests never need it.
+        from google.appengine.ext import deferred
+        deferred.defer(_refresh, url, cache_ttl)
+
+
+class LocalRefresher(object):
+    """ Stand-in for DeferredRefresher for tests and local scripts. Refreshes
+    are queued in process and only run when run_pending() is called. """
+    def __init__(self):
+        self.pending = []
+
+    def schedule(self, url, cache_ttl):
+        self.pending.append((url, cache_ttl))
+
+    def run_pending(self):
+        pending, self.pending = self.pending, []
+        for url, cache_ttl in pending:
+            _refresh(url, cache_ttl)
+        return len(pending)
+
+
+REFRESHER = DeferredRefresher()
+
+
+class _LeaseTimeout(Exception):
+    """ Another caller holds the fetch lease and didn't finish in time """
+
+
+class _Flight(object):
+    """ A fetch in progress in this process """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _count(stat):
+    with _stats_lock:
+        STATS[stat] += 1
+    if stat != 'fetches':
+        memcache.incr('fetches_saved', initial_value=0)
+
+
+def fetches_saved():
+    """ Returns the number of fetches saved by coalescing across all
+    instances """
+    return memcache.get('fetches_saved') or 0
+
+
+def _deadline(url):
+    """ Returns the deadline to use for a request to url """
+    return latency.deadline(latency.endpoint(url), min(MIN_DEADLINE, DEADLINE),
+                            DEADLINE)
+
+
+class _Entry(object):
+    """ What we have cached for a url: its failover copy, whether that is
+    still fresh and the validators to revalidate it with """
+    def __init__(self, copy, fresh, validators):
+        self.copy = copy
+        self.fresh = fresh
+        self.validators = validators
+
+    def conditional_headers(self):
+        """ Returns the headers that make a refresh conditional """
+        headers = {}
+        if self.validators:
+            if 'ETag' in self.validators:
+                headers['If-None-Match'] = self.validators['ETag']
+            if 'Last-Modified' in self.validators:
+                headers['If-Modified-Since'] = self.validators['Last-Modified']
+        return headers
+
+
+def _lookup(urls):
+    """ Looks up what we have cached for urls with one memcache call. The
+    content itself is only stored once, as the failover copy, and the request
+    cache just marks it as fresh. Returns a dict mapping the urls that have a
+    failover copy to their _Entry. """
+    keys = []
+    for url in urls:
+        keys.extend(['request:%s' % url, 'failure:%s' % url,
+                     'validators:%s' % url])
+    cached = codec.get_multi(keys)
+
+    entries = {}
+    for url in urls:
+        if 'failure:%s' % url in cached:
+            entries[url] = _Entry(cached['failure:%s' % url],
+                                  'request:%s' % url in cached,
+                                  cached.get('validators:%s' % url))
+
+    # Memcache might have lost copies that the datastore still has.
+    durable = failover.load(url for url in urls if url not in entries)
+    if durable:
+        codec.set_multi(durable, DURABLE_REFILL_TTL, key_prefix='failure:')
+        for url, copy in durable.iteritems():
+            entries[url] = _Entry(copy, False, None)
+    return entries
+
+
+def _read_response(response, entry=None):
+    """ Returns the parsed content of a response, its validators and whether
+    it was modified. A 304 for a conditional request just gives back the cached
+    copy unparsed. """
+    if entry and entry.validators and response.status_code == 304:
+        return entry.copy, entry.validators, False
+    validators = {}
+    for header in ('ETag', 'Last-Modified'):
+        value = response.headers.get(header)
+        if value:
+            validators[header] = value
+    return simplejson.loads(response.content), validators, True
+
+
+def _mark_fresh(copies, cache_ttl):
+    """ Marks the cached copies of urls as fresh for cache_ttl, given a dict
+    mapping the urls to their content. This is all a 304 needs, since the copy
+    it confirms is already stored. """
+    memcache.set_multi(dict((url, 1) for url in copies), cache_ttl,
+                       key_prefix='request:')
+    for url, resp in copies.iteritems():
+        localcache.set('api', url, resp)
+
 
-def _request(url, cache_ttl=3600, force=False):
-    request_cache_key = 'request:%s' % url
-    failure_cache_key = 'failure:%s' % url
-    resp = memcache.get(request_cache_key)
-    if force or not resp:
+def _store(fresh, cache_ttl):
+    """ Stores fresh responses, a dict mapping urls to their content and
+    validators. The content goes in the failover copy, and the request cache
+    entry marks it as fresh. Its expiry is the soft expiry of the entry, the
+    failover copy's is the hard one. """
+    # The durable copies are written behind, without waiting for them.
+    copies = dict((url, resp) for url, (resp, _) in fresh.iteritems())
+    failover.save(copies)
+    long_lived = {}
+    for url, (resp, validators) in fresh.iteritems():
+        long_lived['failure:%s' % url] = resp
+        if validators:
+            long_lived['validators:%s' % url] = validators
+    codec.set_multi(long_lived, cache_ttl*10)
+    # Only marked fresh once the new copy is there, so that nobody reads the
+    # old one as fresh in between.
+    _mark_fresh(copies, cache_ttl)
+
+
+def _fetch(url, cache_ttl, entry=None):
+    """ Fetches url, revalidating the cached entry if it can, and stores it """
+    circuit = breaker.for_host(urlparse.urlparse(url).netloc)
+    if not circuit.allow():
+        raise breaker.CircuitOpenError(url)
+    if entry is None:
+        entry = _lookup([url]).get(url)
+    headers = entry.conditional_headers() if entry else {}
+    _count('fetches')
+    start = time.time()
+    try:
+        resp, validators, modified = _read_response(urlfetch.fetch(url,
+            headers=headers, deadline=_deadline(url), follow_redirects=False),
+            entry)
+    except (ValueError, urlfetch.DownloadError):
+        circuit.record_failure()
+        raise
+    finally:
+        latency.record(latency.endpoint(url), time.time() - start)
+    circuit.record_success()
+    if modified:
+        _store({url: (resp, validators)}, cache_ttl)
+    else:
+        _mark_fresh({url: resp}, cache_ttl)
+    return resp
+
+
+def _await_leases(urls):
+    """ Waits for the callers holding the fetch leases of urls to fill the
+    request cache. Only memcache is polled while waiting; the datastore copies
+    of the urls that don't show up are looked at once, when the wait gives up.
+    Returns a dict mapping the urls that were found to their copies. """
+    urls = list(urls)
+    found = {}
+    waited = 0
+    while urls and waited < FETCH_WAIT:
+        time.sleep(FETCH_POLL_INTERVAL)
+        waited += FETCH_POLL_INTERVAL
+        keys = []
+        for url in urls:
+            keys.extend(['request:%s' % url, 'failure:%s' % url])
+        cached = codec.get_multi(keys)
+        for url in urls:
+            if 'request:%s' % url in cached and 'failure:%s' % url in cached:
+                _count('leased')
+                found[url] = cached['failure:%s' % url]
+                localcache.set('api', url, found[url])
+        urls = [url for url in urls if url not in found]
+
+    # The other callers might have stored copies that memcache has lost since.
+    found.update(failover.load(urls))
+    return found
+
+
+def _leased_fetch(url, cache_ttl, entry=None):
+    """ Fetches url if no other caller holds its fetch lease, otherwise waits
+    for that caller to fill the request cache. """
+    lease_key = 'lease:%s' % url
+    if memcache.add(lease_key, 1, FETCH_LEASE):
+        try:
+            return _fetch(url, cache_ttl, entry)
+        finally:
+            memcache.delete(lease_key)
+
+    copies = _await_leases([url])
+    if url in copies:
+        return copies[url]
+    raise _LeaseTimeout(url)
+
+
+def _coalesced_fetch(url, cache_ttl, entry=None):
+    """ Single-flight fetch of url: one thread per process and one caller
+    across instances actually hits the upstream app. """
+    with _flights_lock:
+        flight = _flights.get(url)
+        leader = flight is None
+        if leader:
+            flight = _flights[url] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(FETCH_WAIT):
+            raise _LeaseTimeout(url)
+        if flight.error:
+            raise flight.error
+        _count('waited')
+        return flight.result
+
+    try:
+        flight.result = _leased_fetch(url, cache_ttl, entry)
+        return flight.result
+    except Exception, e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[url]
+        flight.done.set()
+
+
+def _fetch_many(urls, cache_ttl, entries):
+    """ Fetches urls in parallel, revalidating the cached entries in entries
+    where it can, and stores them. Between them they take no longer than
+    DEADLINE. Returns a dict mapping the urls that were fetched to their
+    responses, and a dict mapping the ones that failed to the error. """
+    start = time.time()
+    rpcs = {}
+    errors = {}
+    for url in urls:
+        circuit = breaker.for_host(urlparse.urlparse(url).netloc)
+        if not circuit.allow():
+            errors[url] = breaker.CircuitOpenError(url)
+            continue
+        entry = entries.get(url)
+        headers = entry.conditional_headers() if entry else {}
+        rpc = urlfetch.create_rpc(deadline=_deadline(url))
+        urlfetch.make_fetch_call(rpc, url, headers=headers,
+                                 follow_redirects=False)
+        rpcs[rpc] = (url, circuit)
+        _count('fetches')
+
+    # Handle them in the order they finish, so the latencies we record are
+    # accurate.
+    fresh = {}
+    unmodified = {}
+    while rpcs:
+        rpc = apiproxy_stub_map.UserRPC.wait_any(rpcs.keys())
+        url, circuit = rpcs.pop(rpc)
+        latency.record(latency.endpoint(url), time.time() - start)
         try:
-            resp = simplejson.loads(urlfetch.fetch(url, deadline=DEADLINE,
-                                    follow_redirects=False).content)
-            memcache.set(request_cache_key, resp, cache_ttl)
-            memcache.set(failure_cache_key, resp, cache_ttl*10)
+            resp, validators, modified = _read_response(rpc.get_result(),
+                                                        entries.get(url))
         except (ValueError, urlfetch.DownloadError), e:
             # Not valid JSON or request timeout
-            resp = memcache.get(failure_cache_key)
-            if not resp:
-                resp = []
+            circuit.record_failure()
+            errors[url] = e
+        else:
+            circuit.record_success()
+            if modified:
+                fresh[url] = (resp, validators)
+            else:
+                unmodified[url] = resp
+
+    results = {}
+    if fresh:
+        _store(fresh, cache_ttl)
+        for url, (resp, _) in fresh.iteritems():
+            results[url] = resp
+    if unmodified:
+        _mark_fresh(unmodified, cache_ttl)
+        results.update(unmodified)
+    return results, errors
+
+
+def _coalesced_fetch_many(urls, cache_ttl, entries):
+    """ Like _coalesced_fetch for several urls at once. The urls that no other
+    thread or caller is fetching are fetched in parallel, and then the others
+    are waited for. Returns a dict mapping the urls that were fetched to their
+    responses, and a dict mapping the ones that failed to the error. """
+    leading = {}
+    following = {}
+    with _flights_lock:
+        for url in urls:
+            if url in _flights:
+                following[url] = _flights[url]
+            else:
+                leading[url] = _flights[url] = _Flight()
+
+    results = {}
+    errors = {}
+    try:
+        taken = memcache.add_multi(dict((url, 1) for url in leading),
+                                   FETCH_LEASE, key_prefix='lease:')
+        leased = [url for url in leading if url not in taken]
+        try:
+            fetched, failed = _fetch_many(leased, cache_ttl, entries)
+        finally:
+            if leased:
+                memcache.delete_multi(leased, key_prefix='lease:')
+        results.update(fetched)
+        errors.update(failed)
+
+        results.update(_await_leases(taken))
+        for url in taken:
+            if url not in results:
+                errors[url] = _LeaseTimeout(url)
+    except Exception, e:
+        for url in leading:
+            if url not in results:
+                errors.setdefault(url, e)
+        raise
+    finally:
+        for url, flight in leading.iteritems():
+            flight.result = results.get(url)
+            flight.error = errors.get(url)
+        with _flights_lock:
+            for url in leading:
+                del _flights[url]
+        for flight in leading.itervalues():
+            flight.done.set()
+
+    give_up = time.time() + FETCH_WAIT
+    for url, flight in following.iteritems():
+        if not flight.done.wait(max(0, give_up - time.time())):
+            errors[url] = _LeaseTimeout(url)
+        elif flight.error:
+            errors[url] = flight.error
+        else:
+            _count('waited')
+            results[url] = flight.result
+    return results, errors
+
+
+def _refresh(url, cache_ttl):
+    """ Background refresh of url, as run by a refresher """
+    try:
+        _fetch(url, cache_ttl)
+    except (ValueError, urlfetch.DownloadError,
+            breaker.CircuitOpenError), e:
+        logging.warning("Background refresh of %s failed: %s" % (url, e))
+    finally:
+        memcache.delete('refresh:%s' % url)
+
+
+def _schedule_refresh(url, cache_ttl):
+    """ Schedules a background refresh of url unless one is already pending """
+    if memcache.add('refresh:%s' % url, 1, REFRESH_LEASE):
+        REFRESHER.schedule(url, cache_ttl)
+
+
+def _request(url, cache_ttl=3600, force=False, stale_ok=None):
+    if stale_ok is None:
+        stale_ok = STALE_WHILE_REVALIDATE
+    if force:
+        localcache.invalidate('api', url)
+        entry = None
+    else:
+        resp = localcache.get('api', url)
+        if resp is not None:
+            return resp
+        entry = _lookup([url]).get(url)
+        if entry and entry.fresh:
+            localcache.set('api', url, entry.copy)
+            return entry.copy
+        if stale_ok and entry:
+            _schedule_refresh(url, cache_ttl)
+            return entry.copy
+    try:
+        if force:
+            resp = _fetch(url, cache_ttl)
+        else:
+            resp = _coalesced_fetch(url, cache_ttl, entry)
+    except (ValueError, urlfetch.DownloadError, _LeaseTimeout,
+            breaker.CircuitOpenError):
+        # Not valid JSON, request timeout, gave up waiting on another
+        # caller's fetch or the upstream app is known to be down
+        if force:
+            entry = _lookup([url]).get(url)
+        resp = entry.copy if entry else None
+        if not resp:
+            resp = []
     return resp
 
 
+def _request_many(urls, cache_ttl=3600, force=False, stale_ok=None):
+    """ Like _request for several urls at once. Cached responses are read with
+    a single get_multi and all the misses are fetched in parallel, so between
+    them they take no longer than DEADLINE. Returns a dict mapping each url to
+    its response. """
+    if stale_ok is None:
+        stale_ok = STALE_WHILE_REVALIDATE
+    results = {}
+    missing = []
+    for url in urls:
+        if force:
+            localcache.invalidate('api', url)
+            missing.append(url)
+            continue
+        resp = localcache.get('api', url)
+        if resp is not None:
+            results[url] = resp
+        else:
+            missing.append(url)
+    if not missing:
+        return results
+
+    entries = _lookup(missing)
+    if force:
+        fetched, failed = _fetch_many(missing, cache_ttl, entries)
+    else:
+        for url, entry in entries.iteritems():
+            if entry.fresh:
+                results[url] = entry.copy
+                localcache.set('api', url, entry.copy)
+            elif stale_ok:
+                _schedule_refresh(url, cache_ttl)
+                results[url] = entry.copy
+        missing = [url for url in missing if url not in results]
+        if not missing:
+            return results
+        fetched, failed = _coalesced_fetch_many(missing, cache_ttl, entries)
+
+    results.update(fetched)
+    for url in failed:
+        # Not valid JSON, request timeout, gave up waiting on another
+        # caller's fetch or the upstream app is known to be down
+        entry = entries.get(url)
+        results[url] = (entry.copy if entry else None) or []
+    return results
+
+
+DOMAIN_URL = 'http://hd-domain-hrd.appspot.com'
+
+
 def domain(path, force=False):
-    base_url = 'http://hd-domain-hrd.appspot.com'
-    return _request(base_url + path, force=force)
+    return _request(DOMAIN_URL + path, force=force)
+
+
+def fetch_many(paths, force=False):
+    """ Fetches several hd-domain paths at once. Returns a dict mapping each
+    path to its response. """
+    results = _request_many([DOMAIN_URL + path for path in paths], force=force)
+    return dict((path, results[DOMAIN_URL + path]) for path in paths)
+
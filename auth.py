@@ -1,17 +1,26 @@
 """ Manages the signup app user authentication system. """
 
 
+import binascii
 import datetime
+import hashlib
 import json
 import logging
+import os
+import time
 import urllib
 import urlparse
 
-from google.appengine.api import app_identity, memcache, urlfetch
+from google.appengine.api import memcache, urlfetch
 
 import webapp2
 
-from config import Config
+import codec
+import config
+import latency
+from lib import keymaster
+import localcache
+import session
 
 
 """ A class that on the production app, basically wraps urlfetch.fetch()
@@ -24,15 +33,104 @@ class ResponseFactory:
   def get_response(self, url, *args, **kwargs):
     raise NotImplementedError("Must be overriden in subclass.")
 
-
-""" Wraps urlfetch.fetch(). """
+  """ Starts getting the response for a particular query. By default, this just
+  calls get_response() right away.
+  url: The URL to fetch.
+  Returns: An RPC-like object. Its get_result() method returns the response. """
+  def get_response_async(self, url, *args, **kwargs):
+    try:
+      return FinishedRpc(self.get_response(url, *args, **kwargs))
+    except urlfetch.Error as e:
+      return FinishedRpc(error=e)
+
+  """ Gets the responses for several queries, which are all started before
+  waiting for any of them.
+  urls: The URLs to fetch.
+  Returns: A list of responses, in the same order as the URLs. A response is
+  None if fetching that URL failed. """
+  def get_responses(self, urls, *args, **kwargs):
+    rpcs = [self.get_response_async(url, *args, **kwargs) for url in urls]
+
+    responses = []
+    for url, rpc in zip(urls, rpcs):
+      try:
+        responses.append(rpc.get_result())
+      except urlfetch.Error as e:
+        logging.error("Fetching %s failed: %s" % (url, e))
+        responses.append(None)
+    return responses
+
+
+""" Stands in for a urlfetch RPC when we already have the response, or the error
+that fetching it raised. """
+class FinishedRpc:
+  def __init__(self, response=None, error=None):
+    self.response = response
+    self.error = error
+
+  def wait(self):
+    pass
+
+  """ Returns: The response, or raises the error. """
+  def get_result(self):
+    if self.error:
+      raise self.error
+    return self.response
+
+
+""" Wraps urlfetch.fetch(). Unless a deadline is given, requests get one based
+on how long the endpoint has been taking to respond. """
 class UrlFetch(ResponseFactory):
   """ A transparent wrapper around urlfetch.fetch(). Extra arguments are all
   forwarded to the undelying fetch function.
   url: The URL to fetch.
   Returns: The response from fetch(). """
   def get_response(self, url, *args, **kwargs):
-    return urlfetch.fetch(url, *args, **kwargs)
+    endpoint = latency.endpoint(url)
+    kwargs.setdefault("deadline", latency.deadline(endpoint))
+    start = time.time()
+    try:
+      return urlfetch.fetch(url, *args, **kwargs)
+    finally:
+      latency.record(endpoint, time.time() - start)
+
+  """ Starts an asynchronous fetch. Extra arguments are forwarded to
+  urlfetch.make_fetch_call(), except for deadline, which goes to
+  urlfetch.create_rpc().
+  url: The URL to fetch.
+  Returns: The urlfetch RPC, wrapped so that its latency is recorded. """
+  def get_response_async(self, url, *args, **kwargs):
+    endpoint = latency.endpoint(url)
+    deadline = kwargs.pop("deadline", None) or latency.deadline(endpoint)
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url, *args, **kwargs)
+    return TimedRpc(rpc, endpoint)
+
+
+""" Wraps a urlfetch RPC to record its latency once the result is collected.
+Since that happens when the result is asked for, it can overestimate how long
+the request actually took. """
+class TimedRpc:
+  def __init__(self, rpc, endpoint):
+    self.rpc = rpc
+    self.endpoint = endpoint
+    self.start = time.time()
+    self.recorded = False
+
+  def wait(self):
+    self.rpc.wait()
+    self.__record()
+
+  def get_result(self):
+    try:
+      return self.rpc.get_result()
+    finally:
+      self.__record()
+
+  def __record(self):
+    if not self.recorded:
+      latency.record(self.endpoint, time.time() - self.start)
+      self.recorded = True
 
 
 """ A RequestHandler subclass for handling requests that require authentication.
@@ -47,6 +145,26 @@ class AuthHandler(webapp2.RequestHandler):
   SIMULATED_USER_ = None
   # How many days our sessions last for by default.
   SESSION_LENGTH = 30
+  # How many seconds to trust a validated token for before asking the signup
+  # app again, and how long to remember that a token is invalid.
+  TOKEN_CACHE_TTL = 300
+  INVALID_TOKEN_CACHE_TTL = 60
+  # Parameter added to the return URL of logouts, so we know to forget the
+  # token when the user comes back.
+  LOGGED_OUT_PARAM_ = "logged_out"
+  # Whether to issue signed session cookies, which let us validate the user and
+  # answer current_user() locally until they expire.
+  SIGNED_SESSIONS = False
+  # How many seconds a signed session cookie is good for.
+  SIGNED_SESSION_LIFETIME = 3600
+  # The subset of USER_PROPERTIES_ that we store in the session cookie.
+  SESSION_PROPERTIES_ = ["first_name", "last_name", "email", "groups"]
+  # Name of the session cookie, and of the keymaster key it is signed with.
+  SESSION_COOKIE_ = "auth_session"
+  SESSION_KEY_NAME_ = "shared:session_key"
+  # How many recently active users to remember, so their data can be loaded
+  # ahead of time when caches are warmed.
+  MAX_ACTIVE_USERS = 500
 
   """ Function meant to be used as a decorator. It's purpose is to ensure that a
   valid user is logged in before running whatever it is decorating.
@@ -76,7 +194,15 @@ class AuthHandler(webapp2.RequestHandler):
   def __init__(self, *args, **kwargs):
     super(AuthHandler, self).__init__(*args, **kwargs)
 
+    # The configuration, which is the same for the whole request.
+    self.config = config.get()
     self.user_valid = None
+    self.session_data = None
+    # Requests to the signup app started by prefetch_user().
+    self._validation_rpc = None
+    self._user_data_rpc = None
+    # What prefetch_user() found in memcache, including the keys it missed.
+    self._prefetched = {}
 
   """ Converts relative URLs relative to this app into absolute URLs. This is
   important when we send these URLs to the signup app.
@@ -97,7 +223,7 @@ class AuthHandler(webapp2.RequestHandler):
   def create_login_url(self, return_url):
     return_url = self.__absolute_url(return_url)
 
-    app_id = app_identity.get_application_id()
+    app_id = self.config.app_name
     query_str = urllib.urlencode({"url": return_url, "app_id": app_id})
     url = "%s/login?%s" % (self.SIGNUP_URL_, query_str)
 
@@ -110,13 +236,20 @@ class AuthHandler(webapp2.RequestHandler):
   Returns: The logout URL, or None, if no user is logged in. """
   def create_logout_url(self, return_url):
     return_url = self.__absolute_url(return_url)
+    # Mark the return URL so that dispatch() can revoke the token once the user
+    # is back from logging out.
+    url_parts = list(urlparse.urlparse(return_url))
+    query = urlparse.parse_qsl(url_parts[4])
+    query.append((self.LOGGED_OUT_PARAM_, "1"))
+    url_parts[4] = urllib.urlencode(query)
+    return_url = urlparse.urlunparse(url_parts)
 
     cookie_values = self.request.cookies.get("auth")
     if not cookie_values:
       return None
     cookie_values = json.loads(cookie_values)
 
-    app_id = app_identity.get_application_id()
+    app_id = self.config.app_name
     query_str = urllib.urlencode({"url": return_url, "app_id": app_id,
                                   "user": cookie_values["user"],
                                   "token": cookie_values["token"]})
@@ -132,7 +265,7 @@ class AuthHandler(webapp2.RequestHandler):
   def current_user(self):
     # Use simulated user for testing.
     if self.SIMULATED_USER_ != None:
-      if not Config().is_testing:
+      if not self.config.is_testing:
         error = "Cannot simulate user on non-unittest."
         logging.critical(error)
         raise RuntimeError(error)
@@ -148,35 +281,164 @@ class AuthHandler(webapp2.RequestHandler):
       return None
     cookie_values = json.loads(cookie_values)
 
+    # On a cold cache, validating the user and getting their data can happen at
+    # the same time.
+    self.prefetch_user()
+
     # First, check that the user is valid to begin with.
     if not self.validate_user():
       logging.debug("User is not valid.")
       return None
 
-    # Check if we have any cached data for this.
-    key = "user_data.%s" % cookie_values["user"]
-    user_data = memcache.get(key)
+    # The session cookie might already have everything we need.
+    if self.session_data and self.session_data.get("data"):
+      return self.session_data["data"]
+
+    user = cookie_values["user"]
+    key = self._user_data_key(user, self.USER_PROPERTIES_)
+    user_data = self._prefetched.pop(key, None)
+    if user_data:
+      localcache.set("user_data", key, user_data)
+    elif self._user_data_rpc:
+      rpc, self._user_data_rpc = self._user_data_rpc, None
+      try:
+        response = rpc.get_result()
+      except urlfetch.Error as e:
+        logging.error("Fetching data for user %s failed: %s" % (user, e))
+        response = None
+      user_data = self._parse_user_data(user, response)
+      if user_data:
+        codec.set(key, user_data)
+        localcache.set("user_data", key, user_data)
+    else:
+      user_data = self.get_users([user])[user]
     if user_data:
-      return user_data
+      self._write_session(cookie_values["user"], user_data)
+    return user_data
 
-    logging.debug("Cache miss on data for user %s." % (cookie_values["user"]))
+  """ Starts validating the current user and fetching their data from the signup
+  app, both at once, so that they overlap with each other and with whatever the
+  handler does before it calls validate_user() or current_user(), which will
+  pick up the results. Anything we have cached isn't fetched. """
+  def prefetch_user(self):
+    if self.SIMULATED_USER_ != None or self.user_valid != None or \
+        self._validation_rpc or self._user_data_rpc:
+      return
 
-    # Fetch the URL.
-    query_str = urllib.urlencode({"id": cookie_values["user"],
-                                  "properties[]": self.USER_PROPERTIES_}, True)
-    url = "%s/api/v1/user?%s" % (self.SIGNUP_URL_, query_str)
-    logging.debug("Fetching URL: %s" % (url))
-    response = self.URL_FETCHER.get_response(url, follow_redirects=False)
-    if response.status_code != 200:
-      logging.error("API call failed with status %d." % (response.status_code))
+    cookie_values = self.request.cookies.get("auth")
+    if not cookie_values:
+      return
+    cookie_values = json.loads(cookie_values)
+    user = cookie_values["user"]
+
+    need_validation = not self._read_session(user)
+    data_key = self._user_data_key(user, self.USER_PROPERTIES_)
+    need_data = not (self.session_data and self.session_data.get("data")) and \
+                not localcache.get("user_data", data_key)
+
+    token_key = self._token_cache_key(user, cookie_values["token"])
+    keys = []
+    if need_validation:
+      keys.append(token_key)
+    if need_data:
+      keys.append(data_key)
+    cached = codec.get_multi(keys) if keys else {}
+    self._prefetched = dict((key, cached.get(key)) for key in keys)
+
+    if need_validation and token_key not in cached:
+      self._validation_rpc = self.URL_FETCHER.get_response_async(
+          self._validation_url(cookie_values), method="POST",
+          follow_redirects=False)
+    # A token cached as invalid means there is no user to get data for.
+    if need_data and data_key not in cached and \
+        cached.get(token_key) is not False:
+      self._user_data_rpc = self.URL_FETCHER.get_response_async(
+          self._user_data_url(user, self.USER_PROPERTIES_),
+          follow_redirects=False)
+
+  """ Generates the memcache key under which we cache data for a user.
+  user: The user id.
+  properties: The list of user properties the data contains.
+  Returns: The memcache key. """
+  @classmethod
+  def _user_data_key(cls, user, properties):
+    if properties == cls.USER_PROPERTIES_:
+      return "user_data.%s" % (user)
+    digest = hashlib.md5(",".join(sorted(properties))).hexdigest()
+    return "user_data.%s.%s" % (user, digest[:8])
+
+  """ Gets information about a number of users from the signup app at once.
+  Cached users cost a single memcache call between them, and the rest are
+  fetched from the signup app in parallel.
+  ids: The ids of the users to get information about.
+  properties: The user properties to fetch. Defaults to USER_PROPERTIES_.
+  Returns: A dict mapping each id to a dict of information about the user, or to
+  None if it could not obtain information about that user. """
+  @classmethod
+  def get_users(cls, ids, properties=None):
+    if properties is None:
+      properties = cls.USER_PROPERTIES_
+
+    users = {}
+    keys = {}
+    for user in ids:
+      key = cls._user_data_key(user, properties)
+      user_data = localcache.get("user_data", key)
+      if user_data:
+        users[user] = user_data
+      else:
+        keys[key] = user
+
+    # Check if we have any cached data for the rest.
+    cached = codec.get_multi(keys.keys())
+    for key, user_data in cached.iteritems():
+      users[keys.pop(key)] = user_data
+      localcache.set("user_data", key, user_data)
+    if not keys:
+      return users
+
+    logging.debug("Cache miss on data for users %s." % (keys.values()))
+
+    # Fetch the URLs.
+    urls = [cls._user_data_url(user, properties) for user in keys.values()]
+    responses = cls.URL_FETCHER.get_responses(urls, follow_redirects=False)
+
+    to_cache = {}
+    for (key, user), response in zip(keys.items(), responses):
+      user_data = cls._parse_user_data(user, response)
+      users[user] = user_data
+      if user_data:
+        to_cache[key] = user_data
+        localcache.set("user_data", key, user_data)
+
+    # Cache it.
+    codec.set_multi(to_cache)
+
+    return users
+
+  """ Generates the signup app URL for getting data about a user.
+  user: The user id.
+  properties: The list of user properties to get.
+  Returns: The URL. """
+  @classmethod
+  def _user_data_url(cls, user, properties):
+    query_str = urllib.urlencode({"id": user, "properties[]": properties}, True)
+    url = "%s/api/v1/user?%s" % (cls.SIGNUP_URL_, query_str)
+    logging.debug("User data URL: %s" % (url))
+    return url
+
+  """ Reads user data out of a response from the signup app.
+  user: The user id the data is for.
+  response: The response, or None if fetching it failed.
+  Returns: The user data, or None if the request failed. """
+  @classmethod
+  def _parse_user_data(cls, user, response):
+    if not response or response.status_code != 200:
+      logging.error("API call for user %s failed." % (user))
       return None
 
     user_data = json.loads(response.content)
     logging.debug("Got user data: %s" % (user_data))
-
-    # Cache it.
-    memcache.set(key, user_data)
-
     return user_data
 
   """ Checks if the current user is valid.
@@ -184,7 +446,7 @@ class AuthHandler(webapp2.RequestHandler):
   def validate_user(self):
     # Check if we should use the simulated user.
     if self.SIMULATED_USER_ != None:
-      if not Config().is_testing:
+      if not self.config.is_testing:
         error = "Cannot simulate user on non-unittest."
         logging.critical(error)
         raise RuntimeError(error)
@@ -206,26 +468,147 @@ class AuthHandler(webapp2.RequestHandler):
 
     cookie_values = json.loads(cookie_values)
 
-    # Try validating the login.
-    query_str = urllib.urlencode({"user": cookie_values["user"],
-                                  "token": cookie_values["token"]})
-    response = self.URL_FETCHER.get_response("%s/validate_token?%s" % \
-                                              (self.SIGNUP_URL_, query_str),
-                                              method="POST",
-                                              follow_redirects=False)
+    # A valid session cookie means we checked recently.
+    if self._read_session(cookie_values["user"]):
+      self.user_valid = True
+      return True
+
+    # Check if we've validated this token recently.
+    key = self._token_cache_key(cookie_values["user"], cookie_values["token"])
+    if key in self._prefetched:
+      valid = self._prefetched.pop(key)
+    else:
+      valid = memcache.get(key)
+    if valid is not None:
+      self.user_valid = valid
+      if valid:
+        self._write_session(cookie_values["user"])
+      return valid
+
+    # Try validating the login, unless prefetch_user() already started to.
+    if self._validation_rpc:
+      rpc, self._validation_rpc = self._validation_rpc, None
+      response = rpc.get_result()
+    else:
+      response = self.URL_FETCHER.get_response( \
+          self._validation_url(cookie_values), method="POST",
+          follow_redirects=False)
     if response.status_code != 200:
+      # Don't cache this, since the signup app might just be having trouble.
       logging.error("Got bad response (%d), forcing login." % \
                     (response.status_code))
       self.user_valid = False
       return False
+
+    # Check to see what it said, and remember it.
+    valid = bool(json.loads(str(response.content))["valid"])
+    if valid:
+      memcache.set(key, True, self.TOKEN_CACHE_TTL)
+      self._write_session(cookie_values["user"])
+      self._note_active_user(cookie_values["user"])
     else:
-      # Check to see what it said.
-      if not json.loads(str(response.content))["valid"]:
-        self.user_valid = False
-        return False
+      memcache.set(key, False, self.INVALID_TOKEN_CACHE_TTL)
+
+    self.user_valid = valid
+    return valid
 
-    self.user_valid = True
-    return True
+  """ Remembers that a user was active recently. This only happens when we
+  validate their token with the signup app, so it stays off the hot path.
+  user: The user id. """
+  @classmethod
+  def _note_active_user(cls, user):
+    active = memcache.get("active_users") or {}
+    active[user] = time.time()
+    if len(active) > cls.MAX_ACTIVE_USERS:
+      newest = sorted(active, key=active.get)[-cls.MAX_ACTIVE_USERS:]
+      active = dict((user, active[user]) for user in newest)
+    memcache.set("active_users", active)
+
+  """ Gets the users that have been active recently.
+  Returns: A list of user ids, most recently active first. """
+  @classmethod
+  def active_users(cls):
+    active = memcache.get("active_users") or {}
+    return sorted(active, key=active.get, reverse=True)
+
+  """ Generates the signup app URL for validating a user's token.
+  cookie_values: The values from the auth cookie.
+  Returns: The URL. """
+  @classmethod
+  def _validation_url(cls, cookie_values):
+    query_str = urllib.urlencode({"user": cookie_values["user"],
+                                  "token": cookie_values["token"]})
+    return "%s/validate_token?%s" % (cls.SIGNUP_URL_, query_str)
+
+  """ Generates the memcache key under which we cache the result of validating
+  a particular token. The token itself is hashed so it never ends up in
+  memcache.
+  user: The user id.
+  token: The user's token.
+  Returns: The memcache key. """
+  @classmethod
+  def _token_cache_key(cls, user, token):
+    digest = hashlib.sha256("%s:%s" % (user, token)).hexdigest()
+    return "auth_token.%s" % (digest)
+
+  """ Forgets any cached validation of a token, so that the next request with it
+  has to check with the signup app again. Should be called whenever a user logs
+  out.
+  user: The user id.
+  token: The user's token. """
+  @classmethod
+  def revoke_token(cls, user, token):
+    memcache.delete(cls._token_cache_key(user, token))
+
+  """ Gets the key that we sign session cookies with, creating one if we don't
+  have one yet. If several instances create one at once, they all end up with
+  the same one.
+  Returns: The key. """
+  @classmethod
+  def _session_key(cls):
+    try:
+      return keymaster.get(cls.SESSION_KEY_NAME_)
+    except keymaster.RedirectException:
+      logging.info("Creating new session signing key.")
+      return keymaster.get_or_set(cls.SESSION_KEY_NAME_,
+                                  binascii.hexlify(os.urandom(32)))
+
+  """ Reads and verifies the signed session cookie, if we are using them.
+  user: The user id from the auth cookie, which the session must match.
+  Returns: The session contents, or None if there is no valid session. """
+  def _read_session(self, user):
+    if not self.SIGNED_SESSIONS:
+      return None
+
+    value = self.request.cookies.get(self.SESSION_COOKIE_)
+    if not value:
+      return None
+    contents = session.decode(value, self._session_key())
+    if not contents or contents["user"] != user:
+      return None
+
+    self.session_data = contents
+    return contents
+
+  """ Issues a new signed session cookie, if we are using them.
+  user: The id of the user it is for.
+  user_data: User data to store in the session, or None to keep whatever the
+  current session has. """
+  def _write_session(self, user, user_data=None):
+    if not self.SIGNED_SESSIONS:
+      return
+
+    if user_data:
+      user_data = dict((name, value) for name, value in user_data.iteritems() \
+                       if name in self.SESSION_PROPERTIES_)
+    elif self.session_data:
+      user_data = self.session_data.get("data")
+    self.session_data = {"user": user, "data": user_data}
+
+    value = session.encode(self.session_data, self._session_key(),
+                           self.SIGNED_SESSION_LIFETIME)
+    self.response.set_cookie(self.SESSION_COOKIE_, value, httponly=True,
+                             max_age=self.SIGNED_SESSION_LIFETIME)
 
   """ Overriden dispatch method to deal with intercepting requests with user and
   token parameters and saving them in a cookie. """
@@ -249,6 +632,20 @@ class AuthHandler(webapp2.RequestHandler):
       self.redirect(redirect_url)
       return
 
+    # If we're coming back from logging out, the token is no longer valid.
+    if self.request.get(self.LOGGED_OUT_PARAM_):
+      cookie_values = self.request.cookies.get("auth")
+      if cookie_values:
+        cookie_values = json.loads(cookie_values)
+        logging.debug("Revoking token for user %s." % (cookie_values["user"]))
+        self.revoke_token(cookie_values["user"], cookie_values["token"])
+        self.response.delete_cookie("auth")
+      self.response.delete_cookie(self.SESSION_COOKIE_)
+
+      redirect_url = self._remove_params([self.LOGGED_OUT_PARAM_])
+      self.redirect(redirect_url)
+      return
+
     super(AuthHandler, self).dispatch(*args, **kwargs)
 
   """ Removes specified parameters from a GET request.
@@ -0,0 +1,113 @@
+""" Circuit breakers for upstream Dojo apps
+
+When an upstream app is down, every request to it would otherwise wait out the
+full fetch deadline before failing. A breaker counts consecutive failures per
+host and, after FAILURE_THRESHOLD of them, opens: calls are refused right away
+so the caller can go straight to its fallback. After RESET_TIMEOUT seconds a
+single caller across all instances is let through as a probe. If it succeeds
+the breaker closes again, otherwise it stays open for another RESET_TIMEOUT.
+
+The state is shared between instances through memcache, and each process keeps
+its own copy that it re-reads at most every SYNC_INTERVAL seconds.
+
+Usage:
+
+import breaker
+
+circuit = breaker.for_host('hd-domain-hrd.appspot.com')
+if not circuit.allow():
+    raise breaker.CircuitOpenError(circuit.host)
+try:
+    resp = urlfetch.fetch(...)
+except urlfetch.DownloadError:
+    circuit.record_failure()
+    raise
+circuit.record_success()
+
+"""
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+SYNC_INTERVAL = 1
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of making a call to a host whose breaker is open """
+
+
+class CircuitBreaker(object):
+    def __init__(self, host):
+        self.host = host
+        self._opened_at = None
+        self._synced_at = 0
+        self._lock = threading.Lock()
+
+    def _key(self, name):
+        return 'breaker_%s:%s' % (name, self.host)
+
+    def _sync(self):
+        """ Re-reads the shared state if our copy is out of date """
+        now = time.time()
+        if now - self._synced_at < SYNC_INTERVAL:
+            return
+        self._opened_at = memcache.get(self._key('opened'))
+        self._synced_at = now
+
+    def allow(self):
+        """ Returns whether a call to the host should be made """
+        with self._lock:
+            self._sync()
+            opened_at = self._opened_at
+        if opened_at is None:
+            return True
+        if time.time() - opened_at < RESET_TIMEOUT:
+            return False
+        # Half open: only one caller gets to probe.
+        return memcache.add(self._key('probe'), 1, RESET_TIMEOUT)
+
+    def record_success(self):
+        with self._lock:
+            was_open = self._opened_at is not None
+            self._opened_at = None
+            self._synced_at = time.time()
+        if was_open:
+            logging.info("Circuit for %s closed." % self.host)
+            memcache.delete_multi([self._key('opened'), self._key('probe')])
+        memcache.delete(self._key('failures'))
+
+    def record_failure(self):
+        failures = memcache.incr(self._key('failures'), initial_value=0)
+        with self._lock:
+            if self._opened_at is None and failures < FAILURE_THRESHOLD:
+                return
+            # Either we hit the threshold or a probe failed.
+            self._opened_at = time.time()
+            self._synced_at = self._opened_at
+        logging.warning("Circuit for %s opened after %s failures." %
+                        (self.host, failures))
+        memcache.set(self._key('opened'), self._opened_at)
+        memcache.delete(self._key('probe'))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def for_host(host):
+    """ Returns the breaker for host """
+    with _breakers_lock:
+        circuit = _breakers.get(host)
+        if circuit is None:
+            circuit = _breakers[host] = CircuitBreaker(host)
+        return circuit
+
+
+def reset():
+    """ Forgets the in-process state of all breakers """
+    with _breakers_lock:
+        _breakers.clear()
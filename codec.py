@@ -0,0 +1,154 @@
+""" Compact serialization for values cached in memcache
+
+Memcache pickles whatever it is given, which is bulky for the large JSON
+payloads we cache, and items over about 1MB can't be stored at all. Values
+stored through this module are instead encoded as compact JSON (or msgpack, if
+it is installed and FORMAT says so), compressed with zlib when they are larger
+than COMPRESS_THRESHOLD, and split across several memcache items when they are
+still too big for one.
+
+Values that JSON or msgpack couldn't give back exactly as they were, like
+tuples, dicts with keys that aren't strings or strings that aren't UTF-8, are
+pickled instead.
+
+Values that were stored directly with memcache are returned as they are, so
+this can read data cached before it was in use.
+
+Usage:
+
+import codec
+
+codec.set_multi({'a': big_list, 'b': other_list}, 3600, key_prefix='data:')
+values = codec.get_multi(['a', 'b'], key_prefix='data:')
+
+"""
+import hashlib
+import json
+import pickle
+import zlib
+
+from google.appengine.api import memcache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 'json' or 'msgpack'. Values are always readable whichever was used to store
+# them, as long as msgpack is installed.
+FORMAT = 'json'
+COMPRESS_THRESHOLD = 1024
+# Leaves room under memcache's 1MB item limit for the key and overhead.
+CHUNK_SIZE = 1000000 - 2048
+
+# Encoded values start with MAGIC and a character saying how the rest of the
+# value is encoded.
+MAGIC = '\x00hd'
+_JSON = 'j'
+_MSGPACK = 'm'
+_PICKLE = 'p'
+_ZLIB = 'z'
+_CHUNKED = 'c'
+
+
+def _round_trips(value):
+    """ Returns whether value would come back from JSON or msgpack equal to
+    what it was. Neither has tuples, and dict keys come back as strings. """
+    if isinstance(value, list):
+        return all(_round_trips(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, basestring) and _round_trips(item)
+                   for key, item in value.iteritems())
+    return isinstance(value, (basestring, int, long, float, bool, type(None)))
+
+
+def dumps(value):
+    """ Encodes value, compressing it if it is large """
+    kind = data = None
+    if _round_trips(value):
+        if FORMAT == 'msgpack' and msgpack:
+            kind, data = _MSGPACK, msgpack.packb(value, use_bin_type=True)
+        else:
+            try:
+                kind, data = _JSON, json.dumps(value, separators=(',', ':'))
+            except ValueError:
+                # Strings that aren't UTF-8.
+                data = None
+    if data is None:
+        kind, data = _PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) > COMPRESS_THRESHOLD:
+        return MAGIC + _ZLIB + kind + zlib.compress(data)
+    return MAGIC + kind + data
+
+
+def loads(data):
+    """ Decodes something encoded by dumps. Anything else is returned as it
+    is. """
+    if not isinstance(data, str) or not data.startswith(MAGIC):
+        return data
+    kind, data = data[len(MAGIC)], data[len(MAGIC) + 1:]
+    if kind == _ZLIB:
+        kind, data = data[0], zlib.decompress(data[1:])
+    if kind == _JSON:
+        return json.loads(data)
+    if kind == _MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    if kind == _PICKLE:
+        return pickle.loads(data)
+    raise ValueError("Unknown cache encoding %r" % kind)
+
+
+def _chunk_key(key, digest, i):
+    return '%s:chunk:%s:%d' % (key, digest, i)
+
+
+def set_multi(mapping, time=0, key_prefix=''):
+    """ Encodes and stores all the values in mapping with one memcache call,
+    splitting any that are too large for a single item """
+    items = {}
+    for key, value in mapping.iteritems():
+        key = key_prefix + key
+        data = dumps(value)
+        if len(data) <= CHUNK_SIZE:
+            items[key] = data
+            continue
+        # The header names its chunks by content, so a reader can never mix
+        # chunks from different versions of the value.
+        digest = hashlib.sha1(data).hexdigest()
+        count = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+        items[key] = MAGIC + _CHUNKED + json.dumps([digest, count])
+        for i in range(count):
+            items[_chunk_key(key, digest, i)] = \
+                data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]
+    return memcache.set_multi(items, time)
+
+
+def get_multi(keys, key_prefix=''):
+    """ Reads and decodes values stored with set_multi. Missing values, or ones
+    with chunks missing, are left out of the returned dict. """
+    found = memcache.get_multi(keys, key_prefix=key_prefix)
+
+    chunked = {}
+    for key, data in found.items():
+        if isinstance(data, str) and data.startswith(MAGIC + _CHUNKED):
+            digest, count = json.loads(data[len(MAGIC) + 1:])
+            chunked[key] = [_chunk_key(key_prefix + key, digest, i)
+                            for i in range(count)]
+    if chunked:
+        chunks = memcache.get_multi(
+            [chunk for chunk_keys in chunked.values() for chunk in chunk_keys])
+        for key, chunk_keys in chunked.iteritems():
+            if all(chunk in chunks for chunk in chunk_keys):
+                found[key] = ''.join(chunks[chunk] for chunk in chunk_keys)
+            else:
+                del found[key]
+
+    return dict((key, loads(data)) for key, data in found.iteritems())
+
+
+def set(key, value, time=0):
+    return not set_multi({key: value}, time)
+
+
+def get(key):
+    return get_multi([key]).get(key)
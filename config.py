@@ -1,10 +1,181 @@
+""" Configuration for the application.
+
+Everything here is worked out once per process. config.get() returns an
+immutable snapshot of it, which is cheap enough to call on every request:
+
+import config
+
+if config.get().is_testing:
+  ...
+
+Shared settings can be given defaults with config.set_defaults(), and, if
+HOT_RELOAD is on, overridden without a deploy by calling
+config.set_overrides(), which saves them in the datastore. Each instance checks
+the version of the overrides in memcache at most every RELOAD_INTERVAL seconds,
+and only reads them again when it has changed. """
+
+
+import collections
+import json
 import logging
 import os
+import threading
+import time
+
+from google.appengine.api import app_identity, memcache
+from google.appengine.ext import db
+
+
+# Whether to pick up overrides saved with set_overrides().
+HOT_RELOAD = False
+# How often to check whether the overrides have changed, in seconds.
+RELOAD_INTERVAL = 10
+
+DEFAULT_SETTINGS = {}
+
+_VERSION_KEY = "config_version"
+
+
+""" The configuration at some point in time. Settings are read with get(). """
+class Snapshot(collections.namedtuple("Snapshot",
+    ["app_name", "is_dev", "is_prod", "is_testing", "settings", "version"])):
+  __slots__ = ()
+
+  """ Gets the value of a shared setting.
+  name: The name of the setting.
+  default: What to return if it isn't set.
+  Returns: The value. """
+  def get(self, name, default=None):
+    for setting, value in self.settings:
+      if setting == name:
+        return value
+    return default
+
+
+""" Datastore entity holding the overrides for shared settings. """
+class ConfigOverrides(db.Model):
+  settings = db.TextProperty(default="{}")
+  version = db.IntegerProperty(default=0)
+
+
+_lock = threading.Lock()
+_snapshot = None
+_checked = 0
+# The overrides the snapshot was made with.
+_overrides = {}
+
+
+""" Works out the environment and the settings.
+overrides: Settings that replace the defaults.
+version: The version of the overrides.
+Returns: A new Snapshot. """
+def _resolve(overrides=None, version=0):
+  is_dev = False
+  try:
+    # Check if we are running on the local dev server.
+    software = os.environ["SERVER_SOFTWARE"]
+    is_dev = software.startswith("Dev") and "testbed" not in software
+  except KeyError:
+    pass
+
+  try:
+    app_name = app_identity.get_application_id()
+  except AttributeError:
+    # We're calling code outside of GAE, so we must be testing.
+    app_name = "testbed-test"
+  is_testing = app_name == "testbed-test"
+  is_prod = not (is_dev or is_testing)
+
+  if is_testing:
+    logging.debug("Is testing.")
+  elif is_dev:
+    logging.debug("Is dev server.")
+  else:
+    logging.debug("Is production server.")
+
+  settings = dict(DEFAULT_SETTINGS)
+  settings.update(overrides or {})
+  return Snapshot(app_name, is_dev, is_prod, is_testing,
+                  tuple(sorted(settings.items())), version)
+
+""" Gets the version of the overrides, which is kept in memcache so that
+checking it doesn't need the datastore.
+Returns: The version. """
+def _overrides_version():
+  version = memcache.get(_VERSION_KEY)
+  if version is None:
+    overrides = ConfigOverrides.get_by_key_name("shared")
+    version = overrides.version if overrides else 0
+    memcache.add(_VERSION_KEY, version)
+  return version
+
+""" Reloads the overrides if their version has changed. """
+def _reload():
+  global _snapshot, _overrides
+  version = _overrides_version()
+  if version == _snapshot.version:
+    return
+
+  overrides = ConfigOverrides.get_by_key_name("shared")
+  if overrides:
+    _overrides = json.loads(overrides.settings)
+    _snapshot = _resolve(_overrides, overrides.version)
+    logging.info("Loaded version %d of the config overrides." % (version))
+
+""" Gets the configuration.
+Returns: A Snapshot, which is the same object until something changes. """
+def get():
+  global _snapshot, _checked
+  snapshot = _snapshot
+  if snapshot is not None and \
+      (not HOT_RELOAD or time.time() - _checked < RELOAD_INTERVAL):
+    return snapshot
+
+  with _lock:
+    if _snapshot is None:
+      _snapshot = _resolve()
+    if HOT_RELOAD and time.time() - _checked >= RELOAD_INTERVAL:
+      _checked = time.time()
+      _reload()
+    return _snapshot
+
+""" Sets the defaults for shared settings.
+settings: The names and values of the settings. """
+def set_defaults(**settings):
+  global _snapshot
+  with _lock:
+    DEFAULT_SETTINGS.update(settings)
+    if _snapshot is not None:
+      _snapshot = _resolve(_overrides, _snapshot.version)
+
+""" Saves overrides for shared settings, which every instance picks up within
+RELOAD_INTERVAL seconds if HOT_RELOAD is on.
+settings: The names and values of the settings.
+Returns: The new version of the overrides. """
+def set_overrides(**settings):
+  def txn():
+    overrides = ConfigOverrides.get_by_key_name("shared") or \
+        ConfigOverrides(key_name="shared")
+    overrides.settings = json.dumps(settings)
+    overrides.version += 1
+    overrides.put()
+    return overrides.version
+  version = db.run_in_transaction(txn)
+  memcache.set(_VERSION_KEY, version)
+  return version
 
-from google.appengine.api import app_identity
+""" Forgets the configuration, so that it is worked out again. Meant for
+tests. """
+def reset():
+  global _snapshot, _checked, _overrides
+  with _lock:
+    _snapshot = None
+    _checked = 0
+    _overrides = {}
 
 
-""" Class for storing specific configuration parameters. """
+""" Class for storing specific configuration parameters. This just copies them
+from the snapshot returned by get(). """
 class Config(object):
   # Mutually exclusive flags that specify whether the application is running on
   # hd-events-hrd, dev_appserver, or local unit tests.
@@ -13,26 +184,8 @@ class Config(object):
   is_testing = False;
 
   def __init__(self):
-    try:
-      # Check if we are running on the local dev server.
-      software = os.environ["SERVER_SOFTWARE"]
-      Config.is_dev = software.startswith("Dev") and "testbed" not in software
-    except KeyError:
-      pass
-
-    try:
-      self.APP_NAME = app_identity.get_application_id()
-    except AttributeError:
-      # We're calling code outside of GAE, so we must be testing.
-      self.APP_NAME = "testbed-test"
-    if self.APP_NAME == "testbed-test":
-      Config.is_testing = True
-
-    Config.is_prod = not (Config.is_dev or Config.is_testing)
-
-    if Config.is_testing:
-      logging.debug("Is testing.")
-    elif Config.is_dev:
-      logging.debug("Is dev server.")
-    else:
-      logging.debug("Is production server.")
+    snapshot = get()
+    Config.is_dev = snapshot.is_dev
+    Config.is_prod = snapshot.is_prod
+    Config.is_testing = snapshot.is_testing
+    self.APP_NAME = snapshot.app_name
@@ -1,9 +1,18 @@
 import argparse
+import ast
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
+import traceback
 import unittest
 
 
@@ -12,6 +21,38 @@ GAE_SDK_VERSION = "1.9.23"
 """ The oldest version of the SDK that is acceptable to have on a user's system.
 """
 GAE_OLDEST_SDK = "1.9.18"
+""" Where downloaded copies of the GAE SDK are kept between runs, one for each
+version. An archive put here by hand is used without downloading anything. """
+GAE_SDK_CACHE = os.environ.get("GAE_SDK_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "hd-shared", "gae_sdk"))
+""" The SHA-256 of the SDK archive, if it should be pinned. Otherwise, the hash
+of the first archive downloaded is recorded and later ones are checked against
+it. """
+GAE_SDK_SHA256 = os.environ.get("GAE_SDK_SHA256")
+""" Records the version and content hash of each installed external. """
+EXTERNALS_LOCK = "externals/externals.lock"
+""" Where archives of installed externals are kept, named by their hashes, so
+that they can be reinstalled without pip. """
+EXTERNALS_CACHE = os.environ.get("EXTERNALS_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "hd-shared", "externals"))
+""" The file in each external's directory that holds its content hash. """
+EXTERNAL_HASH_FILE = ".external_hash"
+""" How many externals to install at once. """
+EXTERNAL_INSTALL_JOBS = 4
+""" Where the time each test took is recorded, for balancing test shards. """
+TEST_DURATIONS_FILE = ".test_durations.json"
+""" How long to assume a test takes if it has never been timed. """
+DEFAULT_TEST_DURATION = 0.1
+""" Where the import dependencies of the source files and the code that the
+tests last passed against are recorded, relative to the project. """
+TEST_INDEX_FILE = ".test_index.json"
+""" Directories that don't hold code the tests depend on. """
+UNINDEXED_DIRECTORIES = ("externals", "google_appengine", "static")
+
+
+""" Raised when an external can't be installed. """
+class ExternalError(Exception):
+  pass
 
 
 """ Generates a name for the directory that this module will reside in.
@@ -55,16 +96,9 @@ def compare_versions(version1, version2, comparator):
   # If we got here, then they were equal. That's great if we wanted them to be.
   return "=" in comparator
 
-""" Make sure that we have the proper version of the required external library.
-external: The external dependency to check for.
-"""
-def get_external(external):
-  try:
-    name, comparison, version, module_name = make_name(external)
-  except ValueError:
-    print "ERROR: Could not parse line '%s' in externals.txt." % (external)
-    os._exit(1)
-
+""" Lists the directories that externals are installed in.
+Returns: The names of the directories. """
+def list_externals():
   # Get all the subdirectories where we've installed modules.
   subdirectories = [x for x in os.listdir("externals") \
       if os.path.isdir(os.path.join("externals", x))]
@@ -73,44 +107,658 @@ def get_external(external):
   to_delete = []
   for installed in subdirectories:
     # Check that it matches the form of the names we give directories for
-    # installed modules.
-    if not re.findall(r"\w+\_v\d+", installed):
+    # installed modules, and isn't an install in progress.
+    if not re.findall(r"\w+\_v\d+", installed) or installed.startswith("."):
       to_delete.append(installed)
   for item in to_delete:
     subdirectories.remove(item)
+  return subdirectories
+
+""" Hashes a file.
+path: The file to hash.
+Returns: The hex digest of its contents. """
+def hash_file(path):
+  digest = hashlib.sha256()
+  with open(path, "rb") as to_hash:
+    for block in iter(lambda: to_hash.read(1 << 16), ""):
+      digest.update(block)
+  return digest.hexdigest()
+
+""" Finds where the cache records which archive holds an external.
+external: The line from externals.txt for this external. """
+def cache_pointer(external):
+  return os.path.join(EXTERNALS_CACHE, "requirements",
+                      hashlib.sha1(external).hexdigest())
+
+""" Writes a file so that it appears all at once.
+path: The file to write.
+contents: What to write to it. """
+def write_atomically(path, contents):
+  handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+  with os.fdopen(handle, "wb") as output:
+    output.write(contents)
+  os.rename(temporary, path)
+
+""" Archives an installed external into the cache.
+external: The line from externals.txt for this external.
+location: The directory it is installed in.
+Returns: The content hash of the archive. """
+def archive_external(external, location):
+  archives = os.path.join(EXTERNALS_CACHE, "archives")
+  for directory in (archives, os.path.dirname(cache_pointer(external))):
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # Another install made it first.
+        pass
+
+  handle, temporary = tempfile.mkstemp(dir=archives)
+  os.close(handle)
+  archive = tarfile.open(temporary, "w:gz")
+  for name in sorted(os.listdir(location)):
+    if name != EXTERNAL_HASH_FILE:
+      archive.add(os.path.join(location, name), arcname=name)
+  archive.close()
+
+  content_hash = hash_file(temporary)
+  os.rename(temporary, os.path.join(archives, "%s.tar.gz" % (content_hash)))
+  write_atomically(cache_pointer(external), content_hash)
+  return content_hash
+
+""" Finds a cached archive of an external, checking that it is intact.
+external: The line from externals.txt for this external.
+Returns: The path to the archive and its content hash, or None. """
+def cached_archive(external):
+  try:
+    content_hash = open(cache_pointer(external)).read().strip()
+  except IOError:
+    return None
+  path = os.path.join(EXTERNALS_CACHE, "archives",
+                      "%s.tar.gz" % (content_hash))
+  if not os.path.exists(path):
+    return None
+  if hash_file(path) != content_hash:
+    print "Removing corrupt cached archive for '%s'." % (external)
+    os.remove(path)
+    return None
+  return path, content_hash
+
+""" Works out which version of an external pip actually installed.
+name: The name of the external.
+location: The directory it is installed in.
+version: The version to assume if it can't be told.
+Returns: The version string. """
+def installed_version(name, location, version):
+  wanted = name.lower().replace("-", "_")
+  for entry in os.listdir(location):
+    base, extension = os.path.splitext(entry)
+    if extension in (".dist-info", ".egg-info") and "-" in base:
+      have_name, have_version = base.split("-", 1)
+      if have_name.lower().replace("-", "_") == wanted:
+        return have_version.split("-")[0]
+  return version
+
+""" Checks whether the lock file says an external is installed, and that it
+still is.
+external: The line from externals.txt for this external.
+lock: The contents of the lock file.
+Returns: True or False. """
+def external_satisfied(external, lock):
+  entry = lock.get(external)
+  if not entry:
+    return False
+  marker = os.path.join("externals", entry["directory"], EXTERNAL_HASH_FILE)
+  try:
+    return open(marker).read().strip() == entry["hash"]
+  except IOError:
+    return False
+
+""" Make sure that we have the proper version of the required external library.
+external: The external dependency to check for.
+installed: The directories that externals are installed in, if they have
+already been listed.
+Returns: The lock file entry for the external.
+Raises: ExternalError if it can't be installed. """
+def get_external(external, installed=None):
+  try:
+    name, comparison, version, module_name = make_name(external)
+  except ValueError:
+    raise ExternalError("Could not parse line '%s' in externals.txt." % \
+                        (external))
+
+  if installed is None:
+    installed = list_externals()
 
   # Delete any other versions of the module.
-  for installed in subdirectories:
-    have_name, have_version = installed.split("_v")
+  for directory in installed:
+    have_name, have_version = directory.split("_v")
     if have_name == name:
       if compare_versions(have_version, version, comparison):
-        # We already have it; we're done.
-        return
+        # We already have it; we're done once it's in the lock file.
+        location = os.path.join("externals", directory)
+        marker = os.path.join(location, EXTERNAL_HASH_FILE)
+        if os.path.exists(marker):
+          content_hash = open(marker).read().strip()
+        else:
+          content_hash = archive_external(external, location)
+          write_atomically(marker, content_hash)
+        return {"name": name, "directory": directory, "hash": content_hash,
+                "version": installed_version(name, location, have_version)}
       else:
         # Wrong version.
         print "Found unusable version of '%s'" % (name)
-        shutil.rmtree(os.path.join("externals", installed))
+        shutil.rmtree(os.path.join("externals", directory))
 
-  # Make a special directory to install it in.
+  # Install it somewhere else first, so that a failed install never looks
+  # like a finished one.
   install_location = os.path.join("externals", module_name)
-  os.mkdir(install_location)
+  staging = tempfile.mkdtemp(prefix=".", dir="externals")
+
+  cached = cached_archive(external)
+  if cached:
+    archive_path, content_hash = cached
+    print "Installing '%s' from the cache." % (name)
+    archive = tarfile.open(archive_path)
+    archive.extractall(staging)
+    archive.close()
+  else:
+    pip_location = get_location("pip")
+
+    # Install the module.
+    try:
+      subprocess.check_call([os.path.join(pip_location, "pip"), "install",
+                             "-t", staging, external.replace(" ", "")])
+    except subprocess.CalledProcessError:
+      # Get rid of the installation directory.
+      shutil.rmtree(staging)
+      raise ExternalError("Installation of '%s' failed." % (name))
+    content_hash = archive_external(external, staging)
+
+  write_atomically(os.path.join(staging, EXTERNAL_HASH_FILE), content_hash)
+  os.rename(staging, install_location)
+  return {"name": name, "directory": module_name, "hash": content_hash,
+          "version": installed_version(name, install_location, version)}
+
+""" Makes sure that we have all the required externals, installing the missing
+ones at the same time.
+required: The lines from externals.txt. """
+def get_externals(required):
+  try:
+    lock = json.load(open(EXTERNALS_LOCK))
+  except (IOError, ValueError):
+    lock = {}
+
+  missing = [external for external in required \
+             if not external_satisfied(external, lock)]
+  if missing:
+    installed = list_externals()
+    # Let every install finish before giving up, so that none of them is left
+    # half done.
+    def install(external):
+      try:
+        return get_external(external, installed)
+      except ExternalError as error:
+        return error
+    pool = ThreadPool(min(EXTERNAL_INSTALL_JOBS, len(missing)))
+    entries = pool.map(install, missing)
+    pool.close()
+    errors = [entry for entry in entries if isinstance(entry, ExternalError)]
+    for error in errors:
+      print "ERROR: %s" % (error)
+    if errors:
+      sys.exit(1)
+    lock.update(zip(missing, entries))
+
+  # Forget externals that are no longer required.
+  new_lock = dict((external, lock[external]) for external in required)
+  if missing or new_lock != lock:
+    with open(EXTERNALS_LOCK, "w") as lock_file:
+      json.dump(new_lock, lock_file, indent=2, sort_keys=True)
+
+""" Lists all the tests in a suite.
+suite: The suite to list.
+Returns: A list of the individual test cases. """
+def list_tests(suite):
+  tests = []
+  for test in suite:
+    if isinstance(test, unittest.TestSuite):
+      tests.extend(list_tests(test))
+    else:
+      tests.append(test)
+  return tests
+
+""" Reads the test index.
+Returns: A dict with the hash and imports of each source file under "files",
+and under "green", the hash of the code each test module last passed against.
+"""
+def load_test_index():
+  try:
+    index = json.load(open(TEST_INDEX_FILE))
+  except (IOError, ValueError):
+    index = {}
+  index.setdefault("files", {})
+  index.setdefault("green", {})
+  return index
+
+""" Saves the test index.
+index: The index to save. """
+def save_test_index(index):
+  with open(TEST_INDEX_FILE, "w") as index_file:
+    json.dump(index, index_file, sort_keys=True)
+
+""" Finds the modules a source file imports.
+path: The source file.
+Returns: A list of tuples of the level of each import, which is 0 for absolute
+ones, and the dotted names that it could refer to. """
+def find_imports(path):
+  try:
+    tree = ast.parse(open(path).read(), path)
+  except SyntaxError:
+    return []
+  imports = []
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      imports.extend((0, [alias.name]) for alias in node.names)
+    elif isinstance(node, ast.ImportFrom):
+      module = node.module or ""
+      # The names imported can be submodules as well as attributes.
+      names = [module] + [".".join(filter(None, [module, alias.name]))
+                          for alias in node.names]
+      imports.append((node.level, names))
+  return imports
+
+""" Reads the modules that a lazy package like this one exposes as its
+attributes, from the MODULES dict in its __init__.py.
+path: The __init__.py of the package.
+Returns: A dict mapping the names of the modules to where they are in the
+package, which is empty if it isn't a lazy package. """
+def lazy_modules(path):
+  try:
+    tree = ast.parse(open(path).read(), path)
+  except (IOError, SyntaxError):
+    return {}
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and \
+        [getattr(target, "id", None) for target in node.targets] == \
+        ["MODULES"]:
+      try:
+        return ast.literal_eval(node.value)
+      except ValueError:
+        return {}
+  return {}
+
+""" Works out which project files a dotted name refers to, following the names
+of lazy packages to the modules they stand for.
+base: The directory the name is relative to.
+name: The dotted name.
+files: The project's source files.
+in_package: Whether base is the package the name is in, as it is for relative
+imports.
+whole_package: Whether importing a lazy package by itself should count as
+importing all of its modules, since any of them can then be used as its
+attributes.
+Returns: A list of files, relative to the project. """
+def resolve_name(base, name, files, in_package=False, whole_package=False):
+  parts = name.split(".") if name else []
+  resolved = []
+  module_path = base
+  i = 0
+  while True:
+    package = os.path.join(module_path, "__init__.py")
+    modules = {}
+    if (i or in_package) and package in files:
+      modules = lazy_modules(package)
+    if modules and i == len(parts):
+      if whole_package and parts:
+        for module in modules.values():
+          resolved.extend(resolve_name(module_path, module, files))
+    elif modules and parts[i] in modules:
+      parts[i:i + 1] = modules[parts[i]].split(".")
+    elif modules and \
+        os.path.join(module_path, parts[i]) + ".py" not in files and \
+        os.path.join(module_path, parts[i], "__init__.py") not in files:
+      # Not one of its modules, so it could be anything the package has.
+      for module in modules.values():
+        resolved.extend(resolve_name(module_path, module, files))
+      break
+    if i == len(parts):
+      break
+
+    # Importing a module runs the __init__ of each package it's in.
+    module_path = os.path.join(module_path, parts[i])
+    i += 1
+    for candidate in (module_path + ".py",
+                      os.path.join(module_path, "__init__.py")):
+      if candidate in files:
+        resolved.append(candidate)
+  return resolved
+
+""" Works out which project files an import refers to.
+path: The file doing the importing, relative to the project.
+level: The level of the import.
+names: The dotted names it could refer to.
+files: The project's source files.
+Returns: A list of files, relative to the project. """
+def resolve_import(path, level, names, files):
+  directory = os.path.dirname(path)
+  if level:
+    for _ in range(level - 1):
+      directory = os.path.dirname(directory)
+    bases = [directory]
+  else:
+    # Python 2 tries imports relative to the package first.
+    bases = [directory, ""]
+
+  resolved = []
+  for base in bases:
+    for name in names:
+      # Only a plain "import package" gives just the one name.
+      resolved.extend(resolve_name(base, name, files, in_package=bool(level),
+                                   whole_package=len(names) == 1))
+    if resolved:
+      break
+  return resolved
+
+""" Brings the file records in the index up to date, only rereading the files
+that have changed since they were indexed. Files that aren't Python, like
+templates and yaml, are recorded too, since tests can depend on them as well.
+index: The test index.
+Returns: A dict mapping each file to its hash and, for source files, the files
+it imports. """
+def index_files(index):
+  paths = []
+  for directory, subdirectories, filenames in os.walk("."):
+    subdirectories[:] = [subdirectory for subdirectory in subdirectories \
+        if not subdirectory.startswith(".") and \
+        subdirectory not in UNINDEXED_DIRECTORIES]
+    paths.extend(os.path.normpath(os.path.join(directory, filename)) \
+                 for filename in filenames if not filename.startswith(".") \
+                 and not filename.endswith(".pyc"))
+
+  files = {}
+  changed = []
+  for path in paths:
+    stat = os.stat(path)
+    record = index["files"].get(path)
+    if record and record["mtime"] == stat.st_mtime and \
+        record["size"] == stat.st_size:
+      files[path] = record
+      continue
+    files[path] = {"mtime": stat.st_mtime, "size": stat.st_size,
+                   "hash": hashlib.sha1(open(path, "rb").read()).hexdigest()}
+    changed.append(path)
+  sources = [path for path in paths if path.endswith(".py")]
+  if set(sources) - set(index["files"]) or \
+      any(lazy_modules(path) for path in changed \
+          if os.path.basename(path) == "__init__.py"):
+    # New files and the modules of lazy packages can change what other files'
+    # imports refer to.
+    changed = sources
+  for path in changed:
+    if not path.endswith(".py"):
+      continue
+    imports = set()
+    for level, names in find_imports(path):
+      imports.update(resolve_import(path, level, names, files))
+    imports.discard(path)
+    files[path]["imports"] = sorted(imports)
 
-  pip_location = get_location("pip")
+  index["files"] = files
+  return files
 
-  # Install the module.
+""" Reads the version of the GAE SDK.
+sdk_path: The path to the appengine sdk.
+Returns: The version string, or None if it can't be told. """
+def sdk_version(sdk_path):
   try:
-    subprocess.check_call([os.path.join(pip_location, "pip"), "install",
-                           "-t", install_location, external.replace(" ", "")])
-  except subprocess.CalledProcessError:
-    print "ERROR: Installation of '%s' failed." % (name)
-    # Get rid of the installation directory.
-    shutil.rmtree(install_location)
-    os._exit(0)
+    version_info = open(os.path.join(sdk_path, "VERSION")).read()
+  except (IOError, TypeError):
+    return None
+  return version_info.split("\n")[0].lstrip("release: ").strip("\"")
+
+""" Hashes what every test depends on besides the source files it imports: the
+version of the SDK, the installed externals and the project's files that
+aren't Python.
+files: The project's files, as recorded in the index.
+sdk_path: The path to the appengine sdk.
+Returns: The hash. """
+def environment_hash(files, sdk_path=None):
+  digest = hashlib.sha1()
+  digest.update("sdk %s\n" % (sdk_version(sdk_path)))
+  if os.path.exists(EXTERNALS_LOCK):
+    digest.update("%s %s\n" % (EXTERNALS_LOCK, hash_file(EXTERNALS_LOCK)))
+  for path in sorted(files):
+    if not path.endswith(".py"):
+      digest.update("%s %s\n" % (path, files[path]["hash"]))
+  return digest.hexdigest()
+
+""" Hashes the code a source file depends on, which is the file itself and
+everything it imports, directly or not, along with everything the tests depend
+on.
+path: The source file.
+files: The project's files.
+environment: The environment_hash().
+Returns: The hash. """
+def dependency_hash(path, files, environment=""):
+  seen = set([path])
+  pending = [path]
+  while pending:
+    for imported in files[pending.pop()].get("imports", []):
+      if imported not in seen:
+        seen.add(imported)
+        pending.append(imported)
+  digest = hashlib.sha1(environment)
+  for dependency in sorted(seen):
+    digest.update("%s %s\n" % (dependency, files[dependency]["hash"]))
+  return digest.hexdigest()
+
+""" Finds the project file that a test is defined in.
+test: The test case.
+Returns: The path relative to the project, or None if it isn't in one. """
+def test_file(test):
+  module = sys.modules.get(test.__class__.__module__)
+  path = getattr(module, "__file__", None)
+  if not path:
+    return None
+  path = os.path.splitext(os.path.realpath(path))[0] + ".py"
+  path = os.path.relpath(path, os.path.realpath(os.getcwd()))
+  if path.startswith(os.pardir):
+    return None
+  return path
+
+""" Leaves out the tests whose code hasn't changed since they last passed.
+suites: The test suites to select from.
+index: The test index.
+sdk_path: The path to the appengine sdk.
+Returns: The selected tests as a list of suites, and a dict mapping the test
+modules to the hashes of the code they depend on now. """
+def select_tests(suites, index, sdk_path=None):
+  files = index_files(index)
+  environment = environment_hash(files, sdk_path)
+  hashes = {}
+  selected = []
+  for suite in suites:
+    tests = unittest.TestSuite()
+    for test in list_tests(suite):
+      path = test_file(test)
+      if path not in files:
+        # Couldn't tell what it depends on.
+        tests.addTest(test)
+        continue
+      if path not in hashes:
+        hashes[path] = dependency_hash(path, files, environment)
+      if index["green"].get(path) != hashes[path]:
+        tests.addTest(test)
+    selected.append(tests)
+  return selected, hashes
+
+""" Reads the recorded test durations.
+Returns: A dict mapping test ids to how long they took in seconds. """
+def load_durations():
+  try:
+    return json.load(open(TEST_DURATIONS_FILE))
+  except (IOError, ValueError):
+    return {}
+
+""" Records test durations, keeping the ones for tests that didn't run.
+durations: A dict mapping test ids to how long they took in seconds. """
+def save_durations(durations):
+  recorded = load_durations()
+  recorded.update(durations)
+  with open(TEST_DURATIONS_FILE, "w") as durations_file:
+    json.dump(recorded, durations_file, indent=2, sort_keys=True)
+
+""" Splits tests into shards that should take about as long as each other to
+run, by always giving the next longest test to the shard with the least work.
+test_ids: The ids of the tests to split up.
+durations: A dict mapping test ids to how long they took last time.
+count: How many shards to make.
+Returns: A list of lists of test ids. """
+def make_shards(test_ids, durations, count):
+  shards = [[] for _ in range(count)]
+  loads = [0.0] * count
+  by_duration = sorted(test_ids, reverse=True,
+      key=lambda test_id: durations.get(test_id, DEFAULT_TEST_DURATION))
+  for test_id in by_duration:
+    shard = loads.index(min(loads))
+    shards[shard].append(test_id)
+    loads[shard] += durations.get(test_id, DEFAULT_TEST_DURATION)
+  return [sorted(shard_ids) for shard_ids in shards if shard_ids]
+
+
+""" A test result that sends each outcome to a queue as soon as it is known,
+so that results from all the workers can be shown as they come in. """
+class StreamingResult(unittest.TestResult):
+  def __init__(self, queue):
+    super(StreamingResult, self).__init__()
+    self.queue = queue
+    self.__started = time.time()
+
+  def startTest(self, test):
+    super(StreamingResult, self).startTest(test)
+    self.__started = time.time()
+
+  def __report(self, test, outcome, err=None):
+    details = err and self._exc_info_to_string(err, test)
+    self.queue.put((test.id(), outcome, time.time() - self.__started,
+                    details))
+
+  def addSuccess(self, test):
+    super(StreamingResult, self).addSuccess(test)
+    self.__report(test, "ok")
+
+  def addError(self, test, err):
+    super(StreamingResult, self).addError(test, err)
+    self.__report(test, "ERROR", err)
+
+  def addFailure(self, test, err):
+    super(StreamingResult, self).addFailure(test, err)
+    self.__report(test, "FAIL", err)
+
+  def addSkip(self, test, reason):
+    super(StreamingResult, self).addSkip(test, reason)
+    self.__report(test, "skipped %r" % (reason))
+
+  def addExpectedFailure(self, test, err):
+    super(StreamingResult, self).addExpectedFailure(test, err)
+    self.__report(test, "expected failure")
+
+  def addUnexpectedSuccess(self, test):
+    super(StreamingResult, self).addUnexpectedSuccess(test)
+    self.__report(test, "unexpected success")
+
+# The queue that a test worker process reports results to.
+_worker_queue = None
+
+""" Sets up a test worker process.
+sdk_path: The path to the appengine sdk.
+queue: The queue to report results to. """
+def _init_worker(sdk_path, queue):
+  global _worker_queue
+  _worker_queue = queue
+
+  if sdk_path not in sys.path:
+    sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  if os.getcwd() not in sys.path:
+    sys.path.insert(0, os.getcwd())
+
+""" Runs a shard of tests in a worker process. Each test sets up its own GAE
+testbed, which is private to the process.
+test_ids: The ids of the tests to run. """
+def _run_shard(test_ids):
+  loader = unittest.loader.TestLoader()
+  suite = unittest.TestSuite()
+  for test_id in test_ids:
+    try:
+      suite.addTest(loader.loadTestsFromName(test_id))
+    except Exception:
+      _worker_queue.put((test_id, "ERROR", 0, traceback.format_exc()))
+  suite.run(StreamingResult(_worker_queue))
+
+""" Runs tests across several processes, showing results as they come in.
+sdk_path: The path to the appengine sdk.
+suites: The test suites to run.
+jobs: How many processes to use.
+Returns: True or False depending on whether tests succeed. """
+def run_tests_parallel(sdk_path, suites, jobs):
+  test_ids = [test.id() for suite in suites for test in list_tests(suite)]
+  if not test_ids:
+    return True
+  shards = make_shards(test_ids, load_durations(), jobs)
+  print "Running %d tests in %d processes." % (len(test_ids), len(shards))
+
+  start = time.time()
+  # A managed queue, so that results have all arrived once the shards are done.
+  queue = multiprocessing.Manager().Queue()
+  pool = multiprocessing.Pool(len(shards), _init_worker, (sdk_path, queue))
+  finished = pool.map_async(_run_shard, shards)
+  pool.close()
+
+  durations = {}
+  problems = []
+  counts = {}
+  while True:
+    done = finished.ready()
+    while not queue.empty():
+      test_id, outcome, duration, details = queue.get()
+      print "%s ... %s" % (test_id, outcome)
+      durations[test_id] = duration
+      counts[outcome] = counts.get(outcome, 0) + 1
+      if details and outcome in ("ERROR", "FAIL"):
+        problems.append((outcome, test_id, details))
+    if done:
+      break
+    time.sleep(0.05)
+  pool.join()
+  # Raise anything that went wrong in the workers themselves.
+  finished.get()
+
+  for outcome, test_id, details in problems:
+    print "=" * 70
+    print "%s: %s" % (outcome, test_id)
+    print "-" * 70
+    print details
+  print "-" * 70
+  print "Ran %d tests in %.3fs" % (len(durations), time.time() - start)
+  print
+
+  save_durations(durations)
+  if problems:
+    print "FAILED (failures=%d, errors=%d)" % (counts.get("FAIL", 0),
+                                               counts.get("ERROR", 0))
+    print "ERROR: Unit tests failed."
+    return False
+  print "OK"
+  return True
 
 """ Runs all the unit tests.
 sdk_path: The path to the appengine sdk.
+args: Options from the command line.
 Returns: True or False depending on whether tests succeed. """
-def run_tests(sdk_path, *args):
+def run_tests(sdk_path, args=None, *unused):
   sys.path.insert(0, sdk_path)
   import dev_appserver
   dev_appserver.fix_sys_path()
@@ -124,6 +772,33 @@ def run_tests(sdk_path, *args):
   # Project-specific tests.
   suites.append(loader.discover("tests", top_level_dir=os.getcwd()))
 
+  # Only run the tests whose code has changed since they last passed.
+  index = load_test_index()
+  total = sum(suite.countTestCases() for suite in suites)
+  selected, hashes = select_tests(suites, index, sdk_path)
+  if not getattr(args, "all", False):
+    suites = selected
+    skipped = total - sum(suite.countTestCases() for suite in suites)
+    if skipped:
+      print "Skipping %d of %d tests, which passed last time and whose code" \
+            " hasn't changed. Use --all to run them anyway." % (skipped, total)
+
+  success = run_suites(sdk_path, suites, args)
+  if success:
+    index["green"].update(hashes)
+  save_test_index(index)
+  return success
+
+""" Runs test suites, in parallel unless we've been told not to.
+sdk_path: The path to the appengine sdk.
+suites: The test suites to run.
+args: Options from the command line.
+Returns: True or False depending on whether tests succeed. """
+def run_suites(sdk_path, suites, args):
+  jobs = getattr(args, "jobs", None) or multiprocessing.cpu_count()
+  if not getattr(args, "serial", False) and jobs > 1:
+    return run_tests_parallel(sdk_path, suites, jobs)
+
   for suite in suites:
     test_result = unittest.TextTestRunner(verbosity=2).run(suite)
     if not test_result.wasSuccessful():
@@ -137,7 +812,7 @@ sdk_location: Path to the GAE sdk.
 args: Options from the command line.
 forward_args: Arguments to forward to dev_appserver. """
 def dev_server(sdk_location, args, forward_args):
-  if (not run_tests(sdk_location) and not args.force):
+  if (not run_tests(sdk_location, args) and not args.force):
     os._exit(1)
 
   command = [os.path.join(sdk_location, "dev_appserver.py"), "app.yaml"]
@@ -153,13 +828,33 @@ sdk_location: Path to the GAE sdk.
 args: Options from the command line.
 forward_args: Arguments to forward to appcfg. """
 def gae_update(sdk_location, args, forward_args):
-  if (not run_tests(sdk_location) and not args.force):
+  if (not run_tests(sdk_location, args) and not args.force):
     os._exit(1)
 
   command = [os.path.join(sdk_location, "appcfg.py"), "update", "app.yaml"]
   command.extend(forward_args)
   subprocess.call(command)
 
+""" Benchmarks how long the shared modules take to import on a cold start.
+sdk_location: Path to the GAE sdk.
+args: Options from the command line.
+Returns: True, unless importing took longer than --max-time. """
+def benchmark_imports(sdk_location, args, *unused):
+  shared_directory = os.path.dirname(os.path.realpath(__file__))
+  sys.path.insert(0, shared_directory)
+  import importbench
+
+  results = importbench.benchmark(sdk_location, args.repeat)
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(results, output, indent=2, sort_keys=True)
+
+  if args.max_time and results["total"] > args.max_time:
+    print "ERROR: Importing the shared modules took %.3fs, which is more than" \
+          " %.3fs." % (results["total"], args.max_time)
+    return False
+  return True
+
 """ Figures out where a particular executable is located on the user's system.
 program: The name of the executable to find.
 Returns: The path to the program. """
@@ -179,30 +874,75 @@ def get_location(program):
   real_location = real_location.rstrip("%s\n" % (program))
   return real_location
 
-""" Downloads the GAE SDK for use with Travis CI.
+""" Gets the GAE SDK for use with Travis CI, downloading it only if there isn't
+already a copy of this version in the cache.
 Returns: The location of the SDK. """
 def prepare_travis_gae():
-  print "Downloading GAE SDK..."
-
-  wget = os.path.join(get_location("wget"), "wget")
-  unzip = os.path.join(get_location("unzip"), "unzip")
-
   sdk_zip = "google_appengine_%s.zip" % (GAE_SDK_VERSION)
-  sdk_url = "https://storage.googleapis.com/appengine-sdks/featured/%s" % \
-            (sdk_zip)
-
-  subprocess.call([wget, sdk_url, "-nv"])
-  subprocess.call([unzip, "-q", sdk_zip])
+  archive = os.path.join(GAE_SDK_CACHE, sdk_zip)
+  extracted = os.path.join(GAE_SDK_CACHE, "google_appengine_%s" % \
+                           (GAE_SDK_VERSION))
+  location = os.path.join(extracted, "google_appengine/")
+  if os.path.exists(os.path.join(location, "VERSION")):
+    print "Using cached GAE SDK %s." % (GAE_SDK_VERSION)
+    return location
+
+  if not os.path.isdir(GAE_SDK_CACHE):
+    os.makedirs(GAE_SDK_CACHE)
+
+  if not os.path.exists(archive):
+    print "Downloading GAE SDK..."
+    wget = os.path.join(get_location("wget"), "wget")
+    sdk_url = "https://storage.googleapis.com/appengine-sdks/featured/%s" % \
+              (sdk_zip)
+    handle, download = tempfile.mkstemp(dir=GAE_SDK_CACHE)
+    os.close(handle)
+    if subprocess.call([wget, sdk_url, "-nv", "-O", download]):
+      os.remove(download)
+      print "ERROR: Could not download the GAE SDK."
+      os._exit(1)
+    os.rename(download, archive)
+
+  # Check the archive against the pinned hash, or the one we recorded the first
+  # time we saw this version.
+  archive_hash = hash_file(archive)
+  hash_record = archive + ".sha256"
+  expected = GAE_SDK_SHA256
+  if not expected and os.path.exists(hash_record):
+    expected = open(hash_record).read().strip()
+  if expected and archive_hash != expected:
+    print "ERROR: GAE SDK archive %s has the wrong checksum. Removing it." % \
+          (archive)
+    os.remove(archive)
+    os._exit(1)
+  write_atomically(hash_record, archive_hash)
 
-  os.remove(sdk_zip)
+  # Extract it somewhere else first, so that an interrupted extraction never
+  # looks like a finished one.
+  if os.path.isdir(extracted):
+    # Something went wrong with it.
+    shutil.rmtree(extracted)
+  unzip = os.path.join(get_location("unzip"), "unzip")
+  staging = tempfile.mkdtemp(prefix=".", dir=GAE_SDK_CACHE)
+  if subprocess.call([unzip, "-q", archive, "-d", staging]):
+    shutil.rmtree(staging)
+    print "ERROR: Could not extract the GAE SDK."
+    os._exit(1)
+  try:
+    os.rename(staging, extracted)
+  except OSError:
+    # Another run extracted it first.
+    shutil.rmtree(staging)
 
-  return "google_appengine/"
+  return location
 
-""" Removes the GAE SDK for use with Travis CI.
-location: The location of the downloaded SDK. """
+""" Cleans up after Travis CI. The cached SDK is kept for the next run.
+location: The location of the SDK. """
 def cleanup_travis_gae(location):
-  print "Cleaning up..."
-  shutil.rmtree(location)
+  cache = os.path.realpath(GAE_SDK_CACHE)
+  if not os.path.realpath(location).startswith(cache + os.sep):
+    print "Cleaning up..."
+    shutil.rmtree(location)
 
 """ Runs tests and takes the requested action.
 Exits upon error. """
@@ -214,6 +954,14 @@ def run():
       help="Takes requested action even if unit tests fail.")
   parser.add_argument("-t", "--travis", action="store_true",
       help="Handles unit testing properly for Travis CI.")
+  parser.add_argument("-a", "--all", action="store_true",
+      help="Runs every unit test, even ones whose code hasn't changed since"
+           " they last passed.")
+  parser.add_argument("-s", "--serial", action="store_true",
+      help="Runs the unit tests one after another in this process.")
+  parser.add_argument("-j", "--jobs", type=int,
+      help="How many processes to run unit tests in. Defaults to the number"
+           " of cores.")
   subparsers = parser.add_subparsers()
   test_parser = subparsers.add_parser("test",
       help="Runs the unit tests and exits.")
@@ -221,10 +969,20 @@ def run():
       help="Runs the dev server")
   update_parser = subparsers.add_parser("update",
       help="Updates the application on GAE.")
+  benchmark_parser = subparsers.add_parser("benchmark",
+      help="Measures how long the shared modules take to import.")
+  benchmark_parser.add_argument("--repeat", type=int, default=5,
+      help="How many times to repeat each measurement.")
+  benchmark_parser.add_argument("--max-time", type=float,
+      help="Fails if importing all the modules takes longer than this many"
+           " seconds.")
+  benchmark_parser.add_argument("--output",
+      help="A file to write the results to as JSON.")
 
   test_parser.set_defaults(func=run_tests)
   dev_server_parser.set_defaults(func=dev_server)
   update_parser.set_defaults(func=gae_update)
+  benchmark_parser.set_defaults(func=benchmark_imports)
 
   args, forward_args = parser.parse_known_args()
 
@@ -236,23 +994,21 @@ def run():
     print "Using GAE installation directory: %s" % (gae_installation)
 
     # Check that we have a reasonable version.
-    version_info = file(os.path.join(gae_installation, "VERSION")).read()
-    gae_version = version_info.split("\n")[0].lstrip("release: ")
-    gae_version = gae_version.strip("\"")
+    gae_version = sdk_version(gae_installation)
 
-    if not compare_versions(gae_version, GAE_OLDEST_SDK, ">="):
+    if not gae_version or \
+        not compare_versions(gae_version, GAE_OLDEST_SDK, ">="):
       print "ERROR: Found version %s of the GAE SDK. Please install at least" \
             " version %s." % (gae_version, GAE_OLDEST_SDK)
       os._exit(1)
 
   # Check for required packages. Pip can't be trusted to deal with
   # already-installed packages correctly, so we're going to install each one
-  # separately.
+  # separately, although not one after another.
   required = open("externals/externals.txt").read().split("\n")
-  for requirement in required:
-    if (requirement and not requirement.startswith("#")):
-      # Not a comment or vertical whitespace.
-      get_external(requirement)
+  # Skip comments and vertical whitespace.
+  get_externals([requirement for requirement in required \
+                 if (requirement and not requirement.startswith("#"))])
 
   # Do the requested action.
   exit_status = 0
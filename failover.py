@@ -0,0 +1,157 @@
+""" Durable failover copies of api responses
+
+The failover copy that api keeps in memcache is exactly what memcache evicts
+under pressure, or loses on a restart, and an outage is when we need it most.
+This keeps another copy of the last good response for each url in the
+datastore. It is only written when the content changes, and it is only read
+when memcache has nothing for the url at all.
+
+Copies are written with asynchronous puts that nothing waits for while the
+request is being handled. finish_saves() waits for them and records what was
+saved, so wrap the app to have that done once the response is finished:
+
+app = failover.middleware(webapp2.WSGIApplication(...))
+
+Otherwise the next save on the same thread does it. A put that fails, or whose
+result is never collected, just makes the next save write the copy again.
+
+"""
+import hashlib
+import logging
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+import codec
+import localcache
+
+# How long to remember the digest of a saved copy. Once it is forgotten, the
+# next save writes the copy again even if it hasn't changed, which also repairs
+# any write that failed.
+DIGEST_TTL = 86400
+
+# The saves each thread has started and not finished yet.
+_pending = threading.local()
+
+
+class FailoverCopy(db.Model):
+    """ The last good response for a url. The key name is a hash of the url,
+    since urls can be longer than key names are allowed to be. """
+    url = db.TextProperty()
+    content = db.BlobProperty()
+    digest = db.StringProperty(indexed=False)
+    updated = db.DateTimeProperty(auto_now=True, indexed=False)
+
+
+def _key_name(url):
+    return hashlib.sha1(url).hexdigest()
+
+
+def load(urls):
+    """ Reads the durable copies of urls with one batch get. Returns a dict
+    mapping the urls that have one to its content. """
+    urls = list(urls)
+    if not urls:
+        return {}
+    copies = FailoverCopy.get_by_key_name([_key_name(url) for url in urls])
+    loaded = {}
+    for url, copy in zip(urls, copies):
+        if copy is not None:
+            loaded[url] = codec.loads(str(copy.content))
+    if loaded:
+        logging.info("Loaded durable failover copies of %s." % loaded.keys())
+    return loaded
+
+
+class _Save(object):
+    """ A write of durable copies in progress """
+    def __init__(self, rpc, digests):
+        self.rpc = rpc
+        self.digests = digests
+
+    def get_result(self):
+        """ Waits for the write, and only then remembers the digests of what
+        was written, so that a failed write is retried by the next save.
+        Returns whether it succeeded. """
+        try:
+            self.rpc.get_result()
+        except (db.Error, apiproxy_errors.Error), e:
+            logging.error("Saving durable failover copies of %s failed: %s" %
+                          (self.digests.keys(), e))
+            return False
+        for url, digest in self.digests.iteritems():
+            localcache.set('failover', url, digest)
+        memcache.set_multi(self.digests, DIGEST_TTL,
+                           key_prefix='failover_digest:')
+        return True
+
+
+def _pending_saves():
+    saves = getattr(_pending, 'saves', None)
+    if saves is None:
+        saves = _pending.saves = []
+    return saves
+
+
+def finish_saves():
+    """ Waits for the saves this thread has started, and records the digests
+    of the ones that succeeded. Returns how many of them did. """
+    saves = _pending_saves()
+    finished = 0
+    while saves:
+        if saves.pop(0).get_result():
+            finished += 1
+    return finished
+
+
+def middleware(app):
+    """ Wraps a WSGI app so that the saves a request started are finished once
+    its response has been sent """
+    def wrapped(environ, start_response):
+        result = app(environ, start_response)
+        try:
+            for chunk in result:
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            finish_saves()
+    return wrapped
+
+
+def save(responses):
+    """ Starts writing the durable copies of responses, a dict mapping urls to
+    their content. Only the ones whose content has changed since they were
+    last saved are written, and the write is left running: see
+    finish_saves(). Returns None if nothing needs writing, otherwise the _Save
+    for it. """
+    # Earlier saves on this thread are most likely done by now, and their
+    # digests tell us what doesn't need writing again.
+    finish_saves()
+
+    encoded = {}
+    digests = {}
+    for url, resp in responses.iteritems():
+        encoded[url] = codec.dumps(resp)
+        digests[url] = hashlib.sha1(encoded[url]).hexdigest()
+
+    # Check the digests we last saved, in process first, then in memcache.
+    unknown = [url for url in responses
+               if localcache.get('failover', url) != digests[url]]
+    saved = memcache.get_multi(unknown, key_prefix='failover_digest:')
+    changed = [url for url in unknown if saved.get(url) != digests[url]]
+    for url in responses:
+        if url not in changed:
+            localcache.set('failover', url, digests[url])
+    if not changed:
+        return None
+
+    copies = [FailoverCopy(key_name=_key_name(url), url=url,
+                           content=db.Blob(encoded[url]), digest=digests[url])
+              for url in changed]
+    saving = _Save(db.put_async(copies),
+                   dict((url, digests[url]) for url in changed))
+    _pending_saves().append(saving)
+    return saving
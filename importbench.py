@@ -0,0 +1,121 @@
+""" Measures how long the shared modules take to import on a cold start.
+
+Each measurement is made in a fresh Python process with the GAE testbed
+already set up, so that only the cost of our modules and whatever they import
+beyond the testbed is counted. Every module is timed on its own, which is what
+it costs an instance that only needs that module, and then all of them are
+imported one after another, which is what they cost together. Each number is
+the median of several runs.
+
+Run it from the root of an app with:
+
+deploy.py benchmark
+
+or directly with:
+
+python shared/importbench.py /path/to/google_appengine """
+
+
+import os
+import subprocess
+import sys
+import time
+
+
+""" How many times to repeat each measurement. """
+REPEAT = 5
+
+
+""" Imports modules one after another in this process, which must be fresh.
+sdk_path: The path to the appengine sdk.
+modules: The names of the modules to import.
+Returns: A list of how long each import took, in seconds. """
+def time_imports(sdk_path, modules):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  # Where the shared package is.
+  sys.path.insert(0, os.path.dirname(os.path.dirname(
+      os.path.realpath(__file__))))
+
+  from google.appengine.ext import testbed
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_app_identity_stub()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_urlfetch_stub()
+
+  import importlib
+  times = []
+  for module in modules:
+    start = time.time()
+    importlib.import_module(module)
+    times.append(time.time() - start)
+
+  bed.deactivate()
+  return times
+
+""" Runs time_imports() in a new process.
+sdk_path: The path to the appengine sdk.
+modules: The names of the modules to import.
+Returns: A list of how long each import took, in seconds. """
+def time_cold_imports(sdk_path, modules):
+  output = subprocess.check_output([sys.executable,
+                                    os.path.realpath(__file__), "--child",
+                                    sdk_path] + list(modules))
+  return [float(line) for line in output.split()]
+
+""" Gets the middle of some numbers.
+values: The numbers.
+Returns: The median. """
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+""" Lists the modules of the shared package.
+Returns: Their full names. """
+def shared_modules():
+  shared_directory = os.path.dirname(os.path.realpath(__file__))
+  package = os.path.basename(shared_directory)
+  sys.path.insert(0, os.path.dirname(shared_directory))
+  modules = __import__(package).MODULES
+  return ["%s.%s" % (package, modules[name]) for name in sorted(modules)]
+
+""" Benchmarks importing the shared modules and prints a report.
+sdk_path: The path to the appengine sdk.
+repeat: How many times to repeat each measurement.
+Returns: A dict with how long each module took on its own under "modules", and
+how long they all took together under "total", in seconds. """
+def benchmark(sdk_path, repeat=REPEAT):
+  modules = shared_modules()
+
+  alone = {}
+  for module in modules:
+    alone[module] = median([time_cold_imports(sdk_path, [module])[0] \
+                            for _ in range(repeat)])
+
+  runs = [time_cold_imports(sdk_path, modules) for _ in range(repeat)]
+  together = [median(run[i] for run in runs) for i in range(len(modules))]
+  total = median(sum(run) for run in runs)
+
+  print "%-40s %10s %10s %12s" % ("Module", "Alone", "In order", "Cumulative")
+  cumulative = 0
+  for module, in_order in zip(modules, together):
+    cumulative += in_order
+    print "%-40s %8.1fms %8.1fms %10.1fms" % (module, alone[module] * 1000,
+                                            in_order * 1000, cumulative * 1000)
+  print "Importing all of them took %.1fms." % (total * 1000)
+
+  return {"modules": alone, "total": total}
+
+
+if __name__ == "__main__":
+  if sys.argv[1] == "--child":
+    for seconds in time_imports(sys.argv[2], sys.argv[3:]):
+      print seconds
+  else:
+    benchmark(sys.argv[1])
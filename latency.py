@@ -0,0 +1,161 @@
+""" Latency tracking and adaptive deadlines for upstream requests
+
+A fixed deadline is either too short for an app that is spinning up or much
+longer than needed when it's warm. Here we keep a histogram of observed
+latencies per endpoint and derive the deadline from it: the PERCENTILE latency
+times MULTIPLIER, clamped to the bounds the caller gives. Until an endpoint
+has MIN_SAMPLES samples, its deadline is the upper bound.
+
+Samples are collected in process and merged into memcache every
+MERGE_INTERVAL seconds, so all instances learn from each other. Memcache keeps
+them in windows of WINDOW seconds, and only the last WINDOWS of those count,
+so an endpoint that was slow for a while, say while its app was cold, gets a
+short deadline again once it has been fast for long enough.
+
+Usage:
+
+import latency
+
+endpoint = latency.endpoint(url)
+deadline = latency.deadline(endpoint, 1, 10)
+start = time.time()
+try:
+    resp = urlfetch.fetch(url, deadline=deadline)
+finally:
+    latency.record(endpoint, time.time() - start)
+
+"""
+import bisect
+import threading
+import time
+import urlparse
+
+from google.appengine.api import memcache
+
+# Upper bounds of the histogram buckets, in seconds. The last bucket takes
+# everything above the last bound.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 30, 60]
+PERCENTILE = 0.99
+MULTIPLIER = 2
+MIN_SAMPLES = 20
+MERGE_INTERVAL = 60
+# Shared samples are counted in windows of WINDOW seconds, and deadlines come
+# from the last WINDOWS windows.
+WINDOW = 300
+WINDOWS = 6
+# Default bounds for callers that don't have their own.
+MIN_DEADLINE = 1
+MAX_DEADLINE = 10
+
+
+def endpoint(url):
+    """ Returns the endpoint that url's latency is tracked under: its host and
+    path, without the query string """
+    parts = urlparse.urlparse(url)
+    return '%s%s' % (parts.netloc, parts.path)
+
+
+class Histogram(object):
+    def __init__(self, counts=None):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket the given fraction of samples
+        fall within """
+        target = fraction * self.total()
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                break
+        return BUCKETS[min(i, len(BUCKETS) - 1)]
+
+
+class LatencyTracker(object):
+    def __init__(self):
+        self._local = {}
+        self._shared = {}
+        self._loaded_at = {}
+        self._merged_at = time.time()
+        self._lock = threading.Lock()
+
+    def _keys(self, name, window):
+        return ['latency:%s:%d:%d' % (name, window, i)
+                for i in range(len(BUCKETS) + 1)]
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._local.setdefault(name, Histogram()).add(seconds)
+            merge = time.time() - self._merged_at >= MERGE_INTERVAL
+        if merge:
+            self.merge()
+
+    def merge(self):
+        """ Adds the samples collected in process to the shared histograms """
+        with self._lock:
+            local, self._local = self._local, {}
+            self._merged_at = time.time()
+        window = int(time.time() // WINDOW)
+        offsets = {}
+        for name, histogram in local.iteritems():
+            for key, count in zip(self._keys(name, window), histogram.counts):
+                if count:
+                    offsets[key] = count
+            # Make sure the next deadline() call sees them.
+            self._loaded_at.pop(name, None)
+        if offsets:
+            # Counters made by offset_multi never expire, so they are added
+            # with an expiry first.
+            memcache.add_multi(dict((key, 0) for key in offsets),
+                               time=WINDOW * (WINDOWS + 1))
+            memcache.offset_multi(offsets, initial_value=0)
+
+    def histogram(self, name):
+        """ Returns the combined histogram of the last WINDOWS shared windows
+        and the unmerged local samples for an endpoint """
+        now = time.time()
+        if now - self._loaded_at.get(name, 0) >= MERGE_INTERVAL:
+            current = int(now // WINDOW)
+            windows = [self._keys(name, window)
+                       for window in range(current - WINDOWS + 1, current + 1)]
+            shared = memcache.get_multi(
+                [key for keys in windows for key in keys])
+            self._shared[name] = [sum(shared.get(key) or 0 for key in bucket)
+                                  for bucket in zip(*windows)]
+            self._loaded_at[name] = now
+
+        with self._lock:
+            local = self._local.get(name)
+            counts = list(self._shared[name])
+            if local:
+                counts = [a + b for a, b in zip(counts, local.counts)]
+        return Histogram(counts)
+
+    def deadline(self, name, lower=MIN_DEADLINE, upper=MAX_DEADLINE):
+        """ Returns the deadline to use for a request to an endpoint """
+        histogram = self.histogram(name)
+        if histogram.total() < MIN_SAMPLES:
+            return upper
+        deadline = histogram.percentile(PERCENTILE) * MULTIPLIER
+        return max(lower, min(upper, deadline))
+
+    def reset(self):
+        with self._lock:
+            self._local.clear()
+            self._shared.clear()
+            self._loaded_at.clear()
+
+
+_tracker = LatencyTracker()
+
+record = _tracker.record
+merge = _tracker.merge
+histogram = _tracker.histogram
+deadline = _tracker.deadline
+reset = _tracker.reset
@@ -0,0 +1,233 @@
+""" Records upstream responses once and replays them from disk
+
+Tests that talk to other apps either fake them by hand or serve them from a
+real local server. A cassette instead sits behind urlfetch_intercept as a wsgi
+app: when recording, it passes each request on to the real host (or to a stub
+wsgi app) and appends the response to a file; when replaying, it answers from
+that file, which is memory mapped and indexed by a hash of the method, url and
+body of each request, so nothing is read until it is needed.
+
+Usage:
+
+from google.appengine.api import urlfetch
+import urlfetch_intercept
+from cassette import Cassette
+
+urlfetch_intercept.install()
+tape = Cassette('tests/cassettes/signup.cassette', mode=Cassette.NEW)
+with tape.intercept('hd-signup-hrd.appspot.com'):
+    resp = urlfetch.fetch('http://hd-signup-hrd.appspot.com/api/v1/user')
+...
+tape.close()
+
+Responses can be slowed down to simulate timeouts deterministically:
+
+tape.delay('http://hd-signup-hrd.appspot.com/api/*', 5)
+
+delays every matching request by five seconds, which is over any deadline a
+test is likely to use. Pass real_time=True to replay every response as slowly
+as it was recorded instead.
+
+"""
+
+import contextlib
+import fnmatch
+import hashlib
+import httplib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import wsgiref.util
+
+import urlfetch_intercept
+
+__all__ = ['Cassette', 'CassetteError']
+
+MAGIC = 'HDCASSETTE1\n'
+# Each record is this header, then the response headers as JSON, then the
+# response body. The header holds the request key, the status, how long the
+# response took when it was recorded, and the lengths of the two parts.
+_RECORD = struct.Struct('>20sHfII')
+
+# Headers that describe how the recorded response was sent, not what it is.
+_SKIPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+
+class CassetteError(LookupError):
+    """ Raised when replaying a request that was never recorded """
+
+
+def _key(method, url, body):
+    return hashlib.sha1('%s\n%s\n%s' % (method.upper(), url,
+                        hashlib.sha1(body).hexdigest())).digest()
+
+
+class Cassette(object):
+    # Only replay, and fail on requests that weren't recorded.
+    REPLAY = 'replay'
+    # Replay what was recorded and record anything new.
+    NEW = 'new'
+    # Record every request again.
+    RECORD = 'record'
+
+    def __init__(self, path, mode=REPLAY, upstream=None, latency=0,
+                 real_time=False):
+        """ path: The cassette file.
+        mode: One of REPLAY, NEW or RECORD.
+        upstream: A wsgi app to record from instead of the real hosts.
+        latency: How long to delay every replayed response, in seconds.
+        real_time: Whether to delay responses by as long as they took when they
+                   were recorded instead. """
+        self.path = path
+        self.mode = mode
+        self.upstream = upstream
+        self.latency = latency
+        self.real_time = real_time
+        self._delays = []
+        self._lock = threading.Lock()
+        self._index = {}
+        self._recorded = {}
+        self._map = None
+        self._file = None
+        self._load()
+
+    def _load(self):
+        """ Maps the cassette file and indexes its records by request key.
+        Only the record headers are read; bodies are sliced from the map when
+        they are replayed. """
+        if not os.path.exists(self.path) or \
+                os.path.getsize(self.path) <= len(MAGIC):
+            return
+        with open(self.path, 'rb') as cassette_file:
+            self._map = mmap.mmap(cassette_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a cassette' % self.path)
+        offset = len(MAGIC)
+        while offset + _RECORD.size <= len(self._map):
+            key, status, elapsed, headers_length, body_length = \
+                _RECORD.unpack_from(self._map, offset)
+            headers_offset = offset + _RECORD.size
+            body_offset = headers_offset + headers_length
+            # Later records of the same request replace earlier ones.
+            self._index[key] = (status, elapsed, headers_offset,
+                                headers_length, body_offset, body_length)
+            offset = body_offset + body_length
+
+    def _lookup(self, key):
+        """ Returns the status, recorded latency, headers and body of the
+        response recorded for key, or None """
+        if key in self._recorded:
+            return self._recorded[key]
+        if key not in self._index:
+            return None
+        status, elapsed, headers_offset, headers_length, body_offset, \
+            body_length = self._index[key]
+        headers = json.loads(
+            self._map[headers_offset:headers_offset + headers_length])
+        body = self._map[body_offset:body_offset + body_length]
+        return status, elapsed, headers, body
+
+    def _write(self, key, status, elapsed, headers, body):
+        """ Appends a record to the cassette file and keeps it in memory until
+        the cassette is loaded again """
+        encoded_headers = json.dumps(headers, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                new = not os.path.exists(self.path) or \
+                    os.path.getsize(self.path) == 0
+                self._file = open(self.path, 'ab')
+                if new:
+                    self._file.write(MAGIC)
+            self._file.write(_RECORD.pack(key, status, elapsed,
+                                          len(encoded_headers), len(body)))
+            self._file.write(encoded_headers)
+            self._file.write(body)
+            self._file.flush()
+            self._recorded[key] = (status, elapsed, headers, body)
+
+    def delay(self, pattern, seconds):
+        """ Delays replayed responses to urls matching pattern, a shell-style
+        wildcard pattern, by seconds. The last matching delay wins. """
+        self._delays.append((pattern, seconds))
+
+    def _delay_for(self, url, elapsed):
+        for pattern, seconds in reversed(self._delays):
+            if fnmatch.fnmatchcase(url, pattern):
+                return seconds
+        if self.real_time:
+            return elapsed
+        return self.latency
+
+    def _record(self, method, url, headers, body):
+        start = time.time()
+        if self.upstream is not None:
+            response = urlfetch_intercept._app_fetch(
+                self.upstream, url, body, method, headers)
+        else:
+            response = urlfetch_intercept.original_fetch(
+                url, body, method, headers, follow_redirects=False)
+        elapsed = time.time() - start
+        response_headers = [[name, value] for name, value in
+                            response.headers.items()
+                            if name.lower() not in _SKIPPED_HEADERS]
+        self._write(_key(method, url, body), response.status_code, elapsed,
+                    response_headers, response.content)
+        return response.status_code, response_headers, response.content
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        url = wsgiref.util.request_uri(environ)
+        body = environ['wsgi.input'].read(
+            int(environ.get('CONTENT_LENGTH') or 0))
+
+        entry = self._lookup(_key(method, url, body))
+        if entry is None or self.mode == self.RECORD:
+            if self.mode == self.REPLAY:
+                raise CassetteError('%s has no response to %s %s' %
+                                    (self.path, method, url))
+            headers = dict((key[5:].replace('_', '-').title(), value)
+                           for key, value in environ.iteritems()
+                           if key.startswith('HTTP_') and key != 'HTTP_HOST')
+            if environ.get('CONTENT_TYPE'):
+                headers['Content-Type'] = environ['CONTENT_TYPE']
+            status, headers, body = self._record(method, url, headers, body)
+        else:
+            status, elapsed, headers, body = entry
+            delay = self._delay_for(url, elapsed)
+            if delay:
+                time.sleep(delay)
+
+        start_response('%d %s' % (status, httplib.responses.get(status, '')),
+                       [(str(name), str(value)) for name, value in headers])
+        return [body]
+
+    @contextlib.contextmanager
+    def intercept(self, *hosts):
+        """ Answers requests to hosts from this cassette until the end of the
+        with block, in a urlfetch_intercept scope """
+        with urlfetch_intercept.scope():
+            for host in hosts:
+                urlfetch_intercept.add_intercept(host, self)
+            yield self
+
+    def __len__(self):
+        return len(set(self._index) | set(self._recorded))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -14,6 +14,10 @@ which is primarily to make it harder for people with admin access to easily
 see keys. It's assumed admins are mostly trusted, the encryption is just a 
 layer of obfuscation. If you can't hash a password, at least obfuscate it!
 
+Secrets are cached, encrypted in memcache and decrypted in each instance, so
+calling get() inline is cheap. To get several at once, use get_many(), which
+loads whatever isn't cached with one datastore call.
+
 Using the API is just importing and then using the get function:
 
 from shared import keymaster
@@ -23,16 +27,15 @@ descrypted_password = keymaster.get('some_service:api_key')
 In the case where you might be getting a new access token periodically, say
 with cron.yaml, you can also use keymaster.set(key, secret)
 
+Every set() saves a new version of the secret and makes it current. Older
+ones can still be read with get(key, version=n), and Keymaster.use_version()
+makes one current again.
+
 """
 import os
-import urllib
 
 from google.appengine.api import memcache
-from google.appengine.api import urlfetch
-from google.appengine.api import users
 from google.appengine.ext import db
-from google.appengine.ext import webapp
-from google.appengine.ext.webapp import util
 
 try:
     from shared.utils import RedirectException
@@ -40,70 +43,258 @@ except ImportError:
     from utils import RedirectException
 
 try:
-    from Crypto.Cipher import ARC4
+    from shared import localcache
 except ImportError:
+    import localcache
+
+class _PassThrough:
     # Just pass through in dev mode
-    class ARC4:
-        new = classmethod(lambda k,x: ARC4)
-        encrypt = classmethod(lambda k,x: x)
-        decrypt = classmethod(lambda k,x: x)
+    new = classmethod(lambda k,x: _PassThrough)
+    encrypt = classmethod(lambda k,x: x)
+    decrypt = classmethod(lambda k,x: x)
+
+_ARC4 = None
+def _arc4():
+    """ Imports the cipher the first time a secret is used, instead of when
+    this module is """
+    global _ARC4
+    if _ARC4 is None:
+        try:
+            from Crypto.Cipher import ARC4
+        except ImportError:
+            ARC4 = _PassThrough
+        _ARC4 = ARC4
+    return _ARC4
+
+# Generation of the key that secrets are encrypted with. To rotate it, bump
+# this, deploy, and run reencrypt() (or POST to /_km/reencrypt) to move every
+# stored secret over. Each entity records the generation it was encrypted with,
+# so secrets stay readable while that runs.
+CIPHER_GENERATION = 0
+REENCRYPT_BATCH_SIZE = 100
+# How many entities to re-encrypt per transaction. Cross-group transactions
+# can't span more than 25 entity groups.
+REENCRYPT_TRANSACTION_SIZE = 25
+
+# Seconds to keep encrypted secrets in memcache for. A read that races a set()
+# can cache the old secret again after invalidate() has run, so an instance
+# can see a stale secret for up to this plus localcache's 'keymaster' TTL.
+MEMCACHE_TTL = 600
+
+def _cipher(generation):
+    if generation == 0:
+        return _arc4().new(os.environ['APPLICATION_ID'])
+    return _arc4().new('%s:%d' % (os.environ['APPLICATION_ID'], generation))
 
 class Keymaster(db.Model):
+    """ The current version of a secret. Older versions are kept as
+    KeymasterVersion children, but the current one is copied here so that
+    reading it is a single get by key name. """
     secret  = db.BlobProperty(required=True)
+    version = db.IntegerProperty(default=0)
+    cipher = db.IntegerProperty(default=0)
     
     @classmethod
     def encrypt(cls, key_name, secret):
-        secret  = ARC4.new(os.environ['APPLICATION_ID']).encrypt(secret)
-        k = cls.get_by_key_name(key_name)
-        if k:
-            k.secret = str(secret)
-        else:
-            k = cls(key_name=str(key_name), secret=str(secret))
-        return k.put()
+        """ Saves secret as a new version of key_name and makes it current """
+        key_name = str(key_name)
+        secret = str(_cipher(CIPHER_GENERATION).encrypt(secret))
+        def txn():
+            k = cls.get_by_key_name(key_name)
+            to_put = []
+            if k:
+                if k.version == 0:
+                    # Keep the secret from before there were versions.
+                    to_put.append(KeymasterVersion(parent=k, key_name='v0',
+                        secret=k.secret, cipher=k.cipher))
+                k.version += 1
+            else:
+                k = cls(key_name=key_name, secret=secret, version=1)
+            k.secret = secret
+            k.cipher = CIPHER_GENERATION
+            to_put.append(KeymasterVersion(parent=k,
+                key_name='v%d' % k.version, secret=secret,
+                cipher=CIPHER_GENERATION))
+            db.put([k] + to_put)
+            return k.key()
+        key = db.run_in_transaction(txn)
+        invalidate(key_name)
+        return key
     
+    @classmethod
+    def encrypt_if_missing(cls, key_name, secret):
+        """ Saves secret as key_name unless key_name already has a secret, in
+        a transaction so that callers racing to create it all end up with the
+        same one. Returns the secret that key_name has. """
+        key_name = str(key_name)
+        encrypted = str(_cipher(CIPHER_GENERATION).encrypt(secret))
+        def txn():
+            k = cls.get_by_key_name(key_name)
+            if k:
+                return k.cipher, str(k.secret)
+            k = cls(key_name=key_name, secret=encrypted, version=1,
+                    cipher=CIPHER_GENERATION)
+            db.put([k, KeymasterVersion(parent=k, key_name='v1',
+                secret=encrypted, cipher=CIPHER_GENERATION)])
+            return CIPHER_GENERATION, encrypted
+        generation, stored = db.run_in_transaction(txn)
+        invalidate(key_name)
+        return _cipher(generation).encrypt(stored)
+
     @classmethod
     def decrypt(cls, key_name):
+        secrets = cls.decrypt_many([key_name])
+        if key_name not in secrets:
+            raise RedirectException('/_km/key/%s' % key_name, "Keymaster has no secret for %s" % key_name)
+        return secrets[key_name]
+
+    @classmethod
+    def decrypt_many(cls, key_names):
+        """ Decrypts the current versions of several secrets, looking for them
+        in the instance cache, then memcache, which only ever holds them
+        encrypted, and then the datastore with one batch get. Names with no
+        secret are left out of the returned dict. """
+        key_names = [str(key_name) for key_name in key_names]
+        secrets = {}
+        missing = []
+        for key_name in key_names:
+            secret = localcache.get('keymaster', key_name)
+            if secret is not None:
+                secrets[key_name] = secret
+            else:
+                missing.append(key_name)
+        if not missing:
+            return secrets
+
+        encrypted = memcache.get_multi(missing, key_prefix='keymaster:')
+        missing = [key_name for key_name in missing if key_name not in encrypted]
+        if missing:
+            loaded = {}
+            for key_name, k in zip(missing, cls.get_by_key_name(missing)):
+                if k is not None:
+                    loaded[key_name] = (k.cipher, str(k.secret))
+            memcache.set_multi(loaded, time=MEMCACHE_TTL,
+                               key_prefix='keymaster:')
+            encrypted.update(loaded)
+
+        for key_name, cached in encrypted.iteritems():
+            if isinstance(cached, str):
+                # Cached before secrets were versioned.
+                cached = (0, cached)
+            generation, secret = cached
+            secret = _cipher(generation).encrypt(secret)
+            localcache.set('keymaster', key_name, secret)
+            secrets[key_name] = secret
+        return secrets
+
+    @classmethod
+    def versions(cls, key_name):
+        """ Returns the version numbers saved for key_name, oldest first """
         k = cls.get_by_key_name(str(key_name))
         if k is None:
-            raise RedirectException('/_km/key/%s' % key_name, "Keymaster has no secret for %s" % key_name)
-        return ARC4.new(os.environ['APPLICATION_ID']).encrypt(k.secret)
+            return []
+        return sorted(int(key.name()[1:]) for key in
+                      KeymasterVersion.all(keys_only=True).ancestor(k))
+
+    @classmethod
+    def decrypt_version(cls, key_name, version):
+        v = KeymasterVersion.get_by_key_name('v%d' % version,
+            parent=db.Key.from_path(cls.kind(), str(key_name)))
+        if v is None:
+            raise RedirectException('/_km/key/%s' % key_name, "Keymaster has no version %d of %s" % (version, key_name))
+        return _cipher(v.cipher).encrypt(v.secret)
+
+    @classmethod
+    def use_version(cls, key_name, version):
+        """ Makes an older version of key_name current again """
+        key_name = str(key_name)
+        def txn():
+            k = cls.get_by_key_name(key_name)
+            v = k and KeymasterVersion.get_by_key_name('v%d' % version, parent=k)
+            if v is None:
+                raise ValueError("Keymaster has no version %d of %s" % (version, key_name))
+            k.secret, k.cipher, k.version = v.secret, v.cipher, version
+            k.put()
+        db.run_in_transaction(txn)
+        invalidate(key_name)
+
+class KeymasterVersion(db.Model):
+    """ One version of a secret, as a child of its Keymaster entity """
+    secret = db.BlobProperty(required=True)
+    cipher = db.IntegerProperty(default=0)
+    created = db.DateTimeProperty(auto_now_add=True)
 
-def get(key):
+def _reencrypt_group(keys):
+    """ Re-encrypts the entities with keys in one cross-group transaction, so
+    that a secret saved while this runs is never overwritten with the old one.
+    keys can be in at most REENCRYPT_TRANSACTION_SIZE entity groups. Returns
+    the keys of the entities that needed re-encrypting. """
+    def txn():
+        changed = []
+        for entity in db.get(keys):
+            if entity is None or entity.cipher == CIPHER_GENERATION:
+                continue
+            secret = _cipher(entity.cipher).encrypt(entity.secret)
+            entity.secret = str(_cipher(CIPHER_GENERATION).encrypt(secret))
+            entity.cipher = CIPHER_GENERATION
+            changed.append(entity)
+        if changed:
+            db.put(changed)
+        return [entity.key() for entity in changed]
+    options = db.create_transaction_options(xg=True)
+    return db.run_in_transaction_options(options, txn)
+
+def reencrypt(kind='Keymaster', cursor=None):
+    """ Re-encrypts every stored secret that isn't encrypted with the current
+    CIPHER_GENERATION, one batch of entities at a time. Each batch is re-read
+    and saved in a few cross-group transactions, with one get and one put
+    each, and the job continues on the task queue from the cursor, first over
+    the Keymaster entities and then their versions. """
+    model = Keymaster if kind == 'Keymaster' else KeymasterVersion
+    query = model.all(keys_only=True)
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(REENCRYPT_BATCH_SIZE)
+
+    size = REENCRYPT_TRANSACTION_SIZE
+    changed = []
+    for i in range(0, len(batch), size):
+        changed.extend(_reencrypt_group(batch[i:i + size]))
+    if changed and model is Keymaster:
+        memcache.delete_multi([key.name() for key in changed],
+                              key_prefix='keymaster:')
+
+    from google.appengine.ext import deferred
+    if len(batch) == REENCRYPT_BATCH_SIZE:
+        deferred.defer(reencrypt, kind, query.cursor())
+    elif model is Keymaster:
+        deferred.defer(reencrypt, 'KeymasterVersion')
+
+def get(key, version=None):
+    if version is not None:
+        return Keymaster.decrypt_version(key, version)
     return Keymaster.decrypt(key)
 
+def get_many(keys):
+    return Keymaster.decrypt_many(keys)
+
 def set(key, secret):
     Keymaster.encrypt(key, secret)
 
-class KeymasterHandler(webapp.RequestHandler):
-    @util.login_required
-    def get(self, key=None):
-        if users.is_current_user_admin():
-            if key:
-                key = urllib.unquote(key)
-                self.response.out.write("""<html><body><form method="post">
-                    <input type="hidden" name="key" value="%(key)s" />
-                    Need a key for <strong>%(key)s</strong>: <input type="text" name="secret" /> <input type="submit" value="Save" /></form></body></html>""" % locals())
-            else:
-                self.response.out.write("""<html><body><form method="post">
-                    Key name: <input type="text" name="key" /><br />
-                    Key secret: <input type="text" name="secret" /> <input type="submit" value="Save" /></form></body></html>""")
-        else:
-            self.redirect('/')
-        
-    def post(self, key=None):
-        if users.is_current_user_admin():
-            Keymaster.encrypt(self.request.get('key'), self.request.get('secret'))
-            self.response.out.write("Saved: %s" % Keymaster.decrypt(self.request.get('key')))
-        else:
-            self.redirect('/')
+def get_or_set(key, secret):
+    return Keymaster.encrypt_if_missing(key, secret)
+
+def invalidate(key):
+    """ Drops the cached copies of a secret. Other instances keep theirs until
+    it expires from their instance cache. """
+    localcache.invalidate('keymaster', str(key))
+    memcache.delete('keymaster:%s' % key)
 
 def main():
-    application = webapp.WSGIApplication([
-        ('/_km/key', KeymasterHandler),
-        ('/_km/key/(.+)', KeymasterHandler),
-        ],debug=True)
-    util.run_wsgi_app(application)
+    # The admin pages live in their own module, so that reading secrets never
+    # has to import webapp.
+    import keymaster_handlers
+    keymaster_handlers.main()
 
 if __name__ == '__main__':
     main()
-
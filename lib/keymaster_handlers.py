@@ -0,0 +1,62 @@
+""" The admin pages for keymaster
+
+They are kept out of keymaster itself so that apps that only read secrets
+don't import webapp. See keymaster for how to route them.
+
+"""
+import urllib
+
+from google.appengine.api import users
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+import keymaster
+from keymaster import Keymaster
+
+try:
+    from shared.utils import install_redirect_handler
+except ImportError:
+    from utils import install_redirect_handler
+
+class KeymasterHandler(webapp.RequestHandler):
+    @util.login_required
+    def get(self, key=None):
+        if users.is_current_user_admin():
+            if key:
+                key = urllib.unquote(key)
+                self.response.out.write("""<html><body><form method="post">
+                    <input type="hidden" name="key" value="%(key)s" />
+                    Need a key for <strong>%(key)s</strong>: <input type="text" name="secret" /> <input type="submit" value="Save" /></form></body></html>""" % locals())
+            else:
+                self.response.out.write("""<html><body><form method="post">
+                    Key name: <input type="text" name="key" /><br />
+                    Key secret: <input type="text" name="secret" /> <input type="submit" value="Save" /></form></body></html>""")
+        else:
+            self.redirect('/')
+        
+    def post(self, key=None):
+        if users.is_current_user_admin():
+            Keymaster.encrypt(self.request.get('key'), self.request.get('secret'))
+            self.response.out.write("Saved: %s" % Keymaster.decrypt(self.request.get('key')))
+        else:
+            self.redirect('/')
+
+class ReencryptHandler(webapp.RequestHandler):
+    def post(self):
+        if users.is_current_user_admin():
+            keymaster.reencrypt()
+            self.response.out.write("Re-encrypting secrets with cipher generation %d." % keymaster.CIPHER_GENERATION)
+        else:
+            self.redirect('/')
+
+def main():
+    install_redirect_handler()
+    application = webapp.WSGIApplication([
+        ('/_km/key', KeymasterHandler),
+        ('/_km/key/(.+)', KeymasterHandler),
+        ('/_km/reencrypt', ReencryptHandler),
+        ],debug=True)
+    util.run_wsgi_app(application)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 """ Monkey patch to hit wsgi apps when using urlfetch
 
 This will monkey patch App Engine's urlfetch.fetch with a fetch that hits a local
-wsgi app registered with add_intercept. This module is inspired by and borrows 
+wsgi app registered with add_intercept. This module is inspired by and borrows
 code from the wsgi-intercept project, which doesn't work with App Engine.
 
 This is intended only for the local SDK environment for unit tests.
@@ -16,101 +16,424 @@ urlfetch_intercept.add_intercept('example.com', my_wsgi_app)
 resp = urlfetch.fetch("http://example.com/foo")
 ...
 
+Intercepts can also be added inside a scope, which only lasts until the end of
+the with block and is only seen by the thread that made it, so tests running
+in parallel threads don't see each other's intercepts:
+
+with urlfetch_intercept.scope():
+    urlfetch_intercept.add_intercept('*.example.com:8080', my_wsgi_app)
+    ...
+
+Hosts are matched with their port first, then without it, then against
+wildcards for each of their parent domains. Fetches to hosts that aren't
+intercepted go out as usual.
+
+Asynchronous fetches with urlfetch.create_rpc and urlfetch.make_fetch_call
+are intercepted too. If they have a deadline, the apps they hit run
+concurrently in their own threads, and the deadline counts from when the fetch
+was made. Without one, the app runs in make_fetch_call.
+
+Pass stream=True to get a response whose content is only read from the app
+when it is first used. Its iter_content() yields the app's output chunk by
+chunk without ever joining it. A deadline is honored by running the app in
+another thread and raising urlfetch.DeadlineExceededError if it doesn't
+finish in time.
+
 """
 
+import contextlib
+import cStringIO
+import sys
+import threading
+import time
 import urllib
 import urlparse
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch
 from google.appengine.api.urlfetch import fetch as original_fetch
+from google.appengine.api.urlfetch import create_rpc as original_create_rpc
+from google.appengine.api.urlfetch import \
+    make_fetch_call as original_make_fetch_call
 import webob
+from webob.headers import ResponseHeaders
 
-__all__ = ['install', 'uninstall', 'add_intercept', 'remove_intercept']
+__all__ = ['install', 'uninstall', 'add_intercept', 'remove_intercept',
+           'scope']
+
+original_wait_any = apiproxy_stub_map.UserRPC.__dict__['wait_any']
 
 def install():
     urlfetch.fetch = wsgi_fetch
+    urlfetch.create_rpc = create_rpc
+    urlfetch.make_fetch_call = make_fetch_call
+    apiproxy_stub_map.UserRPC.wait_any = classmethod(wait_any)
 
 def uninstall():
     urlfetch.fetch = original_fetch
-    
-_intercepts = {}
-def add_intercept(host, app):
-    _intercepts[host] = app
+    urlfetch.create_rpc = original_create_rpc
+    urlfetch.make_fetch_call = original_make_fetch_call
+    apiproxy_stub_map.UserRPC.wait_any = original_wait_any
 
-def remove_intercept(host):
-    del _intercepts[host]
 
-def wsgi_fetch(url, payload=None, method=urlfetch.GET, headers={},
-          allow_truncated=False, follow_redirects=True,
-          deadline=None):
+class _Registry(object):
+    """ Maps hosts to the apps that intercept them. Intercepts added inside a
+    scope belong to the thread that opened it; the rest are global. """
+    def __init__(self):
+        self._global = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
-    url = urlparse.urlparse(url)
-    app = _intercepts[url.netloc]
-    
-    req = webob.Request.blank(url.path)
-    req.method = method
-    for header in headers:
-        req.headers[header] = headers[header]
-    if payload:
-        if isinstance(payload, str):
-            req.body = payload
+    def _scopes(self):
+        scopes = getattr(self._local, 'scopes', None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+    def push(self):
+        self._scopes().append({})
+
+    def pop(self):
+        self._scopes().pop()
+
+    def add(self, host, app):
+        scopes = self._scopes()
+        if scopes:
+            scopes[-1][host] = app
         else:
-            req.body = urllib.urlencode(payload)
-
-    resp = {}
-    resp['content_was_truncated'] = False
-    resp['final_url'] = url
-    
-    write_results = []
-    def start_response(status, headers, exc_info=None):
-        resp['status_code'] = status
-        resp['headers'] = headers
-
-        def write_fn(s):
-            write_results.append(s)
-        return write_fn
-    
-    # run the application.
-    app_result = app(req.environ, start_response)
-    result = iter(app_result)
-    
-    ###
-    
-    # read all of the results.  the trick here is to get the *first*
-    # bit of data from the app via the generator, *then* grab & return
-    # the data passed back from the 'write' function, and then return
-    # the generator data.  this is because the 'write' fn doesn't
-    # necessarily get called until the first result is requested from
-    # the app function.
-    #
-    # see twill tests, 'test_wrapper_intercept' for a test that breaks
-    # if this is done incorrectly.
-    output = []
+            with self._lock:
+                self._global[host] = app
+
+    def remove(self, host):
+        scopes = self._scopes()
+        if scopes and host in scopes[-1]:
+            del scopes[-1][host]
+        else:
+            with self._lock:
+                del self._global[host]
+
+    def lookup(self, netloc):
+        """ Returns the app intercepting netloc, or None """
+        candidates = _candidates(netloc)
+        with self._lock:
+            mappings = list(reversed(self._scopes())) + [dict(self._global)]
+        for mapping in mappings:
+            for candidate in candidates:
+                if candidate in mapping:
+                    return mapping[candidate]
+        return None
+
+
+def _candidates(netloc):
+    """ Returns the registered hosts that could match netloc, most specific
+    first """
+    host, _, port = netloc.partition(':')
+    names = [host]
+    parts = host.split('.')
+    names.extend('*.' + '.'.join(parts[i:]) for i in range(1, len(parts)))
+    candidates = []
+    for name in names:
+        if port:
+            candidates.append('%s:%s' % (name, port))
+        candidates.append(name)
+    return candidates
+
+
+_registry = _Registry()
+
+def add_intercept(host, app):
+    _registry.add(host, app)
+    _base_environs.pop(host, None)
+
+def remove_intercept(host):
+    _registry.remove(host)
+    _base_environs.pop(host, None)
+
+@contextlib.contextmanager
+def scope():
+    """ Intercepts added inside this block are only seen by this thread, and
+    are removed at the end of it """
+    _registry.push()
     try:
-        generator_data = None
+        yield
+    finally:
+        _registry.pop()
+
+# Environ dicts with everything that is the same for all requests to a host,
+# which are copied for each request instead of being built from scratch.
+_base_environs = {}
+def _base_environ(host):
+    environ = _base_environs.get(host)
+    if environ is None:
+        environ = webob.Request.blank('/').environ
+        environ['HTTP_HOST'] = host
+        name, _, port = host.partition(':')
+        environ['SERVER_NAME'] = name
+        environ['SERVER_PORT'] = port or '80'
+        for key in ('PATH_INFO', 'QUERY_STRING', 'CONTENT_LENGTH',
+                    'CONTENT_TYPE', 'wsgi.input'):
+            environ.pop(key, None)
+        _base_environs[host] = environ
+    return environ
+
+_method_names = {
+    urlfetch.GET: 'GET', urlfetch.POST: 'POST', urlfetch.HEAD: 'HEAD',
+    urlfetch.PUT: 'PUT', urlfetch.DELETE: 'DELETE',
+}
+if hasattr(urlfetch, 'PATCH'):
+    # Older SDKs don't have it.
+    _method_names[urlfetch.PATCH] = 'PATCH'
+
+def _make_environ(url, method, headers, payload):
+    environ = _base_environ(url.netloc).copy()
+    environ['REQUEST_METHOD'] = _method_names.get(method, method)
+    if url.scheme == 'https':
+        environ['wsgi.url_scheme'] = 'https'
+        environ['HTTPS'] = 'on'
+    environ['PATH_INFO'] = urllib.unquote(url.path) or '/'
+    environ['QUERY_STRING'] = url.query
+    for header, value in headers.iteritems():
+        key = header.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value
+    if payload and not isinstance(payload, str):
+        payload = urllib.urlencode(payload)
+    payload = payload or ''
+    environ['CONTENT_LENGTH'] = str(len(payload))
+    environ['wsgi.input'] = cStringIO.StringIO(payload)
+    return environ
+
+
+class _AppOutput(object):
+    """ Runs a wsgi app and hands out its output.
+
+    The trick here is to get the *first* bit of data from the app via the
+    generator, *then* grab & return the data passed back from the 'write'
+    function, and then return the generator data. This is because the 'write'
+    fn doesn't necessarily get called until the first result is requested
+    from the app function.
+
+    See twill tests, 'test_wrapper_intercept' for a test that breaks if this is
+    done incorrectly. """
+    def __init__(self, app, environ):
+        self.status = None
+        self.headers = None
+        self._written = []
+        self._first = []
+        self._app_result = app(environ, self._start_response)
+        self._result = iter(self._app_result)
         try:
-            generator_data = result.next()
-    
+            self._first.append(self._result.next())
+        except StopIteration:
+            self._result = None
+
+    def _start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+        return self._written.append
+
+    def chunks(self):
+        """ Yields the output of the app in order, then closes it """
+        try:
+            for chunk in self._written:
+                yield chunk
+            for chunk in self._first:
+                yield chunk
+            if self._result is not None:
+                for chunk in self._result:
+                    yield chunk
         finally:
-            for data in write_results:
-                output.append(data)
-    
-        if generator_data:
-            output.append(generator_data)
-    
-            while 1:
-                data = result.next()
-                output.append(data)
-                
-    except StopIteration:
-        pass
-    
-    resp['content'] = ''.join(output)
-    
-    if hasattr(app_result, 'close'):
-        app_result.close()
-    
-    class dictob(object):
-        def __init__(self, d):
-            self.__dict__ = d
-    return dictob(resp)
+            self.close()
+
+    def read(self):
+        """ Returns all the output of the app """
+        output = cStringIO.StringIO()
+        for chunk in self.chunks():
+            output.write(chunk)
+        return output.getvalue()
+
+    def close(self):
+        if hasattr(self._app_result, 'close'):
+            self._app_result.close()
+            self._app_result = None
+
+
+class _Response(object):
+    """ Looks like the response from urlfetch.fetch. If it was created with a
+    stream of content, the content isn't read until it is first used. """
+    def __init__(self, url, output, content=None):
+        self.final_url = url
+        self.content_was_truncated = False
+        self.status_code = int(output.status.split(' ', 1)[0])
+        self.headers = ResponseHeaders(output.headers)
+        self._output = output
+        self._content = content
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self._output.read()
+        return self._content
+
+    def iter_content(self):
+        """ Yields the content chunk by chunk, without joining it, unless it
+        has already been read """
+        if self._content is not None:
+            return iter([self._content])
+        return self._output.chunks()
+
+
+def _run_with_deadline(function, deadline):
+    """ Runs function in another thread and returns its result, raising
+    urlfetch.DeadlineExceededError if it takes longer than deadline """
+    outcome = {}
+    def run():
+        try:
+            outcome['result'] = function()
+        except Exception:
+            outcome['error'] = sys.exc_info()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(deadline)
+    if thread.is_alive():
+        raise urlfetch.DeadlineExceededError(
+            'Intercepted app did not respond within %s seconds' % deadline)
+    if 'error' in outcome:
+        raise outcome['error'][0], outcome['error'][1], outcome['error'][2]
+    return outcome['result']
+
+
+def _app_fetch(app, url, payload=None, method=urlfetch.GET, headers={},
+               stream=False):
+    """ Runs a request through app and returns the response """
+    final_url = url
+    url = urlparse.urlparse(url)
+    output = _AppOutput(app, _make_environ(url, method, headers, payload))
+    if stream:
+        return _Response(final_url, output)
+    return _Response(final_url, output, output.read())
+
+
+def wsgi_fetch(url, payload=None, method=urlfetch.GET, headers={},
+          allow_truncated=False, follow_redirects=True,
+          deadline=None, validate_certificate=None, stream=False):
+
+    app = _registry.lookup(urlparse.urlparse(url).netloc)
+    if app is None:
+        return original_fetch(url, payload, method, headers, allow_truncated,
+                              follow_redirects, deadline, validate_certificate)
+
+    def run():
+        return _app_fetch(app, url, payload, method, headers, stream)
+
+    if deadline:
+        # When streaming, the deadline covers the app starting to respond.
+        return _run_with_deadline(run, deadline)
+    return run()
+
+
+class _InterceptRpc(object):
+    """ Stands in for the RPC from urlfetch.create_rpc. If the fetch made with
+    it is intercepted, the app runs in its own thread when there is a deadline
+    and right away when there isn't, otherwise this hands everything to a real
+    RPC. """
+    def __init__(self, deadline=None, callback=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.real = None
+        self._done = threading.Event()
+        self._started = None
+        self._result = None
+        self._error = None
+        self._finished = False
+
+    def _start(self, app, url, args, kwargs):
+        kwargs = dict(kwargs)
+        for unused in ('allow_truncated', 'follow_redirects',
+                       'validate_certificate'):
+            kwargs.pop(unused, None)
+        def run():
+            try:
+                self._result = _app_fetch(app, url, *args[:3], **kwargs)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._done.set()
+        self._started = time.time()
+        if not self.deadline:
+            run()
+            return
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _timed_out(self):
+        return self.deadline and not self._done.is_set() and \
+            time.time() - self._started >= self.deadline
+
+    def wait(self):
+        if self.real is not None:
+            return self.real.wait()
+        if self._finished:
+            return
+        timeout = None
+        if self.deadline:
+            timeout = max(0, self.deadline - (time.time() - self._started))
+        if not self._done.wait(timeout):
+            self._error = (urlfetch.DeadlineExceededError,
+                urlfetch.DeadlineExceededError(
+                    'Intercepted app did not respond within %s seconds' %
+                    self.deadline), None)
+        self._finished = True
+        if self.callback:
+            self.callback()
+
+    def check_success(self):
+        if self.real is not None:
+            return self.real.check_success()
+        self.wait()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def get_result(self):
+        if self.real is not None:
+            return self.real.get_result()
+        self.check_success()
+        return self._result
+
+
+def create_rpc(deadline=None, callback=None):
+    return _InterceptRpc(deadline, callback)
+
+
+def make_fetch_call(rpc, url, *args, **kwargs):
+    if not isinstance(rpc, _InterceptRpc):
+        return original_make_fetch_call(rpc, url, *args, **kwargs)
+    app = _registry.lookup(urlparse.urlparse(url).netloc)
+    if app is None:
+        rpc.real = original_create_rpc(rpc.deadline, rpc.callback)
+        original_make_fetch_call(rpc.real, url, *args, **kwargs)
+    else:
+        rpc._start(app, url, args, kwargs)
+    return rpc
+
+
+def wait_any(cls, rpcs):
+    """ Replaces UserRPC.wait_any so that it also understands intercepted
+    RPCs. Those are waited for before any real ones. """
+    rpcs = list(rpcs)
+    intercepted = [rpc for rpc in rpcs
+                   if isinstance(rpc, _InterceptRpc) and rpc.real is None]
+    if not intercepted:
+        real = dict((getattr(rpc, 'real', None) or rpc, rpc) for rpc in rpcs)
+        finished = original_wait_any.__get__(None, cls)(real.keys())
+        return real.get(finished)
+
+    while True:
+        for rpc in intercepted:
+            if rpc._done.is_set() or rpc._timed_out():
+                rpc.wait()
+                return rpc
+        time.sleep(0.001)
@@ -0,0 +1,115 @@
+""" In-process cache layered in front of memcache
+
+Memcache is shared across instances, but every lookup is still an RPC. Data
+that is the same for thousands of requests within one instance can be kept
+here instead, in a bounded LRU cache whose entries expire after a per-namespace
+TTL. Keep the TTLs short: other instances can't invalidate this cache, so
+anything written elsewhere is only seen here once the local copy expires.
+
+Usage:
+
+import localcache
+
+value = localcache.get('api', url)
+if value is None:
+    value = expensive_lookup(url)
+    localcache.set('api', url, value)
+
+localcache.invalidate('api', url)
+
+Values other than strings and numbers are stored pickled, and every get()
+returns a new copy of them, so callers can't change what other requests see.
+
+"""
+import collections
+import cPickle
+import threading
+import time
+
+# Seconds to keep entries for, by namespace.
+TTLS = {
+    'api': 60,
+    'user_data': 300,
+    # Secrets are also cached in memcache for keymaster.MEMCACHE_TTL.
+    'keymaster': 600,
+}
+DEFAULT_TTL = 60
+MAX_SIZE = 2000
+
+# Values that can't be changed in place, which are stored as they are.
+_IMMUTABLE = (basestring, int, long, float, bool, type(None))
+
+
+class LocalCache(object):
+    """ A thread-safe LRU cache with per-namespace TTLs and hit/miss stats """
+    def __init__(self, max_size=MAX_SIZE, ttls=None, default_ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttls = ttls if ttls is not None else TTLS
+        self.default_ttl = default_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict(
+            lambda: {'hits': 0, 'misses': 0, 'evictions': 0})
+
+    def get(self, namespace, key):
+        """ Returns the cached value, or None if it's missing or expired """
+        now = time.time()
+        with self._lock:
+            stats = self._stats[namespace]
+            entry = self._entries.pop((namespace, key), None)
+            if entry is None or entry[0] <= now:
+                stats['misses'] += 1
+                return None
+            # Re-inserting marks it as the most recently used.
+            self._entries[(namespace, key)] = entry
+            stats['hits'] += 1
+        _, value, pickled = entry
+        if pickled:
+            return cPickle.loads(value)
+        return value
+
+    def set(self, namespace, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttls.get(namespace, self.default_ttl)
+        pickled = not isinstance(value, _IMMUTABLE)
+        if pickled:
+            value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+            self._entries[(namespace, key)] = (time.time() + ttl, value,
+                                               pickled)
+            while len(self._entries) > self.max_size:
+                (evicted, _), _ = self._entries.popitem(last=False)
+                self._stats[evicted]['evictions'] += 1
+
+    def invalidate(self, namespace, key=None):
+        """ Drops key from namespace, or the whole namespace if key is None """
+        with self._lock:
+            if key is not None:
+                self._entries.pop((namespace, key), None)
+                return
+            for entry_key in [k for k in self._entries if k[0] == namespace]:
+                del self._entries[entry_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+
+    def stats(self):
+        """ Returns a dict of hit, miss and eviction counts by namespace, plus
+        the current size of the cache """
+        with self._lock:
+            stats = dict((namespace, dict(counts))
+                         for namespace, counts in self._stats.items())
+            stats['size'] = len(self._entries)
+            return stats
+
+
+_cache = LocalCache()
+
+get = _cache.get
+set = _cache.set
+invalidate = _cache.invalidate
+clear = _cache.clear
+stats = _cache.stats
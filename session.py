@@ -0,0 +1,70 @@
+""" Signed, expiring cookie values.
+
+These let a handler trust what it stored in a cookie without asking anyone
+else: the contents are readable by the client, but can't be changed or kept
+past their expiry without invalidating the signature. """
+
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+
+""" Compares two strings in constant time, so that the time it takes doesn't
+give away how much of a signature was right.
+a: The first string.
+b: The second string.
+Returns: True if they are equal, False otherwise. """
+def _equal(a, b):
+  if len(a) != len(b):
+    return False
+
+  result = 0
+  for x, y in zip(a, b):
+    result |= ord(x) ^ ord(y)
+  return result == 0
+
+""" Signs a payload.
+payload: The string to sign.
+key: The secret key to sign it with.
+Returns: The hex signature. """
+def _sign(payload, key):
+  return hmac.new(str(key), payload, hashlib.sha256).hexdigest()
+
+""" Encodes data into a signed cookie value.
+data: The data to store. Must be serializable as JSON.
+key: The secret key to sign it with.
+lifetime: How many seconds the value should be valid for.
+Returns: The cookie value. """
+def encode(data, key, lifetime):
+  contents = json.dumps({"data": data, "expires": int(time.time() + lifetime)},
+                        separators=(",", ":"))
+  payload = base64.urlsafe_b64encode(contents)
+  return "%s.%s" % (payload, _sign(payload, key))
+
+""" Decodes a cookie value created by encode().
+value: The cookie value.
+key: The secret key it was signed with.
+Returns: The stored data, or None if the value is malformed, has a bad
+signature, or has expired. """
+def decode(value, key):
+  try:
+    payload, signature = str(value).rsplit(".", 1)
+  except ValueError:
+    return None
+
+  if not _equal(_sign(payload, key), signature):
+    logging.warning("Got cookie value with a bad signature.")
+    return None
+
+  try:
+    contents = json.loads(base64.urlsafe_b64decode(payload))
+  except (TypeError, ValueError):
+    return None
+
+  if contents["expires"] < time.time():
+    return None
+  return contents["data"]
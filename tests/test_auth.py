@@ -9,6 +9,7 @@ import unittest
 import urllib
 
 from google.appengine.api import memcache
+from google.appengine.api import urlfetch
 from google.appengine.ext import testbed
 
 import webapp2
@@ -16,6 +17,9 @@ import webapp2
 import webtest
 
 from .. import auth
+from .. import codec
+from .. import localcache
+from ..lib import keymaster
 
 
 """ Class for creating simulated responses from the signup application for
@@ -52,6 +56,36 @@ class SignupSimulator(auth.ResponseFactory):
     return self.responses.pop(0)
 
 
+""" Like SignupSimulator, but asynchronous. It keeps a log of when requests are
+started and when their results are collected, so tests can check what was done
+concurrently. """
+class AsyncSignupSimulator(SignupSimulator):
+  """ A fake urlfetch RPC. """
+  class FakeRpc:
+    def __init__(self, simulator, url, response):
+      self.simulator = simulator
+      self.url = url
+      self.response = response
+
+    def wait(self):
+      pass
+
+    def get_result(self):
+      self.simulator.log.append(("finish", self.url))
+      return self.response
+
+  def __init__(self):
+    SignupSimulator.__init__(self)
+    self.log = []
+
+  def get_response(self, url, *args, **kwargs):
+    return self.get_response_async(url, *args, **kwargs).get_result()
+
+  def get_response_async(self, url, *args, **kwargs):
+    self.log.append(("start", url))
+    return self.FakeRpc(self, url, self.responses.pop(0))
+
+
 """ A handler subclass expressly for the purpose of testing the login_required
 handler. """
 class LoginRequiredTestHandler(auth.AuthHandler):
@@ -93,6 +127,7 @@ class AuthHandlerTest(unittest.TestCase):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
     self.testbed.init_memcache_stub()
+    localcache.clear()
 
     # Some values that we will use for a fake auth cookie.
     self.auth_cookie_values = json.dumps({"user": 1,
@@ -165,7 +200,7 @@ class AuthHandlerTest(unittest.TestCase):
 
     # Check that it's cached.
     cookie_values = json.loads(self.auth_cookie_values)
-    cached = memcache.get("user_data.%s" % cookie_values["user"])
+    cached = codec.get("user_data.%s" % cookie_values["user"])
     self.assertEqual(user_info, cached)
 
   """ Tests that current_user handles no user being logged in correctly. """
@@ -190,3 +225,159 @@ class AuthHandlerTest(unittest.TestCase):
     self.assertEqual(200, response.status_int)
     new_user_info = json.loads(response.body)
     self.assertEqual(user_info, new_user_info)
+
+  """ Tests that a validated token is cached, so later requests don't need the
+  signup app. """
+  def test_token_cache(self):
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    self.signup_app.set_response(json.dumps({"valid": True}))
+
+    response = self.test_app.get("/test_login_required")
+    self.assertEqual("okay", response.body)
+
+    # No more responses queued, so this has to come from the cache.
+    response = self.test_app.get("/test_login_required")
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("okay", response.body)
+
+  """ Tests that invalid tokens are cached too. """
+  def test_invalid_token_cache(self):
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    self.signup_app.set_response(json.dumps({"valid": False}))
+
+    for _ in range(2):
+      response = self.test_app.get("/test_login_required")
+      self.assertEqual(302, response.status_int)
+      self.assertIn("/login", response.location)
+
+  """ Tests that coming back from a logout revokes the cached token. """
+  def test_logout_revokes_token(self):
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    self.signup_app.set_response(json.dumps({"valid": True}))
+    self.test_app.get("/test_login_required")
+
+    response = self.test_app.get("/test_login_required?logged_out=1")
+    self.assertEqual(302, response.status_int)
+    self.assertNotIn("logged_out", response.location)
+
+    cookie_values = json.loads(self.auth_cookie_values)
+    key = auth.AuthHandler._token_cache_key(cookie_values["user"],
+                                            cookie_values["token"])
+    self.assertEqual(None, memcache.get(key))
+
+  """ Tests that a signed session cookie lets us validate the user and get their
+  data without memcache or the signup app. """
+  def test_signed_session(self):
+    self.testbed.init_datastore_v3_stub()
+    auth.AuthHandler.SIGNED_SESSIONS = True
+    try:
+      self.test_app.set_cookie("auth", self.auth_cookie_values)
+      self.signup_app.set_response(json.dumps({"valid": True}))
+      user_info = {"first_name": "Testy", "email": "testy.testerson@gmail.com",
+                   "created": "2015-01-01"}
+      self.signup_app.set_response(json.dumps(user_info))
+
+      response = self.test_app.get("/test_current_user")
+      self.assertEqual(user_info, json.loads(response.body))
+      self.assertIn("auth_session", self.test_app.cookies)
+
+      # Nothing queued and nothing cached, so it has to use the session.
+      memcache.flush_all()
+      localcache.clear()
+      response = self.test_app.get("/test_current_user")
+      del user_info["created"]
+      self.assertEqual(user_info, json.loads(response.body))
+
+      # A tampered session is ignored.
+      value = self.test_app.cookies["auth_session"]
+      tampered = value[:-1] + ("1" if value.endswith("0") else "0")
+      self.test_app.cookiejar.clear()
+      self.test_app.set_cookie("auth", self.auth_cookie_values)
+      self.test_app.set_cookie("auth_session", tampered)
+      self.signup_app.set_response(json.dumps({"valid": False}))
+      self.signup_app.set_response(json.dumps(user_info))
+      response = self.test_app.get("/test_current_user")
+      self.assertEqual("", response.body)
+    finally:
+      auth.AuthHandler.SIGNED_SESSIONS = False
+
+  """ Tests that the session signing key is only ever created once. """
+  def test_session_key(self):
+    self.testbed.init_datastore_v3_stub()
+    key = auth.AuthHandler._session_key()
+    self.assertEqual(key, auth.AuthHandler._session_key())
+    # Another instance that missed it still gets the same key.
+    self.assertEqual(key, keymaster.get_or_set(
+        auth.AuthHandler.SESSION_KEY_NAME_, "other"))
+
+  """ Tests getting data for several users at once. """
+  def test_get_users(self):
+    cached_info = {"email": "cached@gmail.com"}
+    memcache.set("user_data.1", cached_info)
+    fetched_info = {"email": "fetched@gmail.com"}
+    self.signup_app.set_response(json.dumps(fetched_info))
+    self.signup_app.set_response("", status=404)
+
+    users = auth.AuthHandler.get_users([1, 2, 3])
+
+    self.assertEqual(cached_info, users[1])
+    self.assertEqual(1, len([user for user in users.values() \
+                             if user == fetched_info]))
+    self.assertEqual(1, users.values().count(None))
+
+    # Only the successful fetch should have been cached.
+    cached = codec.get_multi(["user_data.2", "user_data.3"])
+    self.assertEqual([fetched_info], cached.values())
+
+  """ Tests that on a cold cache, current_user validates the user and fetches
+  their data concurrently. """
+  def test_concurrent_fetch(self):
+    async_app = AsyncSignupSimulator()
+    auth.AuthHandler.URL_FETCHER = async_app
+
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    async_app.set_response(json.dumps({"valid": True}))
+    user_info = {"email": "testy.testerson@gmail.com"}
+    async_app.set_response(json.dumps(user_info))
+
+    response = self.test_app.get("/test_current_user")
+    self.assertEqual(user_info, json.loads(response.body))
+
+    events = [event for event, url in async_app.log]
+    self.assertEqual(["start", "start", "finish", "finish"], events)
+    self.assertIn("validate_token", async_app.log[0][1])
+    self.assertIn("api/v1/user", async_app.log[1][1])
+
+  """ Tests that no user data is fetched for a token that is cached as
+  invalid. """
+  def test_invalid_token_prefetch(self):
+    async_app = AsyncSignupSimulator()
+    auth.AuthHandler.URL_FETCHER = async_app
+
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    # On a cold cache, the data is fetched while the token is validated.
+    async_app.set_response(json.dumps({"valid": False}))
+    async_app.set_response(json.dumps({"email": "testy.testerson@gmail.com"}))
+    self.test_app.get("/test_current_user")
+    del async_app.log[:]
+
+    # Nothing is queued, so any fetch would fail.
+    response = self.test_app.get("/test_current_user")
+    self.assertEqual("", response.body)
+    self.assertEqual([], async_app.log)
+
+  """ Tests that a failed prefetch of user data gives no user instead of an
+  error. """
+  def test_failed_prefetch(self):
+    class FailingSimulator(SignupSimulator):
+      def get_response_async(self, url, *args, **kwargs):
+        if "api/v1/user" in url:
+          return auth.FinishedRpc(error=urlfetch.DownloadError())
+        return SignupSimulator.get_response_async(self, url, *args, **kwargs)
+    auth.AuthHandler.URL_FETCHER = FailingSimulator()
+    auth.AuthHandler.URL_FETCHER.set_response(json.dumps({"valid": True}))
+
+    self.test_app.set_cookie("auth", self.auth_cookie_values)
+    response = self.test_app.get("/test_current_user")
+    self.assertEqual(200, response.status_int)
+    self.assertEqual("", response.body)
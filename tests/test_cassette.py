@@ -0,0 +1,87 @@
+""" Tests for cassette.py. """
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.appengine.api import urlfetch
+
+from ..lib import urlfetch_intercept
+from ..lib.cassette import Cassette, CassetteError
+
+
+class CassetteTest(unittest.TestCase):
+  def setUp(self):
+    urlfetch_intercept.install()
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, "test.cassette")
+    self.upstream_calls = 0
+
+  def tearDown(self):
+    urlfetch_intercept.uninstall()
+    shutil.rmtree(self.directory)
+
+  """ A stub upstream app that counts its calls. """
+  def __upstream(self, environ, start_response):
+    self.upstream_calls += 1
+    body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"] or 0))
+    start_response("200 OK", [("Content-Type", "application/json")])
+    return ["[\"%s\", \"%s\"]" % (environ["PATH_INFO"], body)]
+
+  """ Tests that responses are recorded once and replayed after that. """
+  def test_record_replay(self):
+    with Cassette(self.path, Cassette.NEW, upstream=self.__upstream) as tape:
+      with tape.intercept("upstream.example.com"):
+        response = urlfetch.fetch("http://upstream.example.com/a",
+                                  payload="x", method=urlfetch.POST)
+        self.assertEqual("[\"/a\", \"x\"]", response.content)
+        urlfetch.fetch("http://upstream.example.com/a", payload="x",
+                       method=urlfetch.POST)
+        urlfetch.fetch("http://upstream.example.com/b")
+    self.assertEqual(2, self.upstream_calls)
+
+    with Cassette(self.path) as tape:
+      self.assertEqual(2, len(tape))
+      with tape.intercept("upstream.example.com"):
+        response = urlfetch.fetch("http://upstream.example.com/a",
+                                  payload="x", method=urlfetch.POST)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/json",
+                         response.headers.get("content-type"))
+        self.assertEqual("[\"/a\", \"x\"]", response.content)
+        self.assertEqual("[\"/b\", \"\"]",
+            urlfetch.fetch("http://upstream.example.com/b").content)
+
+        # A different body is a different request.
+        self.assertRaises(CassetteError, urlfetch.fetch,
+                          "http://upstream.example.com/a", payload="y",
+                          method=urlfetch.POST)
+    self.assertEqual(2, self.upstream_calls)
+
+  """ Tests that RECORD mode records requests again. """
+  def test_rerecord(self):
+    with Cassette(self.path, Cassette.NEW, upstream=self.__upstream) as tape:
+      with tape.intercept("upstream.example.com"):
+        urlfetch.fetch("http://upstream.example.com/a")
+    with Cassette(self.path, Cassette.RECORD,
+                  upstream=self.__upstream) as tape:
+      with tape.intercept("upstream.example.com"):
+        urlfetch.fetch("http://upstream.example.com/a")
+      self.assertEqual(1, len(tape))
+    self.assertEqual(2, self.upstream_calls)
+
+  """ Tests that delayed responses time out. """
+  def test_delay(self):
+    with Cassette(self.path, Cassette.NEW, upstream=self.__upstream) as tape:
+      with tape.intercept("upstream.example.com"):
+        urlfetch.fetch("http://upstream.example.com/slow")
+        urlfetch.fetch("http://upstream.example.com/fast")
+
+        tape.delay("http://upstream.example.com/slow*", 0.5)
+        self.assertRaises(urlfetch.DeadlineExceededError, urlfetch.fetch,
+                          "http://upstream.example.com/slow", deadline=0.1)
+        response = urlfetch.fetch("http://upstream.example.com/fast",
+                                  deadline=0.1)
+        self.assertEqual("[\"/fast\", \"\"]", response.content)
@@ -0,0 +1,56 @@
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from .. import codec
+
+
+""" Tests for codec.py. """
+class CodecTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    codec.CHUNK_SIZE = 1000000 - 2048
+
+  """ Tests that values survive encoding, and large ones get compressed. """
+  def test_round_trip(self):
+    small = {"name": "Testy", "groups": ["a", "b"]}
+    self.assertEqual(small, codec.loads(codec.dumps(small)))
+
+    large = [{"id": i, "name": "Member %d" % i} for i in range(1000)]
+    encoded = codec.dumps(large)
+    self.assertLess(len(encoded), len(str(large)) / 4)
+    self.assertEqual(large, codec.loads(encoded))
+
+  """ Tests that values JSON can't represent exactly come back as they were.
+  """
+  def test_exact_round_trip(self):
+    for value in [{1: ("a",)}, ("a", "b"), "\xff\xfe", [{"a": "\xff"}]]:
+      self.assertEqual(value, codec.loads(codec.dumps(value)))
+      self.assertEqual(type(value), type(codec.loads(codec.dumps(value))))
+
+  """ Tests that values stored directly with memcache are still readable. """
+  def test_plain_values(self):
+    memcache.set("plain", ["cached"])
+    self.assertEqual(["cached"], codec.get("plain"))
+
+  """ Tests that values too large for one item are split and reassembled. """
+  def test_chunking(self):
+    codec.CHUNK_SIZE = 100
+    value = [str(i) * 50 for i in range(100)]
+    codec.set_multi({"big": value, "small": [1]}, key_prefix="data:")
+
+    self.assertEqual({"big": value, "small": [1]},
+                     codec.get_multi(["big", "small", "missing"],
+                                     key_prefix="data:"))
+
+    # Losing a chunk loses the value, rather than returning part of it.
+    header = memcache.get("data:big")
+    digest, count = codec.json.loads(header[len(codec.MAGIC) + 1:])
+    memcache.delete("data:big:chunk:%s:%d" % (digest, count - 1))
+    self.assertEqual(None, codec.get("data:big"))
@@ -0,0 +1,60 @@
+import unittest
+
+from google.appengine.ext import testbed
+
+from .. import config
+
+
+""" Tests for config.py. """
+class ConfigTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    config.reset()
+
+  def tearDown(self):
+    config.HOT_RELOAD = False
+    config.DEFAULT_SETTINGS.clear()
+    config.reset()
+    self.testbed.deactivate()
+
+  """ Tests that the configuration is only worked out once. """
+  def test_snapshot(self):
+    snapshot = config.get()
+    self.assertTrue(snapshot.is_testing)
+    self.assertFalse(snapshot.is_prod)
+    self.assertEqual("testbed-test", snapshot.app_name)
+    self.assertIs(snapshot, config.get())
+    self.assertRaises(AttributeError, setattr, snapshot, "is_prod", True)
+
+    # The old interface still works.
+    self.assertTrue(config.Config().is_testing)
+    self.assertEqual("testbed-test", config.Config().APP_NAME)
+
+  """ Tests that overrides are only picked up when hot reloading. """
+  def test_hot_reload(self):
+    config.set_defaults(greeting="hello", color="red")
+    self.assertEqual("hello", config.get().get("greeting"))
+    self.assertEqual(None, config.get().get("missing"))
+
+    config.set_overrides(greeting="hi")
+    self.assertEqual("hello", config.get().get("greeting"))
+
+    config.HOT_RELOAD = True
+    snapshot = config.get()
+    self.assertEqual("hi", snapshot.get("greeting"))
+    self.assertEqual("red", snapshot.get("color"))
+    self.assertEqual(1, snapshot.version)
+
+    # Nothing is checked again until the interval is up.
+    config.set_overrides(greeting="hey")
+    self.assertIs(snapshot, config.get())
+    config._checked = 0
+    self.assertEqual("hey", config.get().get("greeting"))
+    # Nor reloaded if the version is the same.
+    snapshot = config.get()
+    config._checked = 0
+    self.assertIs(snapshot, config.get())
@@ -0,0 +1,144 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+from .. import deploy
+
+
+""" Tests for the test selection in deploy.py. """
+class DeployTest(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.project = tempfile.mkdtemp()
+    os.chdir(self.project)
+
+    self.write("pkg/__init__.py",
+               "MODULES = {\"first\": \"first\", \"second\": \"lib.second\"}\n")
+    self.write("pkg/first.py", "")
+    self.write("pkg/lib/__init__.py", "")
+    self.write("pkg/lib/second.py", "import helper\n")
+    self.write("pkg/lib/helper.py", "")
+    self.write("pkg/tests/__init__.py", "")
+    self.write("pkg/tests/test_first.py", "from .. import first\n")
+    self.write("pkg/tests/test_all.py", "import pkg\n")
+
+    self.sdk = os.path.join(self.project, ".sdk")
+    self.write(".sdk/VERSION", "release: \"1.9.40\"\ntimestamp: 0\n")
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.project)
+    sys.modules.pop("pkg.tests.test_first", None)
+
+  def write(self, path, contents):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    with open(path, "w") as out_file:
+      out_file.write(contents)
+    # Makes sure the index notices the change even within the mtime's
+    # resolution.
+    os.utime(path, (0, os.stat(path).st_mtime + 1))
+
+  def index(self):
+    return deploy.index_files({"files": {}, "green": {}})
+
+  """ Tests that imports through a lazy package resolve to its modules. """
+  def test_lazy_imports(self):
+    files = self.index()
+
+    self.assertEqual(["pkg/first.py"],
+                     files["pkg/tests/test_first.py"]["imports"])
+    # A plain import of the package can use any of its modules.
+    self.assertEqual(["pkg/__init__.py", "pkg/first.py",
+                      "pkg/lib/__init__.py", "pkg/lib/second.py"],
+                     files["pkg/tests/test_all.py"]["imports"])
+    # Python 2 tries imports relative to the package first.
+    self.assertEqual(["pkg/lib/helper.py"],
+                     files["pkg/lib/second.py"]["imports"])
+
+  """ Tests that the dependency hash changes with everything a test depends
+  on, and only with that. """
+  def test_dependency_hash(self):
+    def dependency_hash(path):
+      files = self.index()
+      environment = deploy.environment_hash(files, self.sdk)
+      return deploy.dependency_hash(path, files, environment)
+
+    first = dependency_hash("pkg/tests/test_first.py")
+    every = dependency_hash("pkg/tests/test_all.py")
+
+    # Only test_all.py imports helper.py, indirectly.
+    self.write("pkg/lib/helper.py", "VALUE = 1\n")
+    self.assertEqual(first, dependency_hash("pkg/tests/test_first.py"))
+    self.assertNotEqual(every, dependency_hash("pkg/tests/test_all.py"))
+
+    # Every test depends on the externals, the SDK and files that aren't
+    # Python.
+    for path, contents in ((deploy.EXTERNALS_LOCK, "webapp2 abc\n"),
+                           ("templates/page.html", "<p></p>\n"),
+                           (".sdk/VERSION", "release: \"1.9.50\"\n")):
+      self.write(path, contents)
+      changed = dependency_hash("pkg/tests/test_first.py")
+      self.assertNotEqual(first, changed, path)
+      first = changed
+
+  """ Tests that tests are only selected until they pass with their current
+  dependencies. """
+  def test_select_tests(self):
+    module = types.ModuleType("pkg.tests.test_first")
+    module.__file__ = os.path.join(self.project, "pkg/tests/test_first.py")
+    sys.modules[module.__name__] = module
+
+    class FirstTest(unittest.TestCase):
+      def test(self):
+        pass
+    FirstTest.__module__ = module.__name__
+    suite = unittest.TestSuite([FirstTest("test")])
+
+    index = {"files": {}, "green": {}}
+    selected, hashes = deploy.select_tests([suite], index, self.sdk)
+    self.assertEqual(1, selected[0].countTestCases())
+
+    index["green"].update(hashes)
+    selected, _ = deploy.select_tests([suite], index, self.sdk)
+    self.assertEqual(0, selected[0].countTestCases())
+
+    self.write(deploy.EXTERNALS_LOCK, "webapp2 abc\n")
+    selected, _ = deploy.select_tests([suite], index, self.sdk)
+    self.assertEqual(1, selected[0].countTestCases())
+
+  """ Tests that the longest tests are spread between the shards. """
+  def test_make_shards(self):
+    durations = {"a": 4, "b": 3, "c": 2, "d": 2}
+    self.assertEqual([["a"], ["b", "e"], ["c", "d"]],
+                     deploy.make_shards(["a", "b", "c", "d", "e"], durations,
+                                        3))
+    self.assertEqual([["a"]], deploy.make_shards(["a"], durations, 3))
+
+  """ Tests that a failed install lets the others finish and then exits with
+  an error. """
+  def test_external_failure(self):
+    os.mkdir("externals")
+    finished = []
+    def get_external(external, installed=None):
+      if external.startswith("broken"):
+        raise deploy.ExternalError("Installation of 'broken' failed.")
+      time.sleep(0.1)
+      finished.append(external)
+      return {}
+
+    original = deploy.get_external
+    deploy.get_external = get_external
+    try:
+      with self.assertRaises(SystemExit) as context:
+        deploy.get_externals(["broken == 1", "webapp2 == 2.5.2"])
+    finally:
+      deploy.get_external = original
+    self.assertEqual(1, context.exception.code)
+    self.assertEqual(["webapp2 == 2.5.2"], finished)
+    self.assertFalse(os.path.exists(deploy.EXTERNALS_LOCK))
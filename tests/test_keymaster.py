@@ -1 +1,89 @@
-# Stub for keymaster tests
\ No newline at end of file
+""" Tests for keymaster.py. """
+
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from .. import localcache
+from ..lib import keymaster
+
+
+class KeymasterTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    localcache.clear()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that secrets can be saved and read back. """
+  def test_get_set(self):
+    keymaster.set("test:key", "secret")
+    self.assertEqual("secret", keymaster.get("test:key"))
+
+    self.assertRaises(keymaster.RedirectException, keymaster.get,
+                      "test:missing")
+
+  """ Tests that secrets are cached, and that setting them clears the cache. """
+  def test_cache(self):
+    keymaster.set("test:key", "secret")
+    keymaster.get("test:key")
+    self.assertEqual("secret", localcache.get("keymaster", "test:key"))
+    self.assertNotEqual(None, memcache.get("keymaster:test:key"))
+
+    # Cached copies are used even if the datastore changes underneath.
+    keymaster.Keymaster.get_by_key_name("test:key").delete()
+    self.assertEqual("secret", keymaster.get("test:key"))
+
+    keymaster.set("test:key", "new secret")
+    self.assertEqual("new secret", keymaster.get("test:key"))
+
+  """ Tests getting several secrets at once. """
+  def test_get_many(self):
+    keymaster.set("test:key", "secret")
+    keymaster.set("test:other_key", "other secret")
+    keymaster.get("test:key")
+
+    self.assertEqual({"test:key": "secret", "test:other_key": "other secret"},
+                     keymaster.get_many(["test:key", "test:other_key",
+                                         "test:missing"]))
+
+  """ Tests that every set() keeps a new version of the secret. """
+  def test_versions(self):
+    keymaster.set("test:key", "first")
+    keymaster.set("test:key", "second")
+
+    self.assertEqual([1, 2], keymaster.Keymaster.versions("test:key"))
+    self.assertEqual("second", keymaster.get("test:key"))
+    self.assertEqual("first", keymaster.get("test:key", version=1))
+
+    keymaster.Keymaster.use_version("test:key", 1)
+    self.assertEqual("first", keymaster.get("test:key"))
+
+  """ Tests that secrets can be moved to a new cipher generation. """
+  def test_reencrypt(self):
+    self.testbed.init_taskqueue_stub()
+    keymaster.set("test:key", "secret")
+    keymaster.set("test:other_key", "other secret")
+    keymaster.CIPHER_GENERATION = 1
+    # So that it takes more than one transaction.
+    keymaster.REENCRYPT_TRANSACTION_SIZE = 1
+    try:
+      keymaster.reencrypt()
+      keymaster.reencrypt("KeymasterVersion")
+
+      self.assertEqual(1, keymaster.Keymaster.get_by_key_name("test:key").cipher)
+      self.assertEqual([1, 1], [v.cipher for v in
+                                keymaster.KeymasterVersion.all()])
+      localcache.clear()
+      self.assertEqual("secret", keymaster.get("test:key"))
+      self.assertEqual("secret", keymaster.get("test:key", version=1))
+      self.assertEqual("other secret", keymaster.get("test:other_key"))
+    finally:
+      keymaster.CIPHER_GENERATION = 0
+      keymaster.REENCRYPT_TRANSACTION_SIZE = 25
@@ -0,0 +1,75 @@
+import time
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from .. import latency
+
+
+""" Tests for latency.py. """
+class LatencyTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+    self.tracker = latency.LatencyTracker()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  """ Tests that percentiles come from the right buckets. """
+  def test_percentile(self):
+    histogram = latency.Histogram()
+    for _ in range(98):
+      histogram.add(0.2)
+    histogram.add(4)
+    histogram.add(4)
+
+    self.assertEqual(100, histogram.total())
+    self.assertEqual(0.25, histogram.percentile(0.5))
+    self.assertEqual(5, histogram.percentile(0.99))
+
+  """ Tests that the deadline follows observed latency within its bounds. """
+  def test_deadline(self):
+    # Not enough samples yet.
+    self.tracker.record("example.com/", 0.2)
+    self.assertEqual(10, self.tracker.deadline("example.com/", 1, 10))
+
+    for _ in range(latency.MIN_SAMPLES):
+      self.tracker.record("example.com/", 0.2)
+    # 0.25 * MULTIPLIER is below the lower bound.
+    self.assertEqual(1, self.tracker.deadline("example.com/", 1, 10))
+
+    for _ in range(latency.MIN_SAMPLES):
+      self.tracker.record("example.com/", 3.5)
+    self.assertEqual(5 * latency.MULTIPLIER,
+                     self.tracker.deadline("example.com/", 1, 60))
+    self.assertEqual(8, self.tracker.deadline("example.com/", 1, 8))
+
+  """ Tests that samples are shared through memcache. """
+  def test_merge(self):
+    for _ in range(latency.MIN_SAMPLES):
+      self.tracker.record("example.com/", 0.75)
+    self.tracker.merge()
+
+    other = latency.LatencyTracker()
+    self.assertEqual(latency.MIN_SAMPLES,
+                     other.histogram("example.com/").total())
+    self.assertEqual(latency.MULTIPLIER,
+                     other.deadline("example.com/", 1, 10))
+
+  """ Tests that samples from old windows stop counting. """
+  def test_window(self):
+    old = int(time.time() // latency.WINDOW) - latency.WINDOWS
+    memcache.set("latency:example.com/:%d:%d" % (old, len(latency.BUCKETS)),
+                 latency.MIN_SAMPLES)
+    self.assertEqual(0, self.tracker.histogram("example.com/").total())
+
+    for _ in range(latency.MIN_SAMPLES):
+      self.tracker.record("example.com/", 0.75)
+    self.tracker.merge()
+    other = latency.LatencyTracker()
+    self.assertEqual(latency.MIN_SAMPLES,
+                     other.histogram("example.com/").total())
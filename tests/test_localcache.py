@@ -0,0 +1,63 @@
+import time
+import unittest
+
+from .. import localcache
+
+
+""" Tests for localcache.py. """
+class LocalCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.cache = localcache.LocalCache(max_size=2, ttls={"short": 0.1},
+                                       default_ttl=60)
+
+  """ Tests that values can be stored, read and invalidated. """
+  def test_get_set(self):
+    self.assertEqual(None, self.cache.get("api", "a"))
+    self.cache.set("api", "a", [1])
+    self.assertEqual([1], self.cache.get("api", "a"))
+    # Namespaces are separate.
+    self.assertEqual(None, self.cache.get("user_data", "a"))
+
+    self.cache.invalidate("api", "a")
+    self.assertEqual(None, self.cache.get("api", "a"))
+
+    stats = self.cache.stats()
+    self.assertEqual(1, stats["api"]["hits"])
+    self.assertEqual(2, stats["api"]["misses"])
+
+  """ Tests that entries expire after their namespace's TTL. """
+  def test_ttl(self):
+    self.cache.set("short", "a", 1)
+    self.cache.set("long", "a", 2)
+    time.sleep(0.2)
+    self.assertEqual(None, self.cache.get("short", "a"))
+    self.assertEqual(2, self.cache.get("long", "a"))
+
+  """ Tests that changing a cached value doesn't change what is cached. """
+  def test_copies(self):
+    value = {"a": [1]}
+    self.cache.set("api", "a", value)
+    value["a"].append(2)
+    cached = self.cache.get("api", "a")
+    cached["a"].append(3)
+    self.assertEqual({"a": [1]}, self.cache.get("api", "a"))
+
+  """ Tests that the least recently used entry is evicted first. """
+  def test_lru(self):
+    self.cache.set("api", "a", 1)
+    self.cache.set("api", "b", 2)
+    self.cache.get("api", "a")
+    self.cache.set("api", "c", 3)
+
+    self.assertEqual(1, self.cache.get("api", "a"))
+    self.assertEqual(None, self.cache.get("api", "b"))
+    self.assertEqual(3, self.cache.get("api", "c"))
+    self.assertEqual(1, self.cache.stats()["api"]["evictions"])
+
+  """ Tests invalidating a whole namespace. """
+  def test_invalidate_namespace(self):
+    self.cache.set("api", "a", 1)
+    self.cache.set("keymaster", "a", 2)
+    self.cache.invalidate("api")
+    self.assertEqual(None, self.cache.get("api", "a"))
+    self.assertEqual(2, self.cache.get("keymaster", "a"))
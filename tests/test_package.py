@@ -0,0 +1,39 @@
+import importlib
+import sys
+import unittest
+
+from .. import codec
+
+
+""" Tests for the lazy package in __init__.py. """
+class PackageTest(unittest.TestCase):
+  def setUp(self):
+    self.package = sys.modules[__name__.rsplit(".", 2)[0]]
+    self.lib = importlib.import_module("%s.lib" % (self.package.__name__))
+    # The test imports a module again, which mustn't affect other tests.
+    self.modules = sys.modules.copy()
+    self.package_attributes = self.package.__dict__.copy()
+    self.lib_attributes = self.lib.__dict__.copy()
+
+  def tearDown(self):
+    for name in set(sys.modules) - set(self.modules):
+      del sys.modules[name]
+    sys.modules.update(self.modules)
+    self.package.__dict__.clear()
+    self.package.__dict__.update(self.package_attributes)
+    self.lib.__dict__.clear()
+    self.lib.__dict__.update(self.lib_attributes)
+
+  """ Tests that modules are imported when they are first used. """
+  def test_lazy_modules(self):
+    self.assertIs(codec, self.package.codec)
+
+    name = "%s.lib.cassette" % (self.package.__name__)
+    self.package.__dict__.pop("cassette", None)
+    self.lib.__dict__.pop("cassette", None)
+    sys.modules.pop(name, None)
+    self.assertEqual(name, self.package.cassette.__name__)
+    self.assertIn(name, sys.modules)
+
+    self.assertIn("keymaster", dir(self.package))
+    self.assertRaises(AttributeError, getattr, self.package, "missing")
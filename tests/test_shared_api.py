@@ -3,11 +3,18 @@ import time
 import socket
 import unittest
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 from wsgiref import simple_server
 
 from .. import api
+from .. import breaker
+from .. import codec
+from .. import failover
+from .. import latency
+from .. import localcache
 
 
 """ Tests for api.py. """
@@ -18,6 +25,10 @@ class SharedApiTest(unittest.TestCase):
     self.testbed.activate()
     self.testbed.init_urlfetch_stub()
     self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    localcache.clear()
+    breaker.reset()
+    latency.reset()
 
     # Because request deadlines cause an IOError and the default
     # WSGI stack catches and prints these exceptions, we will get
@@ -33,6 +44,7 @@ class SharedApiTest(unittest.TestCase):
     self.threads = []
 
   def tearDown(self):
+    failover.finish_saves()
     self.testbed.deactivate()
 
   """ Single serving web server
@@ -47,6 +59,12 @@ class SharedApiTest(unittest.TestCase):
       start("200 OK", [])
       return [handler()]
 
+    return self.__serve_app_once(app)
+
+  """ Like __serve_once, but serves a whole WSGI app.
+  app: The WSGI app to serve.
+  Returns: URL to hit the web server. """
+  def __serve_app_once(self, app):
     port = 1337
 
     # Especially on Travis, we can't guarantee that a particular port will be
@@ -64,6 +82,15 @@ class SharedApiTest(unittest.TestCase):
     self.threads.append(thread)
     return "http://localhost:%s/" % port
 
+  """ Finds a port that nothing is listening on.
+  Returns: URL on that port. """
+  def __unserved_url(self):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "http://localhost:%s/" % port
+
   """ Tests that it handles requests properly. """
   def test_request(self):
     # Make sure it returns a fresh response
@@ -88,3 +115,220 @@ class SharedApiTest(unittest.TestCase):
     # Same when forcing request to non-existant server
     resp = api._request(url, force=True)
     self.assertIn(42, resp)
+
+  """ Tests that an expired request cache is answered from the failover copy
+  and refreshed in the background. """
+  def test_stale_while_revalidate(self):
+    refresher = api.LocalRefresher()
+    api.REFRESHER = refresher
+    try:
+      url = self.__serve_once(lambda: "[42]")
+      memcache.set("failure:%s" % url, ["stale"])
+
+      # The stale copy comes back without touching the server.
+      resp = api._request(url, stale_ok=True)
+      self.assertIn("stale", resp)
+      self.assertEqual([(url, 3600)], refresher.pending)
+
+      # Only one refresh is scheduled while one is pending.
+      api._request(url, stale_ok=True)
+      self.assertEqual(1, len(refresher.pending))
+
+      self.assertEqual(1, refresher.run_pending())
+      resp = api._request(url, stale_ok=True)
+      self.assertIn(42, resp)
+    finally:
+      api.REFRESHER = api.DeferredRefresher()
+
+  """ Tests that a caller that can't get the fetch lease falls back to the
+  failover copy instead of fetching. """
+  def test_fetch_lease(self):
+    api.FETCH_WAIT = 0.2
+    try:
+      url = self.__serve_once(lambda: "[42]")
+      memcache.set("failure:%s" % url, ["failover"])
+      memcache.add("lease:%s" % url, 1)
+      fetches = api.STATS["fetches"]
+
+      resp = api._request(url)
+      self.assertIn("failover", resp)
+      self.assertEqual(fetches, api.STATS["fetches"])
+
+      # Once the lease is released, it fetches normally.
+      memcache.delete("lease:%s" % url)
+      resp = api._request(url)
+      self.assertIn(42, resp)
+      self.assertEqual(fetches + 1, api.STATS["fetches"])
+    finally:
+      api.FETCH_WAIT = 2
+
+  """ Tests that threads requesting the same url share one upstream fetch. """
+  def test_thread_coalescing(self):
+    started = threading.Event()
+    release = threading.Event()
+    def app(environ, start):
+      started.set()
+      release.wait(0.5)
+      start("200 OK", [])
+      return ["[42]"]
+    url = self.__serve_app_once(app)
+    fetches = api.STATS["fetches"]
+    waited = api.STATS["waited"]
+
+    results = []
+    def request():
+      results.append(api._request(url))
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    threads[0].start()
+    self.assertTrue(started.wait(1))
+    # The others find the first thread's fetch in flight and wait on it.
+    for thread in threads[1:]:
+      thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual([[42]] * 4, results)
+    self.assertEqual(fetches + 1, api.STATS["fetches"])
+    self.assertEqual(waited + 3, api.STATS["waited"])
+
+  """ Tests fetching several urls at once. """
+  def test_request_many(self):
+    fresh_url = self.__serve_once(lambda: "[42]")
+    broken_url = self.__serve_once(lambda: "Certainly not JSON.")
+    cached_url = "http://localhost:1/cached"
+    memcache.set("request:%s" % cached_url, 1)
+    memcache.set("failure:%s" % cached_url, ["cached"])
+    memcache.set("failure:%s" % broken_url, ["failover"])
+
+    results = api._request_many([fresh_url, broken_url, cached_url])
+
+    self.assertIn(42, results[fresh_url])
+    self.assertIn("failover", results[broken_url])
+    self.assertIn("cached", results[cached_url])
+    # The fresh response was cached.
+    self.assertTrue(memcache.get("request:%s" % fresh_url))
+    self.assertIn(42, codec.get("failure:%s" % fresh_url))
+
+  """ Tests that fetching several urls at once serves stale copies and
+  respects fetch leases like single requests do. """
+  def test_request_many_coalescing(self):
+    refresher = api.LocalRefresher()
+    api.REFRESHER = refresher
+    api.FETCH_WAIT = 0.2
+    try:
+      stale_url = self.__serve_once(lambda: "[42]")
+      leased_url = self.__serve_once(lambda: "[43]")
+      memcache.set("failure:%s" % stale_url, ["stale"])
+      memcache.add("lease:%s" % leased_url, 1)
+      fetches = api.STATS["fetches"]
+
+      results = api._request_many([stale_url, leased_url], stale_ok=True)
+      self.assertIn("stale", results[stale_url])
+      self.assertEqual([(stale_url, 3600)], refresher.pending)
+      # The other caller never filled the cache, and there is no copy of it.
+      self.assertEqual([], results[leased_url])
+      self.assertEqual(fetches, api.STATS["fetches"])
+
+      memcache.delete("lease:%s" % leased_url)
+      results = api._request_many([leased_url])
+      self.assertIn(43, results[leased_url])
+      self.assertEqual(fetches + 1, api.STATS["fetches"])
+
+      self.assertEqual(1, refresher.run_pending())
+      self.assertIn(42, api._request_many([stale_url])[stale_url])
+    finally:
+      api.REFRESHER = api.DeferredRefresher()
+      api.FETCH_WAIT = 2
+
+  """ Tests that repeated failures open the circuit breaker, after which we go
+  straight to the failover copy. """
+  def test_circuit_breaker(self):
+    breaker.FAILURE_THRESHOLD = 2
+    try:
+      # Nothing listens here, so fetches fail.
+      url = self.__unserved_url()
+      memcache.set("failure:%s" % url, ["failover"])
+
+      for _ in range(2):
+        self.assertIn("failover", api._request(url, force=True))
+      self.assertFalse(breaker.for_host(url.split("/")[2]).allow())
+
+      fetches = api.STATS["fetches"]
+      self.assertIn("failover", api._request(url, force=True))
+      self.assertEqual(fetches, api.STATS["fetches"])
+    finally:
+      breaker.FAILURE_THRESHOLD = 5
+
+  """ Tests that refreshes revalidate the cached copy with a conditional
+  request. """
+  def test_conditional_request(self):
+    received = {}
+    def app(environ, start):
+      received["etag"] = environ.get("HTTP_IF_NONE_MATCH")
+      start("304 Not Modified", [])
+      return [""]
+
+    url = self.__serve_app_once(app)
+    memcache.set("failure:%s" % url, ["cached"])
+    memcache.set("validators:%s" % url, {"ETag": '"v1"'})
+
+    resp = api._request(url, force=True)
+    self.assertIn("cached", resp)
+    self.assertEqual('"v1"', received["etag"])
+    # The cached copy is fresh again.
+    self.assertTrue(memcache.get("request:%s" % url))
+    self.assertIn("cached", codec.get("failure:%s" % url))
+    # Nothing had to be stored again.
+    self.assertEqual(0, failover.FailoverCopy.all().count())
+
+  """ Tests that the failover copy survives memcache being flushed. """
+  def test_durable_failover(self):
+    url = self.__serve_once(lambda: "[42]")
+    self.assertIn(42, api._request(url))
+    failover.finish_saves()
+    copy = failover.FailoverCopy.all().get()
+    self.assertEqual(url, copy.url)
+
+    # Fetching the same content again doesn't rewrite it.
+    api._store({url: ([42], None)}, 3600)
+    self.assertEqual(copy.updated, failover.FailoverCopy.all().get().updated)
+
+    memcache.flush_all()
+    localcache.clear()
+    # The server is gone, but the datastore still has the response.
+    self.assertIn(42, api._request(url))
+
+  """ Tests that wrapped apps finish writing durable copies once they have
+  responded. """
+  def test_durable_failover_middleware(self):
+    def app(environ, start):
+      api._store({"http://example.com/a": ([1], None)}, 3600)
+      start("200 OK", [])
+      return ["done"]
+
+    wrapped = failover.middleware(app)
+    self.assertEqual(["done"], list(wrapped({}, lambda *args: None)))
+    self.assertEqual(0, failover.finish_saves())
+    self.assertTrue(memcache.get("failover_digest:http://example.com/a"))
+
+  """ Tests that a failed write of a durable copy is retried next time. """
+  def test_durable_failover_retry(self):
+    class FailedPut(object):
+      def get_result(self):
+        raise db.Timeout()
+    put_async = failover.db.put_async
+    failover.db.put_async = lambda copies: FailedPut()
+    try:
+      api._store({"http://example.com/a": ([1], None)}, 3600)
+      self.assertEqual(0, failover.finish_saves())
+    finally:
+      failover.db.put_async = put_async
+    self.assertEqual(None,
+                     memcache.get("failover_digest:http://example.com/a"))
+
+    api._store({"http://example.com/a": ([1], None)}, 3600)
+    self.assertEqual(1, failover.finish_saves())
+    self.assertEqual("http://example.com/a",
+                     failover.FailoverCopy.all().get().url)
@@ -0,0 +1,140 @@
+""" Tests for urlfetch_intercept.py. """
+
+
+import threading
+import time
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch
+
+from ..lib import urlfetch_intercept
+
+
+def echo_app(environ, start_response):
+  start_response("200 OK", [("Content-Type", "text/plain")])
+  body = environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"] or 0))
+  return ["%s %s?%s " % (environ["REQUEST_METHOD"], environ["PATH_INFO"],
+                         environ["QUERY_STRING"]), body]
+
+def write_app(environ, start_response):
+  write = start_response("201 Created", [])
+  write("written ")
+  return ["returned"]
+
+def slow_app(environ, start_response):
+  time.sleep(0.5)
+  start_response("200 OK", [])
+  return ["late"]
+
+
+class UrlfetchInterceptTest(unittest.TestCase):
+  def setUp(self):
+    urlfetch_intercept.install()
+    urlfetch_intercept.add_intercept("echo.example.com", echo_app)
+    urlfetch_intercept.add_intercept("write.example.com", write_app)
+    urlfetch_intercept.add_intercept("slow.example.com", slow_app)
+
+  def tearDown(self):
+    for host in ("echo.example.com", "write.example.com", "slow.example.com"):
+      urlfetch_intercept.remove_intercept(host)
+    urlfetch_intercept.uninstall()
+
+  """ Tests that requests reach the app and responses come back. """
+  def test_fetch(self):
+    response = urlfetch.fetch("http://echo.example.com/foo?a=1",
+                              payload="body", method=urlfetch.POST)
+    self.assertEqual(200, response.status_code)
+    self.assertEqual("text/plain", response.headers.get("content-type"))
+    self.assertEqual("POST /foo?a=1 body", response.content)
+
+  """ Tests that output passed to write() comes first. """
+  def test_write(self):
+    response = urlfetch.fetch("http://write.example.com/")
+    self.assertEqual(201, response.status_code)
+    self.assertEqual("written returned", response.content)
+
+  """ Tests that streamed content can be iterated over. """
+  def test_stream(self):
+    response = urlfetch.fetch("http://write.example.com/", stream=True)
+    self.assertEqual(["written ", "returned"], list(response.iter_content()))
+
+  """ Tests that slow apps time out. """
+  def test_deadline(self):
+    self.assertRaises(urlfetch.DeadlineExceededError, urlfetch.fetch,
+                      "http://slow.example.com/", deadline=0.1)
+    response = urlfetch.fetch("http://slow.example.com/", deadline=2)
+    self.assertEqual("late", response.content)
+
+  """ Tests that scoped intercepts shadow global ones until the scope ends,
+  and aren't seen by other threads. """
+  def test_scope(self):
+    seen = []
+    def look():
+      seen.append(urlfetch.fetch("http://echo.example.com/").content)
+
+    with urlfetch_intercept.scope():
+      urlfetch_intercept.add_intercept("echo.example.com", write_app)
+      self.assertEqual("written returned",
+                       urlfetch.fetch("http://echo.example.com/").content)
+      thread = threading.Thread(target=look)
+      thread.start()
+      thread.join()
+    self.assertEqual(["GET /? "], seen)
+    self.assertEqual("GET /? ",
+                     urlfetch.fetch("http://echo.example.com/").content)
+
+  """ Tests matching hosts by port and by wildcard. """
+  def test_host_matching(self):
+    with urlfetch_intercept.scope():
+      urlfetch_intercept.add_intercept("*.wild.example.com", echo_app)
+      urlfetch_intercept.add_intercept("a.wild.example.com:8080", write_app)
+
+      response = urlfetch.fetch("http://b.c.wild.example.com/x")
+      self.assertEqual("GET /x? ", response.content)
+      response = urlfetch.fetch("http://a.wild.example.com:8080/")
+      self.assertEqual("written returned", response.content)
+      response = urlfetch.fetch("http://a.wild.example.com:9090/")
+      self.assertEqual("GET /? ", response.content)
+      response = urlfetch.fetch("http://echo.example.com:8080/")
+      self.assertEqual("GET /? ", response.content)
+
+  """ Tests that asynchronous fetches are intercepted and run concurrently. """
+  def test_rpc(self):
+    start = time.time()
+    rpcs = []
+    for i in range(3):
+      rpc = urlfetch.create_rpc(deadline=2)
+      urlfetch.make_fetch_call(rpc, "http://slow.example.com/%d" % i)
+      rpcs.append(rpc)
+    for rpc in rpcs:
+      self.assertEqual("late", rpc.get_result().content)
+    self.assertLess(time.time() - start, 1.4)
+
+    rpc = urlfetch.create_rpc(deadline=0.1)
+    urlfetch.make_fetch_call(rpc, "http://slow.example.com/")
+    self.assertRaises(urlfetch.DeadlineExceededError, rpc.get_result)
+
+    # The deadline counts from when the fetch was made.
+    rpc = urlfetch.create_rpc(deadline=0.3)
+    urlfetch.make_fetch_call(rpc, "http://slow.example.com/")
+    time.sleep(0.2)
+    self.assertRaises(urlfetch.DeadlineExceededError, rpc.get_result)
+
+    # Without a deadline, the app runs right away.
+    rpc = urlfetch.create_rpc()
+    urlfetch.make_fetch_call(rpc, "http://echo.example.com/", method=urlfetch.PATCH)
+    self.assertTrue(rpc._done.is_set())
+    self.assertEqual("PATCH /? ", rpc.get_result().content)
+
+  """ Tests that wait_any returns intercepted rpcs as they finish. """
+  def test_wait_any(self):
+    slow = urlfetch.create_rpc(deadline=2)
+    urlfetch.make_fetch_call(slow, "http://slow.example.com/")
+    fast = urlfetch.create_rpc(deadline=2)
+    urlfetch.make_fetch_call(fast, "http://echo.example.com/")
+
+    finished = apiproxy_stub_map.UserRPC.wait_any([slow, fast])
+    self.assertIs(fast, finished)
+    self.assertEqual("GET /? ", finished.get_result().content)
+    self.assertIs(slow, apiproxy_stub_map.UserRPC.wait_any([slow]))
@@ -0,0 +1,61 @@
+""" Tests for warmup.py. """
+
+
+import json
+import unittest
+
+from google.appengine.ext import testbed
+
+from .. import auth
+from .. import localcache
+from .. import warmup
+from ..lib import keymaster
+from .test_auth import SignupSimulator
+
+
+class WarmupTest(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    localcache.clear()
+
+    self.signup_app = SignupSimulator()
+    auth.AuthHandler.URL_FETCHER = self.signup_app
+
+  def tearDown(self):
+    auth.AuthHandler.URL_FETCHER = auth.UrlFetch()
+    del warmup.KEY_NAMES[:]
+    self.testbed.deactivate()
+
+  """ Tests that keys and active users get loaded into the caches. """
+  def test_warm(self):
+    keymaster.set("test:key", "secret")
+    keymaster.set("test:other_key", "other secret")
+    localcache.clear()
+    warmup.register(key_names=["test:key", "test:missing"])
+
+    auth.AuthHandler._note_active_user(1)
+    user_info = {"email": "testy.testerson@gmail.com"}
+    self.signup_app.set_response(json.dumps(user_info))
+
+    counts = warmup.warm()
+
+    self.assertEqual({"api_paths": 0, "keys": 1, "users": 1}, counts)
+    self.assertEqual("secret", localcache.get("keymaster", "test:key"))
+    self.assertEqual(None, localcache.get("keymaster", "test:other_key"))
+    self.assertEqual(user_info, localcache.get("user_data", "user_data.1"))
+
+  """ Tests that what one instance registers is warmed by the others. """
+  def test_saved_manifest(self):
+    keymaster.set("test:key", "secret")
+    warmup.register(key_names=["test:key"])
+    warmup.register(key_names=["test:key"])
+    # As if this were a new instance that hasn't registered anything.
+    del warmup.KEY_NAMES[:]
+    localcache.clear()
+
+    self.assertEqual(([], ["test:key"]), warmup.manifest())
+    self.assertEqual(1, warmup.warm()["keys"])
+    self.assertEqual("secret", localcache.get("keymaster", "test:key"))
@@ -5,8 +5,6 @@ import logging
 import sys
 import traceback
 
-from google.appengine.ext import webapp
-
 def set_cookie(response, key, value, expires=0):
     """ Convenience function for setting a cookie """
     expiration = datetime.datetime.now() + datetime.timedelta(seconds=expires)
@@ -51,12 +49,16 @@ class RedirectException(Exception):
                 self.response.clear()
                 self.response.out.write('<pre>%s</pre>' % (cgi.escape(lines, quote=True)))
 
-# webapp framework monkey patch to support RedirectException
-webapp.RequestHandler.handle_exception = RedirectException.handle_exception
+def install_redirect_handler():
+    """ Monkey patches the webapp framework to support RedirectException. Apps
+    whose handlers raise it should call this once when they start up. """
+    from google.appengine.ext import webapp
+    webapp.RequestHandler.handle_exception = RedirectException.handle_exception
 
 
 def Redirect(path):
     """ Convenience RequestHandler that simply redirects to a path """
+    from google.appengine.ext import webapp
     class RedirectHandler(webapp.RequestHandler):
         def get(self):
             self.redirect(path)
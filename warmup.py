@@ -0,0 +1,162 @@
+""" Warms up the shared caches before user traffic arrives.
+
+After a deploy or a memcache flush, the first users to show up would otherwise
+hit every cold path at once. This fills memcache and the in-process caches in
+bulk from a manifest of api paths, keymaster key names and the users that have
+been active recently.
+
+Apps register what to warm when they start up:
+
+from shared import warmup
+warmup.register(api_paths=["/api/v1/members"], key_names=["mailchimp:api_key"])
+
+The manifest is saved in the datastore and cached in memcache, so the warmup
+request and the cron job see it even on an instance that hasn't run the code
+that registers it yet.
+
+and route the warmup request and a cron job to this module in app.yaml:
+
+inbound_services:
+- warmup
+
+handlers:
+- url: /_ah/warmup
+  script: shared.warmup.app
+- url: /_warmup/refresh
+  script: shared.warmup.app
+  login: admin
+
+with this in cron.yaml:
+
+cron:
+- description: refresh shared caches
+  url: /_warmup/refresh
+  schedule: every 30 minutes
+
+The warmup request fills the caches of the instance that is starting, while
+the cron job re-fetches everything into memcache so that it doesn't expire. """
+
+
+import logging
+import time
+
+import webapp2
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import api
+from auth import AuthHandler
+from lib import keymaster
+
+
+# What this instance has registered to warm.
+API_PATHS = []
+KEY_NAMES = []
+# How many of the recently active users to load data for.
+ACTIVE_USERS = 200
+
+_MANIFEST_KEY = "warmup_manifest"
+
+
+""" Datastore entity holding everything that has been registered to warm, by
+any instance. """
+class WarmupManifest(db.Model):
+  api_paths = db.StringListProperty(indexed=False)
+  key_names = db.StringListProperty(indexed=False)
+
+
+""" Gets the saved manifest, from memcache if it's there.
+Returns: A tuple of the api paths and the key names. """
+def _load_manifest():
+  manifest = memcache.get(_MANIFEST_KEY)
+  if manifest is None:
+    saved = WarmupManifest.get_by_key_name("shared")
+    if saved:
+      manifest = (list(saved.api_paths), list(saved.key_names))
+    else:
+      manifest = ([], [])
+    memcache.add(_MANIFEST_KEY, manifest)
+  return manifest
+
+""" Adds to the saved manifest.
+api_paths: Paths to add.
+key_names: Key names to add. """
+def _save_manifest(api_paths, key_names):
+  def txn():
+    saved = WarmupManifest.get_by_key_name("shared") or \
+        WarmupManifest(key_name="shared")
+    saved.api_paths += [path for path in api_paths \
+                        if path not in saved.api_paths]
+    saved.key_names += [name for name in key_names \
+                        if name not in saved.key_names]
+    saved.put()
+    return (list(saved.api_paths), list(saved.key_names))
+  memcache.set(_MANIFEST_KEY, db.run_in_transaction(txn))
+
+""" Adds things to the warmup manifest, and saves whatever wasn't in it
+already.
+api_paths: Paths on hd-domain to fetch with api.fetch_many().
+key_names: Keymaster key names to load. """
+def register(api_paths=(), key_names=()):
+  for path in api_paths:
+    if path not in API_PATHS:
+      API_PATHS.append(path)
+  for name in key_names:
+    if name not in KEY_NAMES:
+      KEY_NAMES.append(name)
+
+  saved_paths, saved_names = _load_manifest()
+  new_paths = [path for path in api_paths if path not in saved_paths]
+  new_names = [name for name in key_names if name not in saved_names]
+  if new_paths or new_names:
+    _save_manifest(new_paths, new_names)
+
+""" Gets everything there is to warm, whether it was registered here or by
+another instance.
+Returns: A tuple of the api paths and the key names. """
+def manifest():
+  saved_paths, saved_names = _load_manifest()
+  return (API_PATHS + [path for path in saved_paths if path not in API_PATHS],
+          KEY_NAMES + [name for name in saved_names if name not in KEY_NAMES])
+
+""" Warms all the caches from the manifest.
+force: Whether to re-fetch api paths even if they are cached.
+Returns: A dict with how many of each kind of thing were warmed. """
+def warm(force=False):
+  start = time.time()
+  counts = {"api_paths": 0, "keys": 0, "users": 0}
+  api_paths, key_names = manifest()
+
+  if api_paths:
+    results = api.fetch_many(api_paths, force=force)
+    counts["api_paths"] = len([path for path in results if results[path]])
+
+  if key_names:
+    counts["keys"] = len(keymaster.get_many(key_names))
+
+  users = AuthHandler.active_users()[:ACTIVE_USERS]
+  if users:
+    user_data = AuthHandler.get_users(users)
+    counts["users"] = len([user for user in user_data if user_data[user]])
+
+  logging.info("Warmed %s in %.2fs." % (counts, time.time() - start))
+  return counts
+
+
+""" Handles the App Engine warmup request. """
+class WarmupHandler(webapp2.RequestHandler):
+  def get(self):
+    warm()
+
+
+""" Handles the cron job that keeps the caches fresh. """
+class RefreshHandler(webapp2.RequestHandler):
+  def get(self):
+    counts = warm(force=True)
+    self.response.out.write(repr(counts))
+
+
+app = webapp2.WSGIApplication([
+    ("/_ah/warmup", WarmupHandler),
+    ("/_warmup/refresh", RefreshHandler)])